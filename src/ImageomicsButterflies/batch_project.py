@@ -0,0 +1,301 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from project import NORMALIZE
+from helpers import get_device
+from scoring_model import get_scoring_model, scores
+
+# Packs many independent projection targets into a fixed number of slots so each
+# optimization step is a single G.synthesis call. Every target keeps its own label,
+# learning rate schedule, loss weights and early stopping state. When a target
+# finishes, its slot is refilled with the next pending target.
+
+def per_target(value, n, dtype=torch.float32):
+    if value is None:
+        return None
+    if torch.is_tensor(value):
+        value = value.detach().cpu()
+    value = torch.as_tensor(np.array(value), dtype=dtype)
+    if value.dim() == 0:
+        value = value.repeat(n)
+    assert len(value) == n, f"Expected {n} per target values, got {len(value)}"
+    return value
+
+def lr_schedule(steps, num_steps, init_lr, lr_rampdown_length, lr_rampup_length):
+    t = steps / num_steps
+    lr_ramp = torch.clamp((1.0 - t) / lr_rampdown_length, max=1.0)
+    lr_ramp = 0.5 - 0.5 * torch.cos(lr_ramp * np.pi)
+    lr_ramp = lr_ramp * torch.clamp(t / lr_rampup_length, max=1.0)
+    return init_lr * lr_ramp
+
+def stack_histories(histories):
+    # Targets that stopped early are padded with their last value
+    length = max(len(h) for h in histories)
+    padded = []
+    for h in histories:
+        h = np.array(h)
+        pad = [(0, length - len(h))] + [(0, 0)] * (h.ndim - 1)
+        padded.append(np.pad(h, pad, mode='edge'))
+    return np.array(padded)
+
+def project_batch(
+    G,
+    F,
+    C,
+    start_ws,
+    images                     = None,
+    labels                     = None,
+    start_zs                   = None,
+    feat_extractor             = None,
+    learn_param                = "w",
+    batch_size                 = 64,
+    num_steps                  = 200,
+    init_lr                    = 0.001,
+    lr_rampdown_length         = 0.25,
+    lr_rampup_length           = 0.05,
+    pixel_lambda               = 1.0,
+    perceptual_lambda          = 0.01,
+    class_lambda               = 0.0,
+    min_loss_lambda            = 0.0,
+    patience                   = 0,
+    min_delta                  = 1e-4,
+    on_record                  = None,
+    record_every               = 1,
+    verbose                    = False,
+    log_every                  = 50
+):
+    if learn_param == "w":
+        num_targets = len(start_ws)
+        start_param = start_ws
+    elif learn_param == "z":
+        num_targets = len(start_zs)
+        start_param = start_zs
+    else:
+        assert False, "Invalide learn_param"
+    assert images is not None or labels is not None, "Need either target images or target labels"
+    if images is not None:
+        assert len(images) == num_targets, "Need one target image per starting latent"
+        assert F is not None or feat_extractor is not None, "Need a feature extractor for the perceptual loss"
+    if feat_extractor is None:
+        feat_extractor = lambda x: F(NORMALIZE(x))
+
+    device = start_param.device if torch.is_tensor(start_param) else get_device()
+    slots = min(batch_size, num_targets)
+    param_dim = start_param[0].shape[-1]
+
+    # Per target settings
+    num_steps = per_target(num_steps, num_targets)
+    init_lr = per_target(init_lr, num_targets)
+    lr_rampdown_length = per_target(lr_rampdown_length, num_targets)
+    lr_rampup_length = per_target(lr_rampup_length, num_targets)
+    pixel_lambda = per_target(pixel_lambda, num_targets)
+    perceptual_lambda = per_target(perceptual_lambda, num_targets)
+    class_lambda = per_target(class_lambda, num_targets)
+    min_loss_lambda = per_target(min_loss_lambda, num_targets)
+    patience = per_target(patience, num_targets, dtype=torch.long)
+    min_delta = per_target(min_delta, num_targets)
+    labels = per_target(labels, num_targets, dtype=torch.long)
+    use_classifier = C is not None and F is not None and labels is not None
+    # C(F(NORMALIZE(.))) fused into one model, shared with project()
+    scorer = get_scoring_model(F, C) if use_classifier else None
+
+    # Slot buffers
+    slot_target = torch.full([slots], -1, dtype=torch.long)
+    slot_start = torch.zeros([slots, param_dim], device=device)
+    slot_images = None
+    slot_features = None
+    slot_labels = torch.zeros([slots], dtype=torch.long, device=device)
+    slot_steps = torch.zeros([slots], device=device)
+    slot_best = torch.full([slots], float('inf'), device=device)
+    slot_since_best = torch.zeros([slots], dtype=torch.long)
+    settings = {
+        "num_steps" : num_steps,
+        "init_lr" : init_lr,
+        "lr_rampdown_length" : lr_rampdown_length,
+        "lr_rampup_length" : lr_rampup_length,
+        "pixel_lambda" : pixel_lambda,
+        "perceptual_lambda" : perceptual_lambda,
+        "class_lambda" : class_lambda,
+        "min_loss_lambda" : min_loss_lambda,
+        "min_delta" : min_delta
+    }
+    slot_settings = {k : torch.zeros([slots], device=device) for k in settings}
+
+    # Learnable offsets and Adam moments, kept per slot so a refilled slot starts fresh
+    learnable = torch.zeros([slots, param_dim], device=device).requires_grad_()
+    adam_m = torch.zeros_like(learnable)
+    adam_v = torch.zeros_like(learnable)
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+
+    # Outputs
+    ws_out = np.zeros([num_targets, G.w_dim], dtype=np.float32)
+    zs_out = np.zeros([num_targets, param_dim], dtype=np.float32) if learn_param == "z" else None
+    images_out = [None] * num_targets
+    steps_out = np.zeros([num_targets], dtype=np.int64)
+    history = {
+        "pixel_losses" : [[] for _ in range(num_targets)],
+        "perceptual_losses" : [[] for _ in range(num_targets)],
+        "class_losses" : [[] for _ in range(num_targets)],
+        "min_losses" : [[] for _ in range(num_targets)],
+        "image_confs" : [[] for _ in range(num_targets)],
+    }
+
+    CELoss = nn.CrossEntropyLoss(reduction='none')
+
+    def load_slots(slot_ids, target_ids):
+        nonlocal slot_images, slot_features
+        target_ids = torch.as_tensor(list(target_ids), dtype=torch.long)
+        slot_ids = torch.as_tensor(list(slot_ids), dtype=torch.long)
+        slot_target[slot_ids] = target_ids
+        slot_start[slot_ids] = torch.stack([start_param[i].reshape(-1).detach() for i in target_ids.tolist()]).to(device, torch.float32)
+        if images is not None:
+            imgs = torch.stack([images[i].detach() for i in target_ids.tolist()]).to(device, torch.float32)
+            with torch.no_grad():
+                feats = feat_extractor(imgs)
+            if slot_images is None:
+                slot_images = torch.zeros([slots] + list(imgs.shape[1:]), device=device)
+                slot_features = torch.zeros([slots] + list(feats.shape[1:]), device=device)
+            slot_images[slot_ids] = imgs
+            slot_features[slot_ids] = feats
+        if labels is not None:
+            slot_labels[slot_ids] = labels[target_ids].to(device)
+        for k in settings:
+            slot_settings[k][slot_ids] = settings[k][target_ids].to(device)
+        slot_steps[slot_ids] = 0
+        slot_best[slot_ids] = float('inf')
+        slot_since_best[slot_ids] = 0
+        with torch.no_grad():
+            learnable[slot_ids] = 0
+            adam_m[slot_ids] = 0
+            adam_v[slot_ids] = 0
+
+    next_target = slots
+    load_slots(range(slots), range(slots))
+    finished = 0
+    it = 0
+    while finished < num_targets:
+        active = (slot_target >= 0).nonzero()[:, 0]
+        active_dev = active.to(device)
+        targets = slot_target[active]
+
+        #####################################################################
+        # Generate images for every active slot in one pass
+        #####################################################################
+        params = slot_start[active_dev] + learnable[active_dev]
+        if learn_param == "w":
+            w_opt = params
+        else:
+            w_opt = G.mapping(params, None)[:, 0, :]
+        synth_images = G.synthesis(w_opt.unsqueeze(1).repeat([1, G.num_ws, 1]), noise_mode='const')
+        synth_images = (synth_images + 1) * (1/2)
+        synth_images = synth_images.clamp(0, 1)
+
+        #####################################################################
+        # Per target losses
+        #####################################################################
+        row_loss = torch.zeros([len(active)], device=device)
+        pixel_loss = torch.zeros_like(row_loss)
+        perceptual_loss = torch.zeros_like(row_loss)
+        class_loss = torch.zeros_like(row_loss)
+        confs = None
+        if images is not None:
+            synth_features = feat_extractor(synth_images)
+            pixel_loss = (slot_images[active_dev] - synth_images).abs().flatten(1).mean(1)
+            perceptual_loss = ((slot_features[active_dev] - synth_features) ** 2).flatten(1).mean(1)
+            row_loss = row_loss + slot_settings["pixel_lambda"][active_dev] * pixel_loss
+            row_loss = row_loss + slot_settings["perceptual_lambda"][active_dev] * perceptual_loss
+        if use_classifier:
+            out, confs, _ = scores(scorer, synth_images)
+            class_loss = CELoss(out, slot_labels[active_dev])
+            row_loss = row_loss + slot_settings["class_lambda"][active_dev] * class_loss
+        min_loss = learnable[active_dev].abs().mean(1)
+        row_loss = row_loss + slot_settings["min_loss_lambda"][active_dev] * min_loss
+
+        #####################################################################
+        # Record (one host copy per step)
+        #####################################################################
+        record = torch.stack([pixel_loss, perceptual_loss, class_loss, min_loss, row_loss], 1).detach().cpu().numpy()
+        confs_np = confs.detach().cpu().numpy() if confs is not None else None
+        w_np = w_opt.detach().cpu().numpy()
+        z_np = params.detach().cpu().numpy() if learn_param == "z" else None
+        for r, t in enumerate(targets.tolist()):
+            history["pixel_losses"][t].append(record[r, 0])
+            history["perceptual_losses"][t].append(record[r, 1])
+            history["class_losses"][t].append(record[r, 2])
+            history["min_losses"][t].append(record[r, 3])
+            if confs_np is not None:
+                history["image_confs"][t].append(confs_np[r])
+
+        #####################################################################
+        # Step: Adam with a per slot learning rate and step count
+        #####################################################################
+        learnable.grad = None
+        row_loss.sum().backward()
+        with torch.no_grad():
+            steps = slot_steps[active_dev]
+            lr = lr_schedule(steps, slot_settings["num_steps"][active_dev], slot_settings["init_lr"][active_dev],
+                             slot_settings["lr_rampdown_length"][active_dev], slot_settings["lr_rampup_length"][active_dev])
+            grad = learnable.grad[active_dev]
+            adam_m[active_dev] = beta1 * adam_m[active_dev] + (1 - beta1) * grad
+            adam_v[active_dev] = beta2 * adam_v[active_dev] + (1 - beta2) * grad * grad
+            bias1 = 1 - beta1 ** (steps + 1)
+            bias2 = 1 - beta2 ** (steps + 1)
+            update = (adam_m[active_dev] / bias1.unsqueeze(1)) / ((adam_v[active_dev] / bias2.unsqueeze(1)).sqrt() + eps)
+            learnable[active_dev] -= lr.unsqueeze(1) * update
+            slot_steps[active_dev] += 1
+
+            # Early stopping state
+            row_loss = row_loss.detach()
+            improved = row_loss < (slot_best[active_dev] - slot_settings["min_delta"][active_dev])
+            slot_best[active_dev] = torch.where(improved, row_loss, slot_best[active_dev])
+            improved = improved.cpu()
+            slot_since_best[active] = torch.where(improved, torch.zeros_like(slot_since_best[active]), slot_since_best[active] + 1)
+            done = slot_steps[active_dev].cpu() >= num_steps[targets]
+            done |= (patience[targets] > 0) & (slot_since_best[active] >= patience[targets])
+
+        # Trajectory capture: every record_every steps and at each target's last step.
+        # on_record(targets, steps, images, ws, zs), zs is None unless learning z
+        if on_record is not None:
+            steps_np = slot_steps[active_dev].long().cpu() - 1
+            keep = (steps_np % record_every == 0) | done
+            if keep.any():
+                rows = keep.nonzero()[:, 0]
+                on_record(targets[rows].numpy(), steps_np[rows].numpy(), synth_images[rows.to(device)].detach().cpu().numpy(), w_np[rows.numpy()],
+                          z_np[rows.numpy()] if z_np is not None else None)
+
+        #####################################################################
+        # Retire finished targets and refill their slots
+        #####################################################################
+        if done.any():
+            done_rows = done.nonzero()[:, 0]
+            for r in done_rows.tolist():
+                t = targets[r].item()
+                ws_out[t] = w_np[r]
+                if zs_out is not None:
+                    zs_out[t] = z_np[r]
+                images_out[t] = synth_images[r].detach().cpu().numpy()
+                steps_out[t] = len(history["pixel_losses"][t])
+            finished += len(done_rows)
+
+            freed = active[done_rows].tolist()
+            refill = min(len(freed), num_targets - next_target)
+            if refill > 0:
+                load_slots(freed[:refill], range(next_target, next_target + refill))
+                next_target += refill
+            if refill < len(freed):
+                slot_target[torch.tensor(freed[refill:], dtype=torch.long)] = -1
+
+        if verbose and it % log_every == 0:
+            print(f'iter {it:>5d}: active {len(active)} finished {finished}/{num_targets} avg loss {record[:, 4].mean():<5.4f}')
+        it += 1
+
+    results = {
+        "ws" : ws_out,
+        "zs" : zs_out,
+        "images" : np.array(images_out),
+        "steps" : steps_out,
+    }
+    for key, values in history.items():
+        results[key] = values
+    return results
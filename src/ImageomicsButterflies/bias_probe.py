@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+from scipy.spatial import cKDTree
+
+from image_cache import cache_key, rgb_loader
+
+# Background bias probe. Cheap background statistics are extracted for every
+# image of a dataset in one pass (and cached per dataset), then a KNN on those
+# statistics alone tells how much of the label leaks through the background.
+#
+# Feature types, all from the image resized to resolution x resolution in [0, 1]:
+#   pixel    the top left pixel
+#   corners  the four corner pixels
+#   border   per channel histogram of the border ring
+
+FEATURE_TYPES = ["pixel", "corners", "border"]
+BIAS_CACHE_DIR = "../cache/bias_probe"
+
+def background_features(img, ring=4, bins=8):
+    # img: [H, W, 3] float in [0, 1]
+    corners = np.stack((img[0, 0], img[0, -1], img[-1, -1], img[-1, 0]))
+    border = np.ones(img.shape[:2], dtype=bool)
+    border[ring:-ring, ring:-ring] = False
+    border_px = img[border]
+    hist = [np.histogram(border_px[:, c], bins=bins, range=(0, 1))[0] for c in range(img.shape[2])]
+    hist = np.concatenate(hist).astype(np.float32) / len(border_px)
+    return {
+        "pixel" : img[0, 0],
+        "corners" : corners.reshape(-1),
+        "border" : hist
+    }
+
+class BackgroundStats(Dataset):
+    def __init__(self, paths, resolution=128, ring=4, bins=8, loader=rgb_loader):
+        self.paths = paths
+        self.resize = transforms.Resize((resolution, resolution))
+        self.ring = ring
+        self.bins = bins
+        self.loader = loader
+
+    def __getitem__(self, index):
+        img = np.asarray(self.resize(self.loader(self.paths[index])), dtype=np.float32) / 255
+        return {k : torch.from_numpy(v) for k, v in background_features(img, self.ring, self.bins).items()}
+
+    def __len__(self):
+        return len(self.paths)
+
+def extract_features(paths, root="", resolution=128, ring=4, bins=8, cache_dir=BIAS_CACHE_DIR, workers=4, batch_size=64):
+    path = os.path.join(cache_dir, cache_key(root, resolution, paths, extra=[ring, bins]) + ".npz")
+    if os.path.exists(path):
+        data = np.load(path)
+        return {k : data[k] for k in FEATURE_TYPES}
+
+    dl = DataLoader(BackgroundStats(paths, resolution, ring, bins), batch_size=batch_size, num_workers=workers)
+    batches = list(dl)
+    feats = {k : torch.cat([batch[k] for batch in batches]).numpy() for k in FEATURE_TYPES}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **feats)
+    os.replace(tmp_path, path)
+    return feats
+
+def nearest_neighbors(train_feats, test_feats, k, method="matrix", chunk_size=4096):
+    # Indices of the k nearest train rows of every test row, closest first
+    k = min(k, len(train_feats))
+    if method == "kdtree":
+        _, idx = cKDTree(train_feats).query(test_feats, k=k)
+        return idx.reshape(len(test_feats), k)
+
+    train_sq = (train_feats ** 2).sum(1)
+    neighbors = []
+    for start in range(0, len(test_feats), chunk_size):
+        query = test_feats[start:start+chunk_size]
+        dist = train_sq[None] - 2 * query @ train_feats.T
+        if k < len(train_feats):
+            idx = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.tile(np.arange(len(train_feats)), (len(query), 1))
+        order = np.argsort(np.take_along_axis(dist, idx, axis=1), axis=1)
+        neighbors.append(np.take_along_axis(idx, order, axis=1))
+    return np.concatenate(neighbors)
+
+def knn_accuracy(train_feats, train_lbls, test_feats, test_lbls, Ks=[1, 5, 10], method="matrix"):
+    # A test image counts as correct when its label is one of the tied modes of its K neighbors
+    train_lbls = np.asarray(train_lbls)
+    test_lbls = np.asarray(test_lbls)
+    num_classes = max(train_lbls.max(), test_lbls.max()) + 1
+    neighbor_lbls = train_lbls[nearest_neighbors(train_feats, test_feats, max(Ks), method=method)]
+
+    accs = {}
+    for K in Ks:
+        counts = np.zeros((len(test_lbls), num_classes), dtype=np.int64)
+        np.add.at(counts, (np.arange(len(test_lbls))[:, None], neighbor_lbls[:, :K]), 1)
+        correct = counts[np.arange(len(test_lbls)), test_lbls] == counts.max(1)
+        accs[K] = float(correct.mean())
+    return accs
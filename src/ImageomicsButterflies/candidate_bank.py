@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import torch
+
+from project import NORMALIZE
+
+# A reusable bank of random w candidates with their synthesized images and
+# feature vectors. Targets are matched against every candidate at once instead
+# of synthesizing and scoring the candidates again for each target.
+
+class CandidateBank:
+    def __init__(self, ws, images, features, network=None, seed=123):
+        self.ws = ws                # [N, C] float32
+        self.images = images        # [N, 3, H, W] uint8
+        self.features = features    # [N, D] float32
+        self.network = network
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.ws)
+
+    @staticmethod
+    def build(G, F, num_samples=100, seed=123, batch_size=32, network=None):
+        device = next(G.parameters()).device
+        z_samples = torch.from_numpy(np.random.RandomState(seed).randn(num_samples, G.z_dim)).to(device)
+        ws = []
+        images = []
+        features = []
+        with torch.no_grad():
+            for i in range(0, num_samples, batch_size):
+                w = G.mapping(z_samples[i:i+batch_size], None)[:, :1, :]
+                synth_images = G.synthesis(w.repeat([1, G.num_ws, 1]), noise_mode='const')
+                synth_images = ((synth_images + 1) * (1/2)).clamp(0, 1)
+                ws.append(w[:, 0].cpu().numpy().astype(np.float32))
+                images.append((synth_images * 255).round().cpu().numpy().astype(np.uint8))
+                features.append(F(NORMALIZE(synth_images)).flatten(1).cpu().numpy().astype(np.float32))
+        return CandidateBank(np.concatenate(ws), np.concatenate(images), np.concatenate(features), network=network, seed=seed)
+
+    @staticmethod
+    def load(path):
+        data = np.load(path, allow_pickle=True)
+        return CandidateBank(data['ws'], data['images'], data['features'], network=str(data['network']) or None, seed=int(data['seed']))
+
+    def save(self, path):
+        np.savez(path, ws=self.ws, images=self.images, features=self.features, network=self.network or '', seed=self.seed)
+
+    @staticmethod
+    def load_or_build(path, G, F, num_samples=100, seed=123, network=None):
+        if path is not None and os.path.exists(path):
+            bank = CandidateBank.load(path)
+            if len(bank) == num_samples and bank.seed == seed and bank.network == network:
+                return bank
+            print(f"Candidate bank at {path} does not match, rebuilding...")
+        bank = CandidateBank.build(G, F, num_samples=num_samples, seed=seed, network=network)
+        if path is not None:
+            bank.save(path)
+        return bank
+
+    def score(self, F, images, pixel_lambda=0.0, chunk_size=16):
+        # Returns a [num targets, num candidates] loss matrix
+        device = next(F.parameters()).device
+        features = torch.from_numpy(self.features).to(device)
+        cand_images = None
+        if pixel_lambda != 0:
+            cand_images = torch.from_numpy(self.images).to(device).float().flatten(1) / 255
+        losses = []
+        with torch.no_grad():
+            for i in range(0, len(images), chunk_size):
+                imgs = images[i:i+chunk_size].to(device).float()
+                feats = F(NORMALIZE(imgs)).flatten(1)
+                # Mean squared error between every target and every candidate
+                loss = (feats.pow(2).sum(1, keepdim=True) - 2 * feats @ features.T + features.pow(2).sum(1)) / feats.shape[1]
+                if cand_images is not None:
+                    loss = loss + pixel_lambda * torch.cdist(imgs.flatten(1), cand_images, p=1) / cand_images.shape[1]
+                losses.append(loss.cpu())
+        return torch.cat(losses)
+
+    def best_ws(self, F, images, pixel_lambda=0.0, chunk_size=16):
+        loss = self.score(F, images, pixel_lambda=pixel_lambda, chunk_size=chunk_size)
+        best = loss.argmin(1).numpy()
+        return torch.from_numpy(self.ws[best]).to(next(F.parameters()).device), loss[torch.arange(len(best)), best]
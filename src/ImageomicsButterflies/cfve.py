@@ -21,6 +21,7 @@ from models import Res50, Classifier, VGG16, VGG16_Decoder
 from loggers import Logger
 from data_tools import NORMALIZE, image_transform, to_tensor, test_image_transform, rgb_img_loader, to_grayscale, cosine_similarity
 from datasets import ImageList
+from helpers import get_device
 
 def get_size_after_conv(cur_size, module):
     stride = module.stride
@@ -58,6 +59,7 @@ def get_args():
     parser.add_argument("--distractor_img", type=str, default="/local/scratch/datasets/high_res_butterfly_data_test/aglaope_M/10428111_V_aglaope_M.png")
     parser.add_argument("--feature_dims", nargs="+", type=int, default=[512, 7, 7])
 
+    parser.add_argument("--beam_width", type=int, default=1)
     parser.add_argument("--batch_size", type=int, default=64)
     parser.add_argument("--workers", type=int, default=4)
 
@@ -67,24 +69,84 @@ def get_args():
     args = parser.parse_args()
     return args
 
-def get_next_edit(feat_original, feat_target, tgt_lbl, classifier, S=[]):
-    highest_conf = 0.0
-    edit = [-1, -1]
-    sm = nn.Softmax()
+def linear_head(classifier):
+    # (weight, bias) when the classifier is a single linear layer
+    if isinstance(classifier, nn.Linear):
+        return classifier.weight, classifier.bias
+    if isinstance(getattr(classifier, "linear", None), nn.Linear) and len(list(classifier.children())) == 1:
+        return classifier.linear.weight, classifier.linear.bias
+    return None
+
+def swap_logits(feat_original, feat_target, classifier, chunk_size=4096):
+    """
+    Logits of every single cell swap, [N, N, K] with [i, j] = cell i of
+    feat_original replaced by cell j of feat_target. Features are [C, N].
+    For a linear head this is closed form: swapping cell i changes the logits
+    by W_i @ T_j - W_i @ O_i (W_i the weights seeing cell i).
+    """
+    C, N = feat_original.shape
+    head = linear_head(classifier)
+    if head is not None:
+        weight, bias = head
+        weight = weight.view(-1, C, N)
+        logits = weight.reshape(len(weight), -1) @ feat_original.reshape(-1) + bias
+        gain = torch.einsum('kci,cj->ijk', weight, feat_target)
+        loss = torch.einsum('kci,ci->ik', weight, feat_original)
+        return logits + gain - loss.unsqueeze(1)
+
+    # Any other head: score the swapped feature maps in batches
+    i, j = torch.meshgrid(torch.arange(N), torch.arange(N), indexing='ij')
+    i, j = i.flatten(), j.flatten()
+    out = []
+    for start in range(0, N*N, chunk_size):
+        ci, cj = i[start:start+chunk_size], j[start:start+chunk_size]
+        feats = feat_original.unsqueeze(0).repeat(len(ci), 1, 1)
+        feats[torch.arange(len(ci)), :, ci] = feat_target[:, cj].T
+        out.append(classifier(feats.view(len(ci), -1)))
+    return torch.cat(out).view(N, N, -1)
+
+def cve_search(feat_original, feat_target, tgt_lbl, classifier, beam_width=1, max_edits=None):
+    """
+    Greedy (beam_width=1) or beam search for the fewest cell swaps that make
+    tgt_lbl the prediction. Every step scores all swaps of all beams at once,
+    cells used by a beam are masked out. Returns (S, conf, edited features).
+    """
+    N = feat_original.shape[1]
+    max_edits = N if max_edits is None else max_edits
+    sm = nn.Softmax(dim=-1)
+    # beam: (features, S, used sources, used targets)
+    beams = [(feat_original.clone(), [], torch.zeros(N, dtype=torch.bool, device=feat_original.device), torch.zeros(N, dtype=torch.bool, device=feat_original.device))]
+    best_conf = 0.0
     with torch.no_grad():
-        for i in range(feat_original.shape[1]):
-            if len(list(filter(lambda x: x[0] == i, S))): continue
-            for j in range(feat_target.shape[1]):
-                if len(list(filter(lambda x: x[1] == j, S))): continue
-                tmp = feat_original[:, i].clone()
-                feat_original[:, i] = feat_target[:, j]
-                out = classifier(feat_original.view(-1).unsqueeze(0))[0]
-                conf = sm(out)
-                if conf[tgt_lbl] > highest_conf:
-                    highest_conf = conf[tgt_lbl]
-                    edit = [i, j]
-                feat_original[:, i] = tmp
-    return edit, highest_conf
+        for _ in range(max_edits):
+            candidates = []
+            for b, (feats, S, used_i, used_j) in enumerate(beams):
+                confs = sm(swap_logits(feats, feat_target, classifier))
+                tgt_confs = confs[:, :, tgt_lbl].clone()
+                tgt_confs[used_i, :] = -1.0
+                tgt_confs[:, used_j] = -1.0
+                top = tgt_confs.view(-1).topk(min(beam_width, int((~used_i).sum() * (~used_j).sum())))
+                for conf, idx in zip(top.values, top.indices):
+                    i, j = idx.item() // N, idx.item() % N
+                    candidates.append((conf.item(), b, i, j, confs[i, j].argmax().item() == tgt_lbl))
+            if len(candidates) == 0:
+                break
+
+            candidates = sorted(candidates, key=lambda x: -x[0])[:beam_width]
+            best_conf = candidates[0][0]
+            new_beams = []
+            for conf, b, i, j, flipped in candidates:
+                feats, S, used_i, used_j = beams[b]
+                feats = feats.clone()
+                feats[:, i] = feat_target[:, j]
+                used_i, used_j = used_i.clone(), used_j.clone()
+                used_i[i] = True
+                used_j[j] = True
+                new_beams.append((feats, S + [[i, j]], used_i, used_j))
+                if flipped:
+                    return new_beams[-1][1], conf, new_beams[-1][0]
+            beams = new_beams
+    return beams[0][1], best_conf, beams[0][0]
 
 def create_guassian_block(size, temp=0.01):
     mid = [size[0] // 2, size[1] // 2]
@@ -118,7 +180,7 @@ def visualize_feature(backbone, classifier, img, img_features, img2, img2_featur
     ToPILImage()(img).save("composite.png")
 
     with torch.no_grad():
-        img = img.cuda()
+        img = img.to(next(backbone.parameters()).device)
         out = classifier(backbone(img.unsqueeze(0)))
         sm = nn.Softmax()
         print(sm(out[0])[lbl])
@@ -144,10 +206,11 @@ def main():
     setup(args)
     dset = ImageList(args.dset, transform=image_transform())
     #train_dataloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
-    backbone = VGG16(pretrain=False).cuda()
-    backbone.load_state_dict(torch.load(args.backbone))
-    classifier = Classifier(backbone.in_features, dset.get_num_classes()).cuda()
-    classifier.load_state_dict(torch.load(args.classifier))
+    device = get_device()
+    backbone = VGG16(pretrain=False).to(device)
+    backbone.load_state_dict(torch.load(args.backbone, map_location=device))
+    classifier = Classifier(backbone.in_features, dset.get_num_classes()).to(device)
+    classifier.load_state_dict(torch.load(args.classifier, map_location=device))
     
     # Select source & distractor img
     args.source_lbl = dset.get_label(args.source_img)
@@ -163,25 +226,16 @@ def main():
     
     with torch.no_grad():
         S = []
-        source_features = backbone(source_img.unsqueeze(0).cuda())[0]
-        distractor_features = backbone(distractor_img.unsqueeze(0).cuda())[0]
+        source_features = backbone(source_img.unsqueeze(0).to(device))[0]
+        distractor_features = backbone(distractor_img.unsqueeze(0).to(device))[0]
         source_features = source_features.view(-1, args.feature_dims[1] * args.feature_dims[2])
         distractor_features = distractor_features.view(-1, args.feature_dims[1] * args.feature_dims[2])
 
-        sm = nn.Softmax()
-        max_loops = source_features.shape[1]**2
-        for _ in range(max_loops):
-            edit, conf = get_next_edit(source_features, distractor_features, args.distractor_lbl, classifier, S)
-            print(edit)
-            S.append(edit)
-            #out = model.predict(source_features.unsqueeze(0))[0]
-            source_features[:, edit[0]] = distractor_features[:, edit[1]]
-            out = classifier(source_features.view(-1).unsqueeze(0))[0]
-            conf = sm(out)
-            if conf[args.distractor_lbl] == max(conf): break
+        S, conf, source_features = cve_search(source_features, distractor_features, args.distractor_lbl, classifier, beam_width=args.beam_width)
+        print(S)
         
         print(f"Number of edits: {len(S)}")
-        print(f"Confidence: {conf[args.distractor_lbl]}")
+        print(f"Confidence: {conf}")
         visualize_feature(
             backbone,
             classifier,
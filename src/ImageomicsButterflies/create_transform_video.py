@@ -1,8 +1,11 @@
+import os
 from argparse import ArgumentParser
 
 import imageio
 import numpy as np
 
+from trajectory_store import load_trajectory
+
 def get_args():
     parser = ArgumentParser()
     parser.add_argument("--projections", type=str, default="styleGAN/results/img_to_img/random_default_z/aglaope_M/projections.npz")
@@ -13,7 +16,9 @@ def get_args():
     return args
 
 def load_projections(path):
-    return np.transpose(np.load(path)['projections'], axes=[0, 1, 3, 4, 2])
+    # Accepts either projections.npz or a chunked trajectory directory
+    name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    return load_trajectory(os.path.dirname(os.path.normpath(path)), name=name, channels_last=True)
 
 def create_video(frames, out_dest):
     video = imageio.get_writer(out_dest, mode='I', fps=30, codec='libx264')
@@ -23,7 +28,8 @@ def create_video(frames, out_dest):
 if __name__ == "__main__":
     args = get_args()
     projections = load_projections(args.projections)
-    frames = projections[:, args.img_idx]
+    # Frames are read one step at a time
+    frames = (projections[step, args.img_idx] for step in range(len(projections)))
     create_video(frames, args.out_file)
 
     
\ No newline at end of file
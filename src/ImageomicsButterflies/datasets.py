@@ -1,11 +1,30 @@
+import os
+
 from torch.utils.data import Dataset
 from data_tools import handle_image_list, handle_image_folder, rgb_img_loader
+from image_cache import ImageCache
+
+IMAGE_CACHE_DIR = "../cache/images"
+
+# Passing cache_resolution serves images from a pre-resized uint8 cache
+# (see image_cache.py) instead of decoding them on every __getitem__.
+
+def filter_view(paths, labels, view):
+    keep = [i for i, path in enumerate(paths) if path.split(os.path.sep)[-1].split(".")[0].split("_")[1] == view]
+    return [paths[i] for i in keep], [labels[i] for i in keep]
 
 class ImageList(Dataset):
-    def __init__(self, image_list, transform=None):
+    def __init__(self, image_list, transform=None, view=None, cache_resolution=None, cache_dir=IMAGE_CACHE_DIR):
         self.paths, self.labels, self.path_label_map = handle_image_list(image_list)
+        if view is not None:
+            self.paths, self.labels = filter_view(self.paths, self.labels, view)
+            self.path_label_map = dict(zip(self.paths, self.labels))
         self.transform = transform
         self.loader = rgb_img_loader
+        self.cache = None
+        if cache_resolution is not None:
+            root = image_list if type(image_list) is str else ""
+            self.cache = ImageCache.load_or_build(root, self.paths, self.labels, cache_resolution, cache_dir=cache_dir, extra=view, loader=self.loader)
 
     def get_label(self, path):
         if path not in self.path_label_map:
@@ -26,7 +45,12 @@ class ImageList(Dataset):
     def __getitem__(self, index):
         path = self.paths[index]
         lbl = self.labels[index]
-        img = self.load_img(path)
+        if self.cache is not None:
+            img = self.cache[index]
+            if self.transform is not None:
+                img = self.transform(img)
+        else:
+            img = self.load_img(path)
 
         return img, lbl, path
 
@@ -35,10 +59,13 @@ class ImageList(Dataset):
 
 
 class ImageFolder(Dataset):
-    def __init__(self, img_dir, transform=None):
+    def __init__(self, img_dir, transform=None, cache_resolution=None, cache_dir=IMAGE_CACHE_DIR):
         self.paths, self.labels, self.path_label_map, self.class_names = handle_image_folder(img_dir)
         self.transform = transform
         self.loader = rgb_img_loader
+        self.cache = None
+        if cache_resolution is not None:
+            self.cache = ImageCache.load_or_build(img_dir, self.paths, self.labels, cache_resolution, cache_dir=cache_dir, loader=self.loader)
 
     def get_label(self, path):
         if path not in self.path_label_map:
@@ -62,9 +89,14 @@ class ImageFolder(Dataset):
     def __getitem__(self, index):
         path = self.paths[index]
         lbl = self.labels[index]
-        img = self.load_img(path)
+        if self.cache is not None:
+            img = self.cache[index]
+            if self.transform is not None:
+                img = self.transform(img)
+        else:
+            img = self.load_img(path)
 
         return img, lbl, path
 
     def __len__(self):
-        return len(self.paths)
\ No newline at end of file
+        return len(self.paths)
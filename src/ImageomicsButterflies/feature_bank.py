@@ -0,0 +1,207 @@
+import os
+import json
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from image_cache import cache_key
+from w_stats import network_hash
+
+# Persistent backbone feature bank. The pooled backbone features (and, if
+# asked for, the compute_z activations) of a dataset are extracted once per
+# (backbone checkpoint, dataset, subset) and stored as float16 .npy files that
+# are opened as read-only memory maps, next to the paths and labels.
+# NeighborIndex answers top-k cosine / L2 queries over a bank with blocked
+# matmuls, optionally restricted to the closest IVF lists.
+
+FEATURE_BANK_DIR = "../cache/feature_banks"
+META_FILE = "meta.json"
+
+def extract(backbone, dataset, compute_z=False, batch_size=64, workers=4, out=None):
+    """
+    Runs backbone over dataset in order. Rows are written into out
+    ({"features" : array, "z" : array}) when given, otherwise returned as
+    float32 arrays.
+    """
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers)
+    device = next(backbone.parameters()).device
+    backbone.eval()
+    rows = {"features" : [], "z" : []}
+    start = 0
+    with torch.no_grad():
+        for imgs, _, _ in tqdm(dataloader, desc="Extracting Features", position=0, ncols=50, leave=False):
+            outs = backbone(imgs.to(device), compute_z=True) if compute_z else (backbone(imgs.to(device)),)
+            for name, x in zip(["features", "z"], outs):
+                x = x.view(len(imgs), -1).cpu().numpy()
+                if out is not None:
+                    out[name][start:start+len(imgs)] = x
+                else:
+                    rows[name].append(x)
+            start += len(imgs)
+    if out is not None:
+        return out
+    return {name : np.concatenate(x) for name, x in rows.items() if len(x)}
+
+class FeatureBank:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.paths = self.meta["paths"]
+        self.labels = np.array(self.meta["labels"], dtype=np.int64)
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r')
+        return self.arrays[name]
+
+    @property
+    def features(self):
+        return self.get("features")
+
+    @property
+    def z(self):
+        return self.get("z")
+
+    def select(self, labels=None, view=None):
+        # Row indices with one of labels and the given view
+        keep = np.ones(len(self), dtype=bool)
+        if labels is not None:
+            keep &= np.isin(self.labels, labels)
+        if view is not None:
+            keep &= np.array([path.split(os.path.sep)[-1].split("_")[1] == view for path in self.paths])
+        return np.nonzero(keep)[0]
+
+    @staticmethod
+    def build(path, backbone, dataset, compute_z=False, batch_size=64, workers=4):
+        os.makedirs(path, exist_ok=True)
+        img, _, _ = dataset[0]
+        device = next(backbone.parameters()).device
+        with torch.no_grad():
+            outs = backbone(img.unsqueeze(0).to(device), compute_z=True) if compute_z else (backbone(img.unsqueeze(0).to(device)),)
+        names = ["features", "z"][:len(outs)]
+
+        tmp_paths = {name : os.path.join(path, f"{name}.{os.getpid()}.tmp.npy") for name in names}
+        out = {name : np.lib.format.open_memmap(tmp_paths[name], mode='w+', dtype=np.float16, shape=(len(dataset), x[0].numel())) for name, x in zip(names, outs)}
+        extract(backbone, dataset, compute_z=compute_z, batch_size=batch_size, workers=workers, out=out)
+        for name in names:
+            out[name].flush()
+        del out
+        # Moved in place whole, meta is written last and marks the bank as complete
+        for name in names:
+            os.replace(tmp_paths[name], os.path.join(path, f"{name}.npy"))
+
+        items = dataset.indices if isinstance(dataset, Subset) else range(len(dataset))
+        base = dataset.dataset if isinstance(dataset, Subset) else dataset
+        tmp_path = os.path.join(path, f"{META_FILE}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"paths" : [base.paths[i] for i in items], "labels" : [int(base.labels[i]) for i in items], "arrays" : names}, f)
+        os.replace(tmp_path, os.path.join(path, META_FILE))
+        return FeatureBank(path)
+
+    @staticmethod
+    def load_or_build(backbone, checkpoint, dataset, root="", indices=None, compute_z=False, extra=None, \
+                      cache_dir=FEATURE_BANK_DIR, batch_size=64, workers=4):
+        """
+        checkpoint: the backbone weights file, part of the cache key.
+        indices: optional subset of the dataset rows to store.
+        extra: anything else that changes the features (e.g. the transform).
+        """
+        if indices is not None:
+            dataset = Subset(dataset, list(indices))
+        items = dataset.indices if isinstance(dataset, Subset) else range(len(dataset))
+        base = dataset.dataset if isinstance(dataset, Subset) else dataset
+        paths = [base.paths[i] for i in items]
+        ckpt = network_hash(checkpoint)[:16] if checkpoint is not None else None
+        path = os.path.join(cache_dir, cache_key(root, None, paths, extra=[ckpt, compute_z, extra]))
+        if os.path.exists(os.path.join(path, META_FILE)):
+            return FeatureBank(path)
+        print(f"Extracting features of {len(paths)} images into {path}...")
+        return FeatureBank.build(path, backbone, dataset, compute_z=compute_z, batch_size=batch_size, workers=workers)
+
+class NeighborIndex:
+    def __init__(self, vectors, metric="cosine", block_size=8192, nlist=None, nprobe=8, device=None, kmeans_iters=10):
+        """
+        vectors: [N, D] (e.g. a bank memmap or a subset of it).
+        nlist: when given, rows are split into nlist k-means lists (IVF) and a
+        query only scans its nprobe closest lists.
+        """
+        assert metric in ["cosine", "l2"], f"Invalid metric: {metric}"
+        self.metric = metric
+        self.block_size = block_size
+        self.device = device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu")
+        self.vectors = torch.as_tensor(np.asarray(vectors, dtype=np.float32), device=self.device)
+        if metric == "cosine":
+            self.vectors = torch.nn.functional.normalize(self.vectors, dim=1)
+        self.sq_norms = (self.vectors ** 2).sum(1)
+        self.nprobe = nprobe
+        self.lists = None
+        if nlist is not None and nlist < len(self.vectors):
+            self.train_ivf(nlist, kmeans_iters)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def train_ivf(self, nlist, iters):
+        g = torch.Generator(device="cpu").manual_seed(0)
+        self.centroids = self.vectors[torch.randperm(len(self.vectors), generator=g)[:nlist].to(self.device)].clone()
+        for _ in range(iters):
+            assign = self.exact(self.vectors, self.centroids, 1)[1][:, 0]
+            sums = torch.zeros_like(self.centroids).index_add_(0, assign, self.vectors)
+            counts = torch.bincount(assign, minlength=nlist).unsqueeze(1)
+            self.centroids = torch.where(counts > 0, sums / counts.clamp(min=1), self.centroids)
+        assign = self.exact(self.vectors, self.centroids, 1)[1][:, 0]
+        self.lists = [torch.nonzero(assign == i)[:, 0] for i in range(nlist)]
+
+    def scores(self, queries, vectors, sq_norms=None):
+        # Larger is closer: cosine similarity, or negative squared L2 distance
+        sims = queries @ vectors.T
+        if self.metric == "cosine":
+            return sims
+        if sq_norms is None:
+            sq_norms = (vectors ** 2).sum(1)
+        return 2 * sims - sq_norms.unsqueeze(0) - (queries ** 2).sum(1, keepdim=True)
+
+    def exact(self, queries, vectors, k, sq_norms=None):
+        k = min(k, len(vectors))
+        best_vals, best_idx = None, None
+        for start in range(0, len(vectors), self.block_size):
+            block = vectors[start:start+self.block_size]
+            block_norms = sq_norms[start:start+self.block_size] if sq_norms is not None else None
+            vals, idx = self.scores(queries, block, block_norms).topk(min(k, len(block)), dim=1)
+            idx = idx + start
+            if best_vals is not None:
+                vals, order = torch.cat((best_vals, vals), 1).topk(k, dim=1)
+                idx = torch.cat((best_idx, idx), 1).gather(1, order)
+            best_vals, best_idx = vals, idx
+        return best_vals, best_idx
+
+    def search(self, queries, k=1):
+        """
+        Returns (scores, indices), each [Q, k], closest first. Scores are cosine
+        similarities, or L2 distances for metric="l2".
+        """
+        queries = torch.as_tensor(np.asarray(queries, dtype=np.float32), device=self.device).view(-1, self.vectors.shape[1])
+        if self.metric == "cosine":
+            queries = torch.nn.functional.normalize(queries, dim=1)
+        if self.lists is None:
+            vals, idx = self.exact(queries, self.vectors, k, self.sq_norms)
+        else:
+            probes = self.exact(queries, self.centroids, self.nprobe)[1]
+            vals, idx = [], []
+            for q, query in enumerate(queries):
+                candidates = torch.cat([self.lists[i] for i in probes[q].tolist()])
+                q_vals, q_idx = self.exact(query.unsqueeze(0), self.vectors[candidates], k, self.sq_norms[candidates])
+                vals.append(q_vals[0])
+                idx.append(candidates[q_idx[0]])
+            k = min(len(v) for v in vals)
+            vals, idx = torch.stack([v[:k] for v in vals]), torch.stack([i[:k] for i in idx])
+        if self.metric == "l2":
+            vals = (-vals).clamp(min=0).sqrt()
+        return vals.cpu().numpy(), idx.cpu().numpy()
@@ -13,6 +13,9 @@ from models import Encoder
 from helpers import set_random_seed, cuda_setup
 from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
 from project import project
+from ganspace_pca import pca
+from w_stats import load_w_stats
+from traversal_renderer import TraversalRenderer, to_strip, write_video
 
 def get_args():
     parser = ArgumentParser()
@@ -21,6 +24,8 @@ def get_args():
     parser.add_argument('--samples', type=int, default=10000)
     parser.add_argument('--mode', type=str, default='filtered', choices=['filtered', 'original', 'original_nohybrid'])
     parser.add_argument('--sub', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--video', action='store_true', default=False, help="Also save the class mean interpolations as videos")
 
     args = parser.parse_args()
     args.gpu_ids = ",".join(map(lambda x: str(x), args.gpu_ids))
@@ -57,23 +62,9 @@ def get_args():
 
     return args
 
-def sample_w_global_mean(samples, G):
-    print(f'Computing {args.samples} W samples...')
-    z_samples = np.random.RandomState(123).randn(args.samples, G.z_dim)
-    w_samples = G.mapping(torch.from_numpy(z_samples).cuda(), None)  # [N, L, C]
-    w_samples = w_samples[:, 0, :].cpu().numpy().astype(np.float32)       # [N, 1, C]
-    w_avg = np.mean(w_samples, axis=0, keepdims=False)
-    return w_avg, w_samples
-
-def pca(data, dim=2):
-    data = np.array(data)
-    mu = data.mean(0)
-    center = data - mu
-    cov = (1/len(data))*(center.T @ center)
-    eig_val, eig_vec = np.linalg.eig(cov)
-    W = eig_vec[:dim]
-
-    return (data - mu) @ W.T, W, mu, eig_vec, eig_val
+def sample_w_global_mean(args, G):
+    stats = load_w_stats(G, args.network, samples=args.samples)
+    return stats["w_avg"], stats
 
 def tsne(data, dim=2):
     data = np.array(data)
@@ -83,16 +74,8 @@ def tsne(data, dim=2):
 
 
 def pca_analysis(args, G):
-    print(f'Computing {args.samples} W samples...')
-    z_samples = np.random.RandomState(123).randn(args.samples, G.z_dim)
-    w_samples = G.mapping(torch.from_numpy(z_samples).cuda(), None)  # [N, L, C]
-    w_samples = w_samples[:, 0, :].cpu().numpy().astype(np.float32)       # [N, 1, C]
-    w_avg = np.mean(w_samples, axis=0, keepdims=False)      # [1, 1, C]
-
-    w_center = w_samples - w_avg
-    w_covariance = (1/args.samples)*(w_center.T @ w_center)
-
-    eig_val, eig_vec = np.linalg.eig(w_covariance)
+    stats = load_w_stats(G, args.network, samples=args.samples)
+    eig_val = stats["eig_val"]
     eig_val_total = eig_val.sum()
 
     accum = 0
@@ -119,7 +102,7 @@ def visualize(data, labels, outdir, name='pca'):
     plt.close()
 
 def create_image(G, w):
-    w_input = torch.from_numpy(np.tile(w, (1, G.num_ws, 1))).cuda()
+    w_input = torch.from_numpy(np.tile(w, (1, G.num_ws, 1))).to(next(G.parameters()).device)
     synth_image = G.synthesis(w_input, noise_mode='const')[0]
     synth_image = (synth_image + 1) * (1/2)
     synth_image = synth_image.clamp(0, 1)
@@ -127,72 +110,35 @@ def create_image(G, w):
     
     return np.transpose(out_image, axes=(1, 2, 0))
 
-def move_along_top_vectors(G, w, w_star, eig_vec, eig_val, outdir, name="base"):
-    for i in range(10):
-        save_img = None
-        for alpha in range(-10, 11, 1):
-            w_move = w + eig_vec[i]*alpha
-            img = create_image(G, w_move)
-            if save_img is None:
-                save_img = img
-            else:
-                save_img = np.concatenate((save_img, img), axis=1)
-        Image.fromarray(save_img).save(os.path.join(outdir, f"{name}_w_vec_{i}.png"))    
-    
-    for i in range(10):
-        save_img = None
-        for alpha in range(-10, 11, 1):
-            w_move = w_star + eig_vec[i]*alpha
-            img = create_image(G, w_move)
-            if save_img is None:
-                save_img = img
-            else:
-                save_img = np.concatenate((save_img, img), axis=1)
-        Image.fromarray(save_img).save(os.path.join(outdir, f"{name}_w_star_vec_{i}.png"))    
-
-def move_along_class_vectors(G, w, w_star, class_vectors, star_class_vectors, names, outdir):
+def move_along_top_vectors(renderer, w, w_star, eig_vec, eig_val, outdir, name="base"):
+    alphas = list(range(-10, 11, 1))
+    traversals = [(w, eig_vec[i], alphas) for i in range(10)] + [(w_star, eig_vec[i], alphas) for i in range(10)]
+    paths = [os.path.join(outdir, f"{name}_w_vec_{i}.png") for i in range(10)] + \
+            [os.path.join(outdir, f"{name}_w_star_vec_{i}.png") for i in range(10)]
+    renderer.save_strips(traversals, paths)
+
+def move_along_class_vectors(renderer, w, w_star, class_vectors, star_class_vectors, names, outdir):
+    alphas = [0 if alpha == 0 else alpha / 10 for alpha in range(-10, 11, 1)]
+    traversals = []
+    paths = []
     for i, class_vec in enumerate(class_vectors):
-        save_img = None
-        save_img_star = None
-        for alpha in range(-10, 11, 1):
-            if alpha == 0:
-                move = 0
-            else:
-                move = alpha / 10
-            w_move = w + class_vectors[i]*move
-            w_star_move = w_star + star_class_vectors[i]*move
-            img = create_image(G, w_move)
-            img_star = create_image(G, w_star_move)
-            if save_img is None:
-                save_img = img
-            else:
-                save_img = np.concatenate((save_img, img), axis=1)
-            if save_img_star is None:
-                save_img_star = img_star
-            else:
-                save_img_star = np.concatenate((save_img_star, img_star), axis=1)
-        Image.fromarray(save_img).save(os.path.join(outdir, f"class_w_{names[i]}.png"))    
-        Image.fromarray(save_img_star).save(os.path.join(outdir, f"class_w_star_{names[i]}.png"))    
-
-def move_between_class_means(G, class_means, names, outdir):
+        traversals.extend([(w, class_vectors[i], alphas), (w_star, star_class_vectors[i], alphas)])
+        paths.extend([os.path.join(outdir, f"class_w_{names[i]}.png"), os.path.join(outdir, f"class_w_star_{names[i]}.png")])
+    renderer.save_strips(traversals, paths)
+
+def move_between_class_means(renderer, class_means, names, outdir, video=False):
+    alphas = [0 if alpha == 0 else alpha / 100 for alpha in range(0, 101, 1)]
+    traversals = []
+    paths = []
     for name_A, mean_A in zip(names, class_means):
         for name_B, mean_B in zip(names, class_means):
             if name_A == name_B: continue
-            vec = mean_B - mean_A
-
-            save_img = None
-            for alpha in range(0, 101, 1):
-                if alpha == 0:
-                    move = 0
-                else:
-                    move = alpha / 100
-                w_move = mean_A + vec*move
-                img = create_image(G, w_move)
-                if save_img is None:
-                    save_img = img
-                else:
-                    save_img = np.concatenate((save_img, img), axis=1)
-            Image.fromarray(save_img).save(os.path.join(outdir, f"{name_A}_to_{name_B}.png"))
+            traversals.append((mean_A, mean_B - mean_A, alphas))
+            paths.append(os.path.join(outdir, f"{name_A}_to_{name_B}"))
+    for frames, path in zip(renderer.iter_traversals(traversals), paths):
+        Image.fromarray(to_strip(frames)).save(f"{path}.png")
+        if video:
+            write_video(frames, f"{path}.mp4")
 
 
 def get_class_vectors(class_means, w, w_star):
@@ -289,7 +235,7 @@ if __name__ == "__main__":
         class_means.append(filtered_data.mean(0))
         class_lbls.append(i)
 
-    z, W, mu, eig_vec, eig_val = pca(latents)
+    z, W, mu, eig_vec, eig_val = pca(latents, dim=2)
     #z = tsne(latents)
     if not args.sub:
         visualize(z, labels, args.outdir, name='pca')
@@ -298,10 +244,9 @@ if __name__ == "__main__":
 
     # Load Models
     G, _, _, _ = load_models(args.network, f_path=None, c_path=None)
-    G = G.cuda()
-    
+    renderer = TraversalRenderer(G, args.network, batch_size=args.batch_size)
 
-    w_global_mean, sample_ws = sample_w_global_mean(args.samples, G)
+    w_global_mean, w_stats = sample_w_global_mean(args, G)
 
     global_mean_img = create_image(G, w_global_mean)
     Image.fromarray(global_mean_img).save(os.path.join(args.outdir, "w_global_mean_img.png"))
@@ -310,22 +255,22 @@ if __name__ == "__main__":
 
     # If we want to move along directions from ganspace
     if False:
-        _, _, _, eig_vec, eig_val = pca(sample_ws)
-    move_along_top_vectors(G, w_global_mean, w_star_global_mean, eig_vec, eig_val, args.outdir)
+        eig_vec, eig_val = w_stats["eig_vec"], w_stats["eig_val"]
+    move_along_top_vectors(renderer, w_global_mean, w_star_global_mean, eig_vec, eig_val, args.outdir)
 
     z = (np.array(class_means) - mu) @ W.T
     visualize_means(z, class_lbls, (w_global_mean - mu) @ W.T, args.outdir, name='pca_means')
 
     class_vectors, star_class_vectors = get_class_vectors(class_means, w_global_mean, w_star_global_mean)
-    move_along_class_vectors(G, w_global_mean, w_star_global_mean, class_vectors, star_class_vectors, unique_subspecies, args.outdir)
-    move_between_class_means(G, class_means, unique_subspecies, args.outdir)
+    move_along_class_vectors(renderer, w_global_mean, w_star_global_mean, class_vectors, star_class_vectors, unique_subspecies, args.outdir)
+    move_between_class_means(renderer, class_means, unique_subspecies, args.outdir, video=args.video)
 
     class_centered_ws, star_class_centered_ws = center_classes(latents, labels, class_lbls, class_vectors, star_class_vectors)
 
-    z, W, mu, eig_vec, eig_val = pca(class_centered_ws)
-    move_along_top_vectors(G, w_global_mean, w_star_global_mean, eig_vec, eig_val, args.outdir, "w_class_centered")
-    z, W, mu, eig_vec, eig_val = pca(star_class_centered_ws)
-    move_along_top_vectors(G, w_global_mean, w_star_global_mean, eig_vec, eig_val, args.outdir, "w_star_class_centered")
+    z, W, mu, eig_vec, eig_val = pca(class_centered_ws, dim=2)
+    move_along_top_vectors(renderer, w_global_mean, w_star_global_mean, eig_vec, eig_val, args.outdir, "w_class_centered")
+    z, W, mu, eig_vec, eig_val = pca(star_class_centered_ws, dim=2)
+    move_along_top_vectors(renderer, w_global_mean, w_star_global_mean, eig_vec, eig_val, args.outdir, "w_star_class_centered")
     
 
     if True:
@@ -11,11 +11,11 @@ from PIL import Image, ImageDraw
 from torchvision import transforms
 
 from models import Encoder
-from helpers import set_random_seed, cuda_setup
+from helpers import set_random_seed, cuda_setup, get_device
 from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
-from data_tools import NORMALIZE
 from project import project
 from superpixel import superpixel
+from scoring_model import get_scoring_model, scores
 
 def get_args():
     parser = ArgumentParser()
@@ -170,7 +170,7 @@ def create_images(G, w, no_repeat=False):
     if no_repeat:
         w_input = w
     else:
-        w_input = w.unsqueeze(1).repeat((1, G.num_ws, 1)).cuda()
+        w_input = w.unsqueeze(1).repeat((1, G.num_ws, 1))
     synth_images = G.synthesis(w_input, noise_mode='const')
     synth_images = (synth_images + 1) * (1/2)
     synth_images = synth_images.clamp(0, 1)
@@ -182,6 +182,16 @@ def to_numpy_img(img):
 def to_tensor_img(img):
     return torch.tensor(np.transpose(img.astype(np.float32) / 255, axes=(2, 0, 1))).to(torch.float)
 
+def target_confs(scorer, np_imgs, lbl, batch_size=64):
+    # Target confidence of every uint8 [H, W, 3] image, scored in batches
+    device = next(scorer.parameters()).device
+    confs = []
+    with torch.no_grad():
+        for i in range(0, len(np_imgs), batch_size):
+            imgs = torch.stack([to_tensor_img(img) for img in np_imgs[i:i+batch_size]]).to(device)
+            confs.append(scores(scorer, imgs, lbl)[2].cpu())
+    return torch.cat(confs).numpy() if len(confs) else np.zeros(0, dtype=np.float32)
+
 def save_image(img, path):
     np_img = to_numpy_img(img[0])
     Image.fromarray(np_img).save(path)
@@ -218,16 +228,6 @@ def get_diff_img(a, b):
     return diff_img
 
 
-def pca(data):
-    data = np.array(data)
-    mu = data.mean(0)
-    center = data - mu
-    cov = (1/len(data))*(center.T @ center)
-    eig_val, eig_vec = np.linalg.eig(cov)
-    W = np.copy(eig_vec)
-
-    return (data - mu) @ W.T, W, mu, eig_vec, eig_val
-
 def add_text(img, text=""):
     TEXT_HEIGHT = 20
     PAD = 4
@@ -269,15 +269,16 @@ if __name__ == "__main__":
     src_w = np.array(src_ws_list).mean(0)
     tgt_w = np.array(tgt_ws_list).mean(0)
 
-    G, _, F, C = load_models(args.network, args.backbone, args.classifier, args.num_classes)
-    change_v = torch.tensor(tgt_w - src_w).unsqueeze(0).repeat((G.num_ws, 1)).cuda() # [w_dim]
-    src_w = torch.tensor(np.array(src_ws_list)[:args.batch_size]).cuda() #[batch x w_dim]
+    device = get_device()
+    G, _, F, C = load_models(args.network, args.backbone, args.classifier, args.num_classes, device=device)
+    change_v = torch.tensor(tgt_w - src_w).unsqueeze(0).repeat((G.num_ws, 1)).to(device) # [w_dim]
+    src_w = torch.tensor(np.array(src_ws_list)[:args.batch_size]).to(device) #[batch x w_dim]
     if args.start == 'end':
-        cf = torch.ones((args.num_cf, src_w.shape[-1])).unsqueeze(1).repeat((1, G.num_ws, 1)).cuda().requires_grad_()
+        cf = torch.ones((args.num_cf, src_w.shape[-1])).unsqueeze(1).repeat((1, G.num_ws, 1)).to(device).requires_grad_()
     elif args.start == 'begin':
-        cf = (torch.zeros((args.num_cf, src_w.shape[-1]))).unsqueeze(1).repeat((1, G.num_ws, 1)).cuda().requires_grad_()
+        cf = (torch.zeros((args.num_cf, src_w.shape[-1]))).unsqueeze(1).repeat((1, G.num_ws, 1)).to(device).requires_grad_()
     elif args.start == 'rand':
-        cf = torch.rand((args.num_cf, src_w.shape[-1])).unsqueeze(1).repeat((1, G.num_ws, 1)).cuda().requires_grad_()
+        cf = torch.rand((args.num_cf, src_w.shape[-1])).unsqueeze(1).repeat((1, G.num_ws, 1)).to(device).requires_grad_()
 
 
     """
@@ -295,16 +296,14 @@ if __name__ == "__main__":
     #src_proj_ten = torch.tensor(np.transpose(src_proj / 255, axes=(2, 0, 1))).unsqueeze(0).cuda()
     #src_w = torch.tensor(src_w).unsqueeze(0).cuda()
     #src_z = torch.tensor(src_z).unsqueeze(0).cuda()
-    tgt_lbl = torch.tensor([sub_lbl_map[args.tgt_sub]]).cuda()
-    src_lbl = torch.tensor([sub_lbl_map[args.src_sub]]).cuda()
+    tgt_lbl = torch.tensor([sub_lbl_map[args.tgt_sub]], device=device)
+    src_lbl = torch.tensor([sub_lbl_map[args.src_sub]], device=device)
     #cf = torch.zeros((1, LEARNABLE_WS, src_w.shape[-1])).cuda().requires_grad_()
     #cf_z = torch.zeros_like(src_z).cuda().requires_grad_()
 
-    G.cuda()
-    F.cuda()
-    C.cuda()
     F.eval()
     C.eval()
+    scorer = get_scoring_model(F, C)
 
     with torch.no_grad():
         src_proj_ten = create_images(G, src_w, no_repeat=False).unsqueeze(1).repeat((1, args.num_cf, 1, 1, 1))
@@ -312,13 +311,13 @@ if __name__ == "__main__":
 
     CLAMP_MIN = 1e-3
     sm = nn.Softmax(dim=1)
-    CELoss = nn.CrossEntropyLoss(reduction='sum').cuda()
-    sigmoid = nn.Sigmoid().cuda()
+    CELoss = nn.CrossEntropyLoss(reduction='sum')
+    sigmoid = nn.Sigmoid()
     loss_fn = None
     if args.loss_fn == "l2":
-        loss_fn = nn.MSELoss().cuda()
+        loss_fn = nn.MSELoss()
     elif args.loss_fn == "l1":
-        loss_fn = nn.L1Loss().cuda()
+        loss_fn = nn.L1Loss()
     elif args.loss_fn == "entropy":
         def calc_loss(x, tmp):
             #out = sm(torch.clamp(x, 0, 1))
@@ -381,8 +380,7 @@ if __name__ == "__main__":
         #img_diff_loss = (sigmoid(img_diff) - 0.5).sum(1).mean()
 
         # class loss
-        out = C(F(NORMALIZE(img)))
-        all_probs = sm(out) 
+        out, all_probs, _ = scores(scorer, img)
         prob_src = all_probs[0][src_lbl.item()].item()
         prob_tgt = all_probs[0][tgt_lbl.item()].item()
         loss = CELoss(out, tgt_lbl.repeat(args.num_cf*args.batch_size))
@@ -398,7 +396,7 @@ if __name__ == "__main__":
         #d_out = D(img, c=1)
         #d_loss = torch.nn.functional.softplus(-d_out).cuda()
 
-        div_loss = torch.tensor(0.0).cuda()
+        div_loss = torch.tensor(0.0, device=device)
         use_img_diff = False
         #div_matrix = sigmoid(cf * 1000)
         div_matrix = sigmoid(cf.view(len(cf), -1))
@@ -481,17 +479,21 @@ if __name__ == "__main__":
                                 for sp_lbl in best_pixels:
                                     mask = chosen_sp.astype(np.uint8) == sp_lbl
                                     tmp_start[mask] = tgt_img_np[mask]
+                                # Every remaining superpixel swap is scored in one batch
+                                cand_lbls, cand_imgs = [], []
                                 for sp_lbl in range(np.max(chosen_sp)+1):
                                     if sp_lbl in best_pixels: continue
                                     mask = chosen_sp.astype(np.uint8) == sp_lbl
                                     tmp = np.copy(tmp_start)
                                     tmp[mask] = tgt_img_np[mask]
                                     if np.sum(tmp) <= 0.0: continue
-                                    tmp = to_tensor_img(tmp)
-                                    conf = sm(C(F(NORMALIZE(tmp.unsqueeze(0).cuda()))))[0, tgt_lbl.item()].item()
-                                    if conf > best[1]:
-                                        best[0] = sp_lbl
-                                        best[1] = conf
+                                    cand_lbls.append(sp_lbl)
+                                    cand_imgs.append(tmp)
+                                cand_confs = target_confs(scorer, cand_imgs, tgt_lbl.item())
+                                # First candidate with the highest confidence, if any is above 0
+                                if len(cand_confs) and cand_confs.max() > best[1]:
+                                    best[0] = cand_lbls[int(np.argmax(cand_confs))]
+                                    best[1] = float(cand_confs.max())
                                 print(f"{sp_i}: {best[1]}")
                                 if best[1] < total_conf:
                                     break
@@ -512,16 +514,21 @@ if __name__ == "__main__":
                             mask = chosen_sp.astype(np.uint8) == sp_lbl
                             result_img[mask] = tgt_img_np[mask]
                         
+                        conf = float(target_confs(scorer, [result_img], tgt_lbl.item())[0])
                         result_img = to_tensor_img(result_img)
-                        conf = sm(C(F(NORMALIZE(result_img.unsqueeze(0).cuda()))))[0, tgt_lbl.item()].item()
                         result_np = to_numpy_img(result_img)
                         result_diff_img = get_diff_img(src_proj, result_np).astype(np.float)
-                        for sp_lbl, conf_v in zip(best_pixels, sp_confs):
+                        # Confidence with each chosen superpixel reverted, in one batch
+                        reverted = []
+                        for sp_lbl in best_pixels[:len(sp_confs)]:
                             mask = chosen_sp.astype(np.uint8) == sp_lbl
                             tmp = np.copy(result_np)
                             tmp[mask] = src_proj[mask]
-                            tmp = to_tensor_img(tmp)
-                            conf_v = sm(C(F(NORMALIZE(tmp.unsqueeze(0).cuda()))))[0, tgt_lbl.item()].item()
+                            reverted.append(tmp)
+                        reverted_confs = target_confs(scorer, reverted, tgt_lbl.item())
+                        for sp_lbl, conf_v in zip(best_pixels, reverted_confs):
+                            mask = chosen_sp.astype(np.uint8) == sp_lbl
+                            conf_v = float(conf_v)
                             print(conf, conf_v)
                             conf_diff = conf - conf_v
                             result_diff_img[mask] = (np.ones_like(result_diff_img[mask])*255 * (max(0, conf_diff)))
@@ -140,11 +140,12 @@ def analyze(subspecies, pixel_losses, perceptual_losses, outdir, type="train", t
 
 def encode_and_gen(images, E, G):
     gen_imgs = []
+    device = next(G.parameters()).device
     for img in images:
         images = encoder_transform()(Image.fromarray(img))
-        start_ws = E(images.unsqueeze(0).cuda())
+        start_ws = E(images.unsqueeze(0).to(device))
         start_ws = start_ws.view(1, G.num_ws, -1)[:, 0, :]
-        gen_input = start_ws.unsqueeze(1).clone().repeat([1, G.mapping.num_ws, 1]).cuda()
+        gen_input = start_ws.unsqueeze(1).clone().repeat([1, G.mapping.num_ws, 1]).to(device)
         synth_images = G.synthesis(gen_input, noise_mode='const')
         synth_images = (synth_images + 1) * (1/2)
         synth_images = synth_images.clamp(0, 1)
@@ -152,25 +153,25 @@ def encode_and_gen(images, E, G):
         gen_imgs.append(np.transpose(gen_img, axes=[1, 2, 0]))
     return gen_imgs
 
-def parent_guess(F, C, org_imgs, encode_imgs, opt_imgs):
-    top_5_data = []
-    sm = nn.Softmax(dim=1).cuda()
-    for org, enc, opt in zip(org_imgs, encode_imgs, opt_imgs):
-        data = []
-        out = C(F(image_transform()(Image.fromarray(org)).unsqueeze(0).cuda()))
-        probs = sm(out)
-        vals, idx = torch.topk(probs[0], 5)
-        data.append([vals.detach().cpu().numpy(), idx.detach().cpu().numpy()])
-        out = C(F(image_transform()(Image.fromarray(enc)).unsqueeze(0).cuda()))
-        probs = sm(out)
-        vals, idx = torch.topk(probs[0], 5)
-        data.append([vals.detach().cpu().numpy(), idx.detach().cpu().numpy()])
-        out = C(F(image_transform()(Image.fromarray(opt)).unsqueeze(0).cuda()))
-        probs = sm(out)
-        vals, idx = torch.topk(probs[0], 5)
-        data.append([vals.detach().cpu().numpy(), idx.detach().cpu().numpy()])
-        top_5_data.append(data)
+def parent_guess(F, C, org_imgs, encode_imgs, opt_imgs, batch_size=64):
+    # Top 5 of the original, encoded and optimized version of every image, classified in batches
+    transform = image_transform()
+    imgs = [img for triple in zip(org_imgs, encode_imgs, opt_imgs) for img in triple]
+    sm = nn.Softmax(dim=1)
+    device = next(F.parameters()).device
+    vals, idx = [], []
+    with torch.no_grad():
+        for start in range(0, len(imgs), batch_size):
+            batch = torch.stack([transform(Image.fromarray(img)) for img in imgs[start:start+batch_size]]).to(device)
+            batch_vals, batch_idx = torch.topk(sm(C(F(batch))), 5, dim=1)
+            vals.append(batch_vals.cpu().numpy())
+            idx.append(batch_idx.cpu().numpy())
+    vals = np.concatenate(vals) if len(vals) else np.zeros((0, 5))
+    idx = np.concatenate(idx) if len(idx) else np.zeros((0, 5), dtype=np.int64)
 
+    top_5_data = []
+    for i in range(0, len(imgs), 3):
+        top_5_data.append([[vals[j], idx[j]] for j in range(i, i + 3)])
     return top_5_data
 
 def get_map(dset_root):
@@ -264,16 +265,13 @@ if __name__ == "__main__":
     # Load models
     G, _, F, C = load_models(args.network, f_path=args.backbone, c_path=args.classifier)
     E = load_e4e_standalone(args.encoder)
-    G = G.cuda()
-    E = E.cuda()
+    E = E.to(next(G.parameters()).device)
 
     # Get encoder ws
     gen_imgs = encode_and_gen(originals, E, G)
 
     G = None
     E = None
-    C = C.cuda()
-    F = F.cuda()
 
     top_5_data = parent_guess(F, C, originals, gen_imgs, projections)
 
@@ -0,0 +1,163 @@
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+
+# PCA for GANSpace style analysis of w latents.
+#   exact       - symmetric eigendecomposition (eigh) of the covariance
+#   randomized  - top-k subspace iteration, never decomposes the full matrix
+# Data can be given all at once (fit) or streamed in minibatches / files
+# (partial_fit, fit_files); the streamed path only keeps the running mean
+# and scatter matrix in memory.
+#
+# Components are rows of components_, sorted by decreasing explained variance.
+
+def eigh_sorted(cov, n_components=None):
+    eig_val, eig_vec = np.linalg.eigh(cov)
+    order = np.argsort(eig_val)[::-1][:n_components]
+    return eig_val[order], eig_vec[:, order].T
+
+def randomized_eigh(cov, n_components, oversample=10, n_iter=4, seed=0):
+    rs = np.random.RandomState(seed)
+    k = min(n_components + oversample, len(cov))
+    Q, _ = np.linalg.qr(cov @ rs.randn(len(cov), k))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(cov @ Q)
+    eig_val, eig_vec = np.linalg.eigh(Q.T @ cov @ Q)
+    order = np.argsort(eig_val)[::-1][:n_components]
+    return eig_val[order], (Q @ eig_vec[:, order]).T
+
+def randomized_svd_components(center, n_components, oversample=10, n_iter=4, seed=0):
+    # Works on the centered data directly, so the d x d covariance is never built
+    rs = np.random.RandomState(seed)
+    k = min(n_components + oversample, *center.shape)
+    Q, _ = np.linalg.qr(center @ rs.randn(center.shape[1], k))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(center.T @ Q)
+        Q, _ = np.linalg.qr(center @ Q)
+    _, s, Vt = np.linalg.svd(Q.T @ center, full_matrices=False)
+    return (s[:n_components] ** 2) / len(center), Vt[:n_components]
+
+def flip_signs(components):
+    # Deterministic orientation: the largest entry of every component is positive
+    signs = np.sign(components[np.arange(len(components)), np.abs(components).argmax(1)])
+    signs[signs == 0] = 1
+    return components * signs[:, np.newaxis]
+
+class PCA:
+    def __init__(self, n_components=None, method='exact', oversample=10, n_iter=4, seed=0):
+        assert method in ['exact', 'randomized'], f"Invalid PCA method: {method}"
+        assert method == 'exact' or n_components is not None, "Randomized PCA needs n_components"
+        self.n_components = n_components
+        self.method = method
+        self.oversample = oversample
+        self.n_iter = n_iter
+        self.seed = seed
+
+        self.n_samples_ = 0
+        self.mean_ = None
+        self.scatter_ = None
+        self.components_ = None
+        self.explained_variance_ = None
+        self.explained_variance_ratio_ = None
+
+    @property
+    def covariance_(self):
+        return self.scatter_ / self.n_samples_
+
+    def fit(self, data):
+        data = np.asarray(data, dtype=np.float64).reshape(len(data), -1)
+        self.n_samples_ = len(data)
+        self.mean_ = data.mean(0)
+        center = data - self.mean_
+        if self.method == 'randomized':
+            self.scatter_ = None
+            eig_val, components = randomized_svd_components(center, self.n_components, self.oversample, self.n_iter, self.seed)
+            total_var = (center ** 2).sum() / len(center)
+            self.set_components(eig_val, components, total_var)
+        else:
+            self.scatter_ = center.T @ center
+            self.finalize()
+        return self
+
+    def partial_fit(self, batch):
+        batch = np.asarray(batch, dtype=np.float64).reshape(len(batch), -1)
+        count = len(batch)
+        if count == 0:
+            return self
+        if self.mean_ is None:
+            self.mean_ = np.zeros(batch.shape[1])
+            self.scatter_ = np.zeros((batch.shape[1], batch.shape[1]))
+
+        # Merge the batch mean and scatter matrix into the running totals (Chan et al.)
+        batch_mean = batch.mean(0)
+        center = batch - batch_mean
+        delta = batch_mean - self.mean_
+        total = self.n_samples_ + count
+        self.mean_ += delta * (count / total)
+        self.scatter_ += center.T @ center + np.outer(delta, delta) * (self.n_samples_ * count / total)
+        self.n_samples_ = total
+        self.components_ = None
+        return self
+
+    def fit_files(self, paths, key='ws', batch_size=4096):
+        for path in paths:
+            data = np.load(path, mmap_mode='r') if path.endswith('.npy') else np.load(path)[key]
+            for start in range(0, len(data), batch_size):
+                self.partial_fit(data[start:start+batch_size])
+        return self.finalize()
+
+    def finalize(self):
+        cov = self.covariance_
+        if self.method == 'randomized':
+            eig_val, components = randomized_eigh(cov, self.n_components, self.oversample, self.n_iter, self.seed)
+        else:
+            eig_val, components = eigh_sorted(cov, self.n_components)
+        self.set_components(eig_val, components, np.trace(cov))
+        return self
+
+    def set_components(self, eig_val, components, total_var):
+        self.explained_variance_ = np.clip(eig_val, 0, None)
+        self.explained_variance_ratio_ = self.explained_variance_ / total_var
+        self.components_ = flip_signs(components)
+
+    def transform(self, data, dim=None):
+        data = np.asarray(data, dtype=np.float64).reshape(len(data), -1)
+        return (data - self.mean_) @ self.components_[:dim].T
+
+    def inverse_transform(self, z):
+        z = np.asarray(z, dtype=np.float64)
+        return z @ self.components_[:z.shape[-1]] + self.mean_
+
+    def components_for_variance(self, percent=0.99):
+        return int(np.searchsorted(np.cumsum(self.explained_variance_ratio_), percent) + 1)
+
+def pca(data, dim=None, method='exact'):
+    # Drop in for the old per-script helpers: (projected, W, mu, eig_vec, eig_val)
+    model = PCA(n_components=dim if method == 'randomized' else None, method=method).fit(data)
+    W = model.components_[:dim]
+    return model.transform(data, dim), W, model.mean_, model.components_, model.explained_variance_
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument('--latents', type=str, nargs='+', required=True, help='npz (or npy) files of projected ws')
+    parser.add_argument('--key', type=str, default='ws')
+    parser.add_argument('--components', type=int, default=None)
+    parser.add_argument('--method', type=str, default='exact', choices=['exact', 'randomized'])
+    parser.add_argument('--batch_size', type=int, default=4096)
+    parser.add_argument('--out', type=str, default='../output/ganspace_pca.npz')
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    model = PCA(n_components=args.components, method=args.method).fit_files(args.latents, key=args.key, batch_size=args.batch_size)
+    print(f"Fit {model.n_samples_} latents from {len(args.latents)} files")
+    print(f"Top {model.components_for_variance(0.99)} components explain 99% of the variance")
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    np.savez(args.out,
+        mean=model.mean_,
+        components=model.components_,
+        explained_variance=model.explained_variance_,
+        explained_variance_ratio=model.explained_variance_ratio_
+    )
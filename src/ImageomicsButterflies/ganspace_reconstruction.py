@@ -4,7 +4,6 @@ from time import perf_counter
 from tqdm import tqdm
 
 import torch
-import torch.nn as nn
 import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image
@@ -12,10 +11,12 @@ from torchvision import transforms
 
 from models import Encoder
 from encoder4editing.utils.model_utils import load_e4e_standalone
-from helpers import set_random_seed, cuda_setup
-from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
-from data_tools import NORMALIZE, test_image_transform
-from project import project
+from helpers import set_random_seed, cuda_setup, get_device
+from loading_helpers import save_json, load_json, load_img, load_models, LazyImages
+from batch_project import project_batch
+from candidate_bank import CandidateBank
+from w_stats import load_w_stats
+from shard_runner import run_shards, default_devices
 
 def encoder_transform():
     return transforms.Compose([
@@ -29,12 +30,18 @@ def get_args():
     parser.add_argument("--seed", type=int, default=303)
     parser.add_argument('--samples', type=int, default=10000)
     parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--candidates', type=int, default=100, help='random w candidates used when there is no encoder')
+    parser.add_argument('--patience', type=int, default=25, help='stop an image after this many steps without improvement (0 = off)')
+    parser.add_argument('--min_delta', type=float, default=1e-4)
     parser.add_argument('--hybrid', action='store_true', default=False)
     parser.add_argument('--mode', type=str, default='filtered', choices=['afhqv2', 'filtered', 'filtered_cond', 'filtered_cond_v2', 'original', 'original_nohybrid'])
     parser.add_argument('--sub', type=str, default=None)
     parser.add_argument('--verbose', action='store_true', default=False)
     parser.add_argument('--limit', type=int, default=0)
     parser.add_argument('--phase', type=str, default='both', choices=['both', 'train', 'test'])
+    parser.add_argument('--workers', type=int, default=1, help='reconstruction processes, one per gpu (cycled) or cpu workers without a gpu')
+    parser.add_argument('--shard_size', type=int, default=256, help='images per resumable shard')
 
     args = parser.parse_args()
 
@@ -87,35 +94,12 @@ def get_args():
     args.gpu_ids = ",".join(map(lambda x: str(x), args.gpu_ids))
     return args
 
-def sample_w_global_mean(samples, G):
-    print(f'Computing {args.samples} W samples...')
-    z_samples = np.random.RandomState(123).randn(args.samples, G.z_dim)
-    w_samples = G.mapping(torch.from_numpy(z_samples).cuda(), None)  # [N, L, C]
-    w_samples = w_samples[:, 0, :].cpu().numpy().astype(np.float32)       # [N, 1, C]
-    w_avg = np.mean(w_samples, axis=0, keepdims=False)
-    return w_avg
-
-def pca(data, dim=2):
-    data = np.array(data)
-    mu = data.mean(0)
-    center = data - mu
-    cov = (1/len(data))*(center.T @ center)
-    eig_val, eig_vec = np.linalg.eig(cov)
-    W = eig_vec[:dim]
-
-    return data @ W.T
+def sample_w_global_mean(args, G):
+    return load_w_stats(G, args.network, samples=args.samples)["w_avg"]
 
 def pca_analysis(args, G):
-    print(f'Computing {args.samples} W samples...')
-    z_samples = np.random.RandomState(123).randn(args.samples, G.z_dim)
-    w_samples = G.mapping(torch.from_numpy(z_samples).cuda(), None)  # [N, L, C]
-    w_samples = w_samples[:, 0, :].cpu().numpy().astype(np.float32)       # [N, 1, C]
-    w_avg = np.mean(w_samples, axis=0, keepdims=False)      # [1, 1, C]
-
-    w_center = w_samples - w_avg
-    w_covariance = (1/args.samples)*(w_center.T @ w_center)
-
-    eig_val, eig_vec = np.linalg.eig(w_covariance)
+    stats = load_w_stats(G, args.network, samples=args.samples)
+    eig_val = stats["eig_val"]
     eig_val_total = eig_val.sum()
 
     accum = 0
@@ -132,45 +116,22 @@ def get_images(G, w):
     synth_images = synth_images.clamp(0, 1)
     return synth_images
 
-def calc_percep_loss(F, img1, img2):
-    feat1 = F(img1)
-    feat2 = F(img2)
-    MSELoss = nn.MSELoss().cuda()
-    return MSELoss(feat1, feat2).item()
-
-def initialize_w(G, path, E, F, num_samples=100, E_type='e4e', is_butterfly=True):
-    IMG_SIZE = 256 if is_butterfly else 512
-    if E is not None:
-        if E_type == 'e4e':
-            target_pil = Image.open(path).convert('RGB') # (res, res, # channels)
-            images = encoder_transform()(target_pil)
-            start_ws = E(images.unsqueeze(0).cuda())
-            start_ws = start_ws.view(1, G.num_ws, -1)[:, 0, :]
-        elif E_type == 'simple':
-            pass
-    else:
-        images = load_imgs(path, view="D")
-        projected_zs = np.random.RandomState(123).randn(num_samples, G.z_dim)
-        projected_zs = torch.from_numpy(projected_zs).cuda()
-        projected_zs = projected_zs.repeat([len(images), 1])
-        projected_ws = G.mapping(projected_zs, None)[:, :1, :]  # [N, L, C]
-        start_ws = []
-        for i in range(len(images)):
-            img = images[i]
-            ws = projected_ws[:, i, :]
-            best_w = None
-            best_loss = 100000
-            for w in ws:
-                w_in = w.repeat([1, G.mapping.num_ws, 1])
-                synth_image = get_images(G, w_in)
-                loss = calc_percep_loss(F, NORMALIZE(synth_image), test_image_transform(resize_size=IMG_SIZE)(img).unsqueeze(0))
-                if loss < best_loss:
-                    best_loss = loss
-                    best_w = w
-            start_ws.append(w.detach().cpu().numpy())
-        start_ws = torch.from_numpy(np.array(start_ws)).cuda()
-    return start_ws
-    #start_zs, start_ws = load_latents(G, None, batch_size=len(images))
+def initialize_ws(G, paths, E, F, bank=None, E_type='e4e', is_butterfly=True, batch_size=32):
+    IMG_SIZE = 128 if is_butterfly else 512
+    start_ws = []
+    for i in tqdm(range(0, len(paths), batch_size), desc="Initializing Latents", ncols=100):
+        batch_paths = paths[i:i+batch_size]
+        with torch.no_grad():
+            if E is not None and E_type == 'e4e':
+                images = torch.stack([encoder_transform()(Image.open(path).convert('RGB')) for path in batch_paths])
+                ws = E(images.to(next(G.parameters()).device))
+                ws = ws.view(len(images), G.num_ws, -1)[:, 0, :]
+            else:
+                # Best candidate from the bank for every target at once
+                images = torch.stack([load_img(path, resolution=IMG_SIZE) for path in batch_paths])
+                ws, _ = bank.best_ws(F, images)
+        start_ws.append(ws)
+    return torch.cat(start_ws)
 
 def visualize(data, labels):
     for i in range(max(labels)+1):
@@ -178,31 +139,6 @@ def visualize(data, labels):
         plt.scatter(dps[:, 0], dps[:, 1], label=i)
     plt.savefig("pca.png")
 
-def reconstruct(path, lbl, E, G, F, steps=5, E_type='e4e', verbose=False, is_butterfly=True):
-    IMG_SIZE = 128 if is_butterfly else 512
-    start_ws = initialize_w(G, path, E, F, E_type=E_type, is_butterfly=is_butterfly)
-    in_images = load_imgs(path, view="D", resolution=IMG_SIZE)
-    w_out, _, all_synth_images, pixel_losses, perceptual_losses, _, _ = project(
-        in_images,
-        G,
-        None,
-        F,
-        None,
-        lbl,
-        learn_param                = 'w',
-        start_zs                   = None,
-        start_ws                   = start_ws,
-        num_steps                  = steps,
-        init_lr                    = 0.001,
-        img_to_img                 = True,
-        batch                      = True,
-        verbose                    = verbose,
-        use_default_feat_extractor = False,
-        multi_w                    = False #E_type == 'e4e'
-    )
-    
-    return w_out[-1], all_synth_images[-1], pixel_losses[-1], perceptual_losses[-1]
-
 def load_data(dset_path, sub_filter=None, is_butterfly=True):
     paths = []
     labels = []
@@ -242,6 +178,101 @@ def load_encoder(path):
     E = load_e4e_standalone(path)
     return E
 
+# Reconstruction is split into shards of paths (see shard_runner). Finished
+# shards are kept in {outdir}/{save_lbl}_shards, so a rerun resumes where the
+# last one stopped, and are merged into the usual output files at the end.
+# Every worker process loads its own models once from the setup below.
+
+def reconstruction_setup(args, is_butterfly=True):
+    # Everything a worker needs, picklable
+    return {
+        "network" : args.network,
+        "backbone" : args.backbone,
+        "encoder" : args.encoder,
+        "encoder_type" : args.encoder_type,
+        "bank_path" : os.path.join(args.outdir, f"candidate_bank_{args.candidates}.npz") if args.encoder is None else None,
+        "candidates" : args.candidates,
+        "is_butterfly" : is_butterfly,
+        "batch_size" : args.batch_size,
+        "steps" : args.steps,
+        "patience" : args.patience,
+        "min_delta" : args.min_delta,
+        "verbose" : args.verbose
+    }
+
+def load_reconstruction_models(device, setup):
+    E = None
+    if setup["encoder"] is not None:
+        E = load_encoder(setup["encoder"]).to(device)
+
+    G, _, F, _ = load_models(setup["network"], f_path=setup["backbone"], c_path=None, device=device)
+
+    # Random w candidates are only needed without an encoder, and are shared by every split
+    bank = None
+    if E is None:
+        bank = CandidateBank.load_or_build(setup["bank_path"], G, F, num_samples=setup["candidates"], network=setup["network"])
+    return {"G" : G, "E" : E, "F" : F, "bank" : bank, "setup" : setup}
+
+def build_candidate_bank(device, setup):
+    # Builds (or checks) the bank with models that are freed right after, so
+    # the workers load only the bank file next to their own G and F
+    G, _, F, _ = load_models(setup["network"], f_path=setup["backbone"], c_path=None, device=device)
+    CandidateBank.load_or_build(setup["bank_path"], G, F, num_samples=setup["candidates"], network=setup["network"])
+    del G, F
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+def reconstruct_shard(models, paths):
+    setup = models["setup"]
+    IMG_SIZE = 128 if setup["is_butterfly"] else 512
+    start_ws = initialize_ws(models["G"], paths, models["E"], models["F"], bank=models["bank"], E_type=setup["encoder_type"], is_butterfly=setup["is_butterfly"])
+
+    # All images of the shard are projected together, batch_size at a time
+    results = project_batch(
+        models["G"],
+        models["F"],
+        None,
+        start_ws,
+        images                     = LazyImages(paths, resolution=IMG_SIZE),
+        batch_size                 = setup["batch_size"],
+        num_steps                  = setup["steps"],
+        init_lr                    = 0.001,
+        patience                   = setup["patience"],
+        min_delta                  = setup["min_delta"],
+        verbose                    = setup["verbose"]
+    )
+    return {
+        "ws" : results["ws"],
+        "projections" : results["images"],
+        "pixel" : np.array(list(map(lambda x: x[-1], results["pixel_losses"]))),
+        "perceptual" : np.array(list(map(lambda x: x[-1], results["perceptual_losses"]))),
+        "steps" : results["steps"]
+    }
+
+def do_reconstruction(paths, labels, args, save_lbl="train", limit=0, is_butterfly=True):
+    if limit > 0:
+        lbl_count = {}
+        kept = []
+        for path, lbl in zip(paths, labels):
+            if lbl not in lbl_count:
+                lbl_count[lbl] = 0
+            if lbl_count[lbl] >= limit: continue
+            lbl_count[lbl] += 1
+            kept.append([path, lbl])
+        paths = list(map(lambda x: x[0], kept))
+        labels = list(map(lambda x: x[1], kept))
+
+    setup = reconstruction_setup(args, is_butterfly=is_butterfly)
+    # Settings that change the results, shards of other settings are not reused
+    extra = {k : setup[k] for k in ["network", "backbone", "encoder", "candidates", "steps", "patience", "min_delta"]}
+    results = run_shards(paths, f'{args.outdir}/{save_lbl}_shards', load_reconstruction_models, reconstruct_shard,
+                         shard_size=args.shard_size, devices=default_devices(args.workers), init_args=(setup,), extra=extra)
+
+    save_json(paths, f'{args.outdir}/{save_lbl}_paths.json')
+    np.savez(f'{args.outdir}/{save_lbl}_ws.npz', ws=results["ws"])
+    np.savez(f'{args.outdir}/{save_lbl}_projections.npz', projections=results["projections"][:, np.newaxis])
+    np.savez(f'{args.outdir}/{save_lbl}_losses.npz', pixel=results["pixel"], perceptual=results["perceptual"], steps=results["steps"])
+
 if __name__ == "__main__":
     # Setup
     args = get_args()
@@ -249,52 +280,15 @@ if __name__ == "__main__":
     cuda_setup(args.gpu_ids)
     os.makedirs(args.outdir, exist_ok=True)
 
-    #is_butterfly = not (args.mode in ['afhqv2'])
-    #paths, labels = load_data(args.dataset_root_train, sub_filter=args.sub, is_butterfly=is_butterfly)
-
-
-    # Load autoencoder
-    if args.encoder is not None:
-        E = load_encoder(args.encoder)
-    else:
-        E = None
-
-    # Load Generator
-    G, _, F, _ = load_models(args.network, f_path=args.backbone, c_path=None)
-    G = G.cuda()
-
-
-    def do_reconstruction(paths, labels, args, save_lbl="train", verbose=False, limit=0, is_butterfly=True):
-        results = []
-        lbl_count = {}
-        for path, lbl in tqdm(zip(paths, labels), desc=f"Reconstructing {save_lbl} Images", ncols=100):
-            if limit > 0:
-                if lbl not in lbl_count:
-                    lbl_count[lbl] = 0
-                if lbl_count[lbl] >= limit: continue
-                lbl_count[lbl] += 1
-            w, synth_img, pix_loss, percep_loss = reconstruct(path, lbl, E, G, F, steps=args.steps, E_type=args.encoder_type, verbose=verbose, is_butterfly=is_butterfly)
-            w = w[0].numpy()
-            results.append([path, w, synth_img, pix_loss, percep_loss])
-
-        paths = list(map(lambda x: x[0], results))
-        save_json(paths, f'{args.outdir}/{save_lbl}_paths.json')
-
-        ws = np.array(list(map(lambda x: x[1], results)))
-        np.savez(f'{args.outdir}/{save_lbl}_ws.npz', ws=ws)
-
-        projections = np.array(list(map(lambda x: x[2], results)))
-        np.savez(f'{args.outdir}/{save_lbl}_projections.npz', projections=projections)
-
-        pixel_losses = np.array(list(map(lambda x: x[3], results)))
-        perceptual_losses = np.array(list(map(lambda x: x[4], results)))
-        np.savez(f'{args.outdir}/{save_lbl}_losses.npz', pixel=pixel_losses, perceptual=perceptual_losses)
+    is_butterfly = not (args.mode in ['afhqv2'])
 
+    # The candidate bank is built once here, before the workers start, so they only load it
+    if args.encoder is None:
+        build_candidate_bank(get_device(), reconstruction_setup(args, is_butterfly=is_butterfly))
 
-    is_butterfly = not (args.mode in ['afhqv2'])
     if args.hybrid and args.sub is None:
         paths, labels = load_data("../datasets/hybrids")
-        do_reconstruction(paths, labels, args, save_lbl="hybrids", verbose=args.verbose, is_butterfly=is_butterfly)
+        do_reconstruction(paths, labels, args, save_lbl="hybrids", is_butterfly=is_butterfly)
 
     # Load Data
     if args.phase in ['both', 'train']:
@@ -302,7 +296,7 @@ if __name__ == "__main__":
         save_lbl = "train"
         if args.sub:
             save_lbl += f"_{args.sub}"
-        do_reconstruction(paths, labels, args, save_lbl=save_lbl, verbose=args.verbose, limit=args.limit, is_butterfly=is_butterfly)
+        do_reconstruction(paths, labels, args, save_lbl=save_lbl, limit=args.limit, is_butterfly=is_butterfly)
 
     # Load Data
     if args.phase in ['both', 'test']:
@@ -310,13 +304,4 @@ if __name__ == "__main__":
         save_lbl = "test"
         if args.sub:
             save_lbl += f"_{args.sub}"
-        do_reconstruction(paths, labels, args, save_lbl=save_lbl, verbose=args.verbose, limit=args.limit, is_butterfly=is_butterfly)
-
-
-
-    
-
-
-
-
-    
\ No newline at end of file
+        do_reconstruction(paths, labels, args, save_lbl=save_lbl, limit=args.limit, is_butterfly=is_butterfly)
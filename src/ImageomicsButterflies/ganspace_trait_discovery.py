@@ -14,6 +14,8 @@ from models import Encoder
 from helpers import set_random_seed, cuda_setup
 from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
 from project import project
+from w_stats import load_w_stats
+from traversal_renderer import TraversalRenderer
 
 def get_args():
     parser = ArgumentParser()
@@ -86,40 +88,20 @@ def get_label_map(data_path):
 
     return subspecies_to_lbl
 
-def get_pinciple_components(G):
-    SAMPLES = 10000
-    print(f'Computing {SAMPLES} W samples...')
-    z_samples = np.random.RandomState(123).randn(SAMPLES, G.z_dim)
-    w_samples = G.mapping(torch.from_numpy(z_samples).cuda(), None)  # [N, L, C]
-    w_samples = w_samples[:, 0, :].cpu().numpy().astype(np.float32)       # [N, 1, C]
-    w_avg = np.mean(w_samples, axis=0, keepdims=False)      # [1, 1, C]
+def get_pinciple_components(G, network_path):
+    stats = load_w_stats(G, network_path, samples=10000)
+    return stats["eig_vec"], stats["eig_val"], stats["w_avg"]
 
-    w_center = w_samples - w_avg
-    w_covariance = (1/SAMPLES)*(w_center.T @ w_center)
-
-    eig_val, eig_vec = np.linalg.eig(w_covariance)
-    
-    return eig_vec, eig_val, w_avg
-
-def create_images(G, w):
-    w_input = torch.from_numpy(np.tile(w, (1, G.num_ws, 1))).cuda()
-    synth_images = G.synthesis(w_input, noise_mode='const')
-    synth_images = (synth_images + 1) * (1/2)
-    synth_images = synth_images.clamp(0, 1)
-    return synth_images
-    #out_image = (synth_image * 255).detach().cpu().numpy().astype(np.uint8)
-    
-    #return np.transpose(out_image, axes=(1, 2, 0))
+def to_classifier_input(frames, device):
+    # [N, H, W, 3] uint8 frames -> [N, 3, H, W] images in [0, 1] on device
+    return torch.from_numpy(frames).to(device).permute(0, 3, 1, 2).float() / 255
 
 def classifier_preprocess(img):
     NORMALIZE = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                   std=[0.229, 0.224, 0.225])
     return NORMALIZE(img)
 
-def save_img(org, proj, synth):
-    out_image = (synth * 255).detach().cpu().numpy().astype(np.uint8)
-    out_image = np.transpose(out_image, axes=(1, 2, 0))
-
+def save_img(org, proj, out_image):
     final = np.concatenate((org, proj, out_image), axis=1)
     Image.fromarray(final).save("pc_img.png")
 
@@ -136,47 +118,43 @@ if __name__ == "__main__":
 
     # Load Generator
     G, _, F, C = load_models(args.network, f_path=args.backbone, c_path=args.classifier)
-    G = G.cuda()
-    F = F.cuda()
-    C = C.cuda()
 
-    pcs, _, w_mean = get_pinciple_components(G)
+    pcs, _, w_mean = get_pinciple_components(G, args.network)
 
 
     img_idx = 1
     w_add = np.zeros_like(pcs[0])
     pcs_to_save = []
     sm = nn.Softmax()
-    synth = create_images(G, ws[img_idx])
-    conf = sm(C(F(classifier_preprocess(synth)))[0])
+    renderer = TraversalRenderer(G, args.network)
+    device = next(G.parameters()).device
+    synth = to_classifier_input(renderer.synthesize(ws[img_idx][None]), device)
+    with torch.no_grad():
+        conf = sm(C(F(classifier_preprocess(synth)))[0])
 
     source_conf = conf[sub_to_lbl_map[args.subA]].item()
     target_conf = conf[sub_to_lbl_map[args.subB]].item()
     print(args.subA, source_conf)
     print(args.subB, target_conf)
+    alphas = np.array([w_pos / 10 for w_pos in range(-20, 21, 1)], dtype=np.float32)
     for pc_i, pc in enumerate(pcs):
-        best_conf = target_conf
-        s_conf = source_conf
-        best_a = 0
-        for w_pos in range(-20, 21, 1):
-            a = w_pos / 10
-            synth = create_images(G, ws[img_idx] + w_add + pc*a)
-            conf = sm(C(F(classifier_preprocess(synth)))[0])
-
-            cur_target_conf = conf[sub_to_lbl_map[args.subB]].item()
-            if cur_target_conf > best_conf:
-                best_conf = cur_target_conf
-                s_conf = conf[sub_to_lbl_map[args.subA]].item()
-                best_a = a
-
+        # Every alpha of this pc rendered as one traversal
+        frames = renderer.render([(ws[img_idx] + w_add, pc, alphas)])[0]
+        with torch.no_grad():
+            confs = nn.Softmax(dim=1)(C(F(classifier_preprocess(to_classifier_input(frames, device)))))
+
+        # First alpha with the highest target confidence, if it beats the current one
+        best_i = confs[:, sub_to_lbl_map[args.subB]].argmax().item()
+        best_conf = confs[best_i, sub_to_lbl_map[args.subB]].item()
         if best_conf > target_conf:
             target_conf = best_conf
+            s_conf = confs[best_i, sub_to_lbl_map[args.subA]].item()
             print(f"Using PC {pc_i}")
             print(args.subA, s_conf)
             print(args.subB, best_conf)
-            w_add += pc*best_a
+            w_add += pc*alphas[best_i]
             pcs_to_save.append(pc)
-            save_img(originals[img_idx], projections[img_idx], synth[0])
+            save_img(originals[img_idx], projections[img_idx], frames[best_i])
         else:
             print(f'PC {pc_i} skipped')
 
@@ -1,13 +1,58 @@
 import os
 import random
+from time import perf_counter
+from contextlib import nullcontext
 
 import torch
 import numpy as np
 import openpyxl
 
-# Set CUDA device
-def cuda_setup(gpu_ids):
+# Set CUDA device. Without a GPU everything runs on the CPU, with threads
+# intra-op threads when given.
+def cuda_setup(gpu_ids, threads=None):
     os.environ["CUDA_VISIBLE_DEVICES"] = gpu_ids
+    if not torch.cuda.is_available() or threads is not None:
+        cpu_setup(threads)
+
+def cpu_setup(threads=None):
+    # Pin the intra-op thread pool (default: all cores), one inter-op thread keeps runs predictable
+    threads = threads if threads is not None else os.cpu_count()
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass # Already set, only possible before any parallel work
+
+def get_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def prepare_model(model, device=None, channels_last=False):
+    # Moves a model to the device in eval mode, channels-last is faster for convolutions on CPU
+    model = model.to(device if device is not None else get_device()).eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+def autocast(enabled=False, device=None):
+    # bfloat16 autocast on the given device, a no-op when disabled
+    if not enabled:
+        return nullcontext()
+    device = torch.device(device if device is not None else get_device())
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+def measure_throughput(fn, batch, iters=20, warmup=3):
+    # Items per second of fn(batch)
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(batch)
+        if batch.is_cuda:
+            torch.cuda.synchronize()
+        start = perf_counter()
+        for _ in range(iters):
+            fn(batch)
+        if batch.is_cuda:
+            torch.cuda.synchronize()
+    return iters * len(batch) / (perf_counter() - start)
 
 # Set random seed
 def set_random_seed(seed):
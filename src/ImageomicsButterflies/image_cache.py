@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+from PIL import Image
+
+# Decoded image cache for datasets. Images are decoded and resized once and
+# packed with their labels into one uint8 .npy ([N, H, W, 3]) per
+# (dataset root, resolution, filter). DataLoader workers open it as a
+# read-only memory map, so they share the page cache instead of each decoding
+# and resizing every image on every epoch.
+#
+# Images are resized with the same filter as transforms.Resize (bilinear by
+# default), so a cached dataset sees the pixels the uncached one does. The
+# filter is part of the cache key.
+#
+# The source roots (ImageomicsButterflies, class_cvae,
+# butterflies_transformation/src) run as separate scripts with flat imports
+# and can't import each other, so each keeps this file. This one is the
+# reference and the copies are identical to it. The cache directory is set by
+# each root's datasets.py.
+
+META_FILE = "meta.json"
+
+def cache_key(root, resolution, paths, extra=None):
+    h = hashlib.sha1()
+    h.update(json.dumps([os.path.abspath(root), resolution, extra]).encode())
+    for path in paths:
+        h.update(path.encode())
+    return h.hexdigest()[:16]
+
+def rgb_loader(path):
+    with open(path, 'rb') as f:
+        with Image.open(f) as img:
+            return img.convert('RGB')
+
+class ImageCache:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.labels = np.load(os.path.join(path, "labels.npy"))
+        self.images = None
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def get_images(self):
+        # Mapped lazily so every worker process maps the file itself
+        if self.images is None:
+            self.images = np.load(os.path.join(self.path, "images.npy"), mmap_mode='r')
+        return self.images
+
+    def __getitem__(self, index):
+        return Image.fromarray(np.asarray(self.get_images()[index]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["images"] = None
+        return state
+
+    @staticmethod
+    def build(path, paths, labels, resolution, loader=rgb_loader, resample=Image.BILINEAR):
+        os.makedirs(path, exist_ok=True)
+        tmp_path = os.path.join(path, f"images.{os.getpid()}.tmp.npy")
+        images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(paths), resolution, resolution, 3))
+        for i, img_path in enumerate(paths):
+            img = loader(img_path).convert('RGB').resize((resolution, resolution), resample)
+            images[i] = np.asarray(img)
+        images.flush()
+        del images
+
+        # Files are moved in place whole, concurrent builders (e.g. DDP ranks) can't see partial ones
+        os.replace(tmp_path, os.path.join(path, "images.npy"))
+        tmp_path = os.path.join(path, f"labels.{os.getpid()}.tmp.npy")
+        np.save(tmp_path, np.asarray(labels, dtype=np.int64))
+        os.replace(tmp_path, os.path.join(path, "labels.npy"))
+
+        # Written last, marks the cache as complete
+        tmp_path = os.path.join(path, f"{META_FILE}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"count" : len(paths), "resolution" : resolution, "resample" : int(resample), "paths" : list(paths)}, f)
+        os.replace(tmp_path, os.path.join(path, META_FILE))
+        return ImageCache(path)
+
+    @staticmethod
+    def load_or_build(root, paths, labels, resolution, cache_dir, extra=None, loader=rgb_loader, resample=Image.BILINEAR):
+        """
+        resample: PIL filter, the one the dataset's transforms.Resize uses.
+        """
+        path = os.path.join(cache_dir, cache_key(root, resolution, paths, [extra, int(resample)]))
+        if os.path.exists(os.path.join(path, META_FILE)):
+            return ImageCache(path)
+        print(f"Caching {len(paths)} images at {resolution}x{resolution} in {path}...")
+        return ImageCache.build(path, paths, labels, resolution, loader=loader, resample=resample)
@@ -11,6 +11,8 @@ import stylegan3.dnnlib as dnnlib
 import stylegan3.legacy as legacy
 
 from models import Classifier, VGG16
+from helpers import get_device
+from w_stats import z_mean
 
 def save_json(data, path):
     with open(path, 'w') as f:
@@ -20,20 +22,6 @@ def load_json(path):
     with open(path, 'r') as f:
         return json.load(f)
 
-def load_latents(G, images, projected_ws, projected_zs, w_avg_samples=10000, use_rand_latents=False):
-    if projected_zs is not None:
-        projected_ws = G.mapping(projected_zs, None)
-    elif projected_ws is None:
-        print(f'Computing W midpoint and stddev using {w_avg_samples} samples...')
-        projected_zs = np.random.RandomState(123).randn(w_avg_samples, G.z_dim)
-        projected_zs = torch.from_numpy(projected_zs).cuda()
-        w_samples = G.mapping(projected_zs, None)  # [N, L, C]
-        w_samples = w_samples[:, :, :].cpu().numpy().astype(np.float32)       # [N, 1, C]
-        projected_ws = torch.from_numpy(np.tile(np.mean(w_samples, axis=0, keepdims=True)[0], (len(images), 1, 1))).cuda()      # [1, 1, C]
-        projected_zs = projected_zs.mean(0, keepdim=True).repeat([len(images), 1])
-
-    return projected_zs, projected_ws
-
 #----------------------------------------------------------------------------
 def load_img(img_path, resolution=128):
     target_pil = PIL.Image.open(img_path).convert('RGB') # (res, res, # channels)
@@ -46,7 +34,7 @@ def load_imgs(img_dir, view="D", max_size=64, resolution=128):
 
     if os.path.isfile(img_dir):
         img = load_img(img_dir, resolution)
-        return img.unsqueeze(0).cuda()
+        return img.unsqueeze(0).to(get_device())
     
     batch = None
     i = 0
@@ -65,36 +53,50 @@ def load_imgs(img_dir, view="D", max_size=64, resolution=128):
 
             if i >= max_size: break
             
-    batch = batch.cuda()
+    batch = batch.to(get_device())
     return batch
 #----------------------------------------------------------------------------
+class LazyImages:
+    # Loads one image per path on access so large path lists don't sit in memory
+    def __init__(self, paths, resolution=128):
+        self.paths = paths
+        self.resolution = resolution
+
+    def __getitem__(self, index):
+        return load_img(self.paths[index], self.resolution)
+
+    def __len__(self):
+        return len(self.paths)
+#----------------------------------------------------------------------------
 
 def load_latents(G, latent_path=None, avg_samples=10000, batch_size=1):
     projected_ws = None
     projected_zs = None
     if latent_path is None:
-        print(f'Computing W midpoint and stddev using {avg_samples} samples...')
-        projected_zs = np.random.RandomState(123).randn(avg_samples, G.z_dim)
-        projected_zs = torch.from_numpy(projected_zs).cuda()
-        projected_zs = projected_zs.mean(0, keepdim=True).repeat([batch_size, 1])
+        # w of the mean z (not the mean w from load_w_stats), the mean z is memoized
+        projected_zs = torch.from_numpy(z_mean(G.z_dim, avg_samples)).to(get_device())
+        projected_zs = projected_zs.repeat([batch_size, 1])
         projected_ws = G.mapping(projected_zs, None)[:, 0, :]  # [N, L, C]
         assert projected_zs.shape == (batch_size, G.z_dim), "Z projection shape incorrect"
-        assert projected_zs.shape == (batch_size, G.w_dim), "W projection shape incorrect"
+        assert projected_ws.shape == (batch_size, G.w_dim), "W projection shape incorrect"
         
         return projected_zs, projected_ws
 
     latents = np.load(latent_path)
     if 'z' in latents.keys():
-        projected_zs = torch.tensor(latents['z']).cuda()
+        projected_zs = torch.tensor(latents['z']).to(get_device())
     if 'w' in latents.keys():
-        projected_ws = torch.tensor(latents['w']).cuda()
+        projected_ws = torch.tensor(latents['w']).to(get_device())
 
     if projected_zs is not None:
         projected_ws = G.mapping(projected_zs, None)[:, 0, :]
         
     return projected_zs, projected_ws
 
-def load_models(gen_path=None, f_path=None, c_path=None, num_classes=27):
+def load_models(gen_path=None, f_path=None, c_path=None, num_classes=27, device=None, channels_last=False):
+    # Everything is loaded onto device (default: cuda when available, otherwise cpu)
+    device = device if device is not None else get_device()
+
     # Load networks.
     G = None
     D = None
@@ -103,27 +105,29 @@ def load_models(gen_path=None, f_path=None, c_path=None, num_classes=27):
         with dnnlib.util.open_url(gen_path) as fp:
             net = legacy.load_network_pkl(fp)
             # Generator
-            G = net['G_ema'].requires_grad_(False).cuda() # type: ignore
+            G = net['G_ema'].requires_grad_(False).to(device) # type: ignore
             G.eval()
 
             # Discriminator
-            D = net['D'].requires_grad_(False).cuda() # type: ignore
+            D = net['D'].requires_grad_(False).to(device) # type: ignore
             D.eval()
 
     # Feature Extractor
     F = None
     if f_path is not None:
-        f_weights = torch.load(f_path)
-        F = VGG16(pretrain=False).cuda()
+        f_weights = torch.load(f_path, map_location=device)
+        F = VGG16(pretrain=False).to(device)
         F.load_state_dict(f_weights)
         F.eval()
+        if channels_last:
+            F = F.to(memory_format=torch.channels_last)
 
     # Classifier
     C = None
     if c_path is not None:
-        c_weights = torch.load(c_path)
-        C = Classifier(F.in_features, num_classes).cuda()
+        c_weights = torch.load(c_path, map_location=device)
+        C = Classifier(F.in_features, num_classes).to(device)
         C.load_state_dict(c_weights)
         C.eval()
 
-    return G, D, F, C
\ No newline at end of file
+    return G, D, F, C
@@ -10,9 +10,9 @@ class TransformLoss(nn.Module):
         self.beta = beta
         self.reg_lambda = reg_lambda
         self.reg_original = reg_original
-        self.mse = nn.MSELoss(size_average=False).cuda()
-        self.cs = nn.CosineSimilarity(dim=0).cuda()
-        self.l1 = nn.L1Loss(size_average=False).cuda()
+        self.mse = nn.MSELoss(size_average=False)
+        self.cs = nn.CosineSimilarity(dim=0)
+        self.l1 = nn.L1Loss(size_average=False)
         self.eps = 1e-3
 
     def reg_loss(self, z):
@@ -24,13 +24,6 @@ def mae_transform():
         NORMALIZE
     ])
 
-def classifier_transform(crop_size=128, normalize=NORMALIZE):
-    return transforms.Compose([
-        transforms.Resize((crop_size, crop_size)),
-        transforms.ToTensor(),
-        normalize
-    ])
-
 def load_all_models(backbone, classifier, mae):
     _, _, F, C = load_models(None, backbone, classifier)
     mae_model = model = getattr(models_mae, 'mae_vit_base_patch16')()
@@ -47,11 +40,13 @@ def get_args():
     parser.add_argument('--classifier', help='classifier', type=str, default='../saved_models/vgg_classifier.pt')
     parser.add_argument('--mae', default='mae/output_dir/checkpoint-99.pth')
     parser.add_argument('--steps', type=int, default=500)
-    parser.add_argument('--img', type=str, default='../datasets/train/aglaope/10428242_D_lowres.png')
+    parser.add_argument('--img', type=str, nargs="+", default=['../datasets/train/aglaope/10428242_D_lowres.png'])
     parser.add_argument('--lbl', type=int, default=0)
     parser.add_argument('--ratio', type=float, default=0.75)
     parser.add_argument('--no_mae', action='store_true', default=False)
-    parser.add_argument('--criteria', type=str, default='dist')
+    parser.add_argument('--criteria', type=str, default='dist', choices=['conf', 'dist', 'patch_dist'])
+    parser.add_argument('--batch_size', type=int, default=64, help="Masks per forward pass")
+    parser.add_argument('--save_every', type=int, default=0, help="Also save the outputs every n masks")
     args = parser.parse_args()
 
     args.gpu_ids = ",".join(map(lambda x: str(x), args.gpu_ids))
@@ -63,95 +58,103 @@ def load_input(path):
 
 
 
-def reconstruct(input_img, mask_ids, ids_restore, mae, no_mae=False):
-    x = mae.patch_embed(input_img)
-    num_patches = x.shape[1]
-    x = x + mae.pos_embed[:, 1:, :]
-
-    x = torch.gather(x, dim=1, index=mask_ids.unsqueeze(-1).repeat(1, 1, x.shape[2]))
-    
-
-    cls_token = mae.cls_token + mae.pos_embed[:, :1, :]
-    cls_tokens = cls_token.expand(x.shape[0], -1, -1)
-    x = torch.cat((cls_tokens, x), dim=1)
-
-    # apply Transformer blocks
-    for blk in mae.blocks:
-        x = blk(x)
-    x = mae.norm(x)
-
-    rv = mae.forward_decoder(x, ids_restore)  # [N, L, p*p*3]
-    rv = mae.unpatchify(rv)
-
-    mask = torch.ones((1, num_patches)).cuda()
-    for mask_id in mask_ids[0]:
-        mask[0][mask_id.item()] = 0
-    mask = mask.detach()
-    mask = mask.unsqueeze(-1).repeat(1, 1, mae.patch_embed.patch_size[0]**2 *3)  # (N, H*W, p*p*3)
-    mask = mae.unpatchify(mask)
-    if no_mae:
-        return input_img * (1-mask)
-    rv = rv * mask + input_img * (1-mask)
-    return rv
-
 def to_pil(tensor_img):
     tensor_img = UNNORMALIZE(tensor_img)
     np_img = np.transpose(tensor_img.cpu().detach().numpy(), axes=[1, 2, 0])
     return Image.fromarray((np_img * 255).astype(np.uint8))
 
-def create_random_mask(N, L, ratio=0.75):
-    len_keep = int(L * (1 - ratio))
-    
-    noise = torch.rand(N, L, device=x.device)  # noise in [0, 1]
-    
-    # sort noise for each sample
-    ids_shuffle = torch.argsort(noise, dim=1)  # ascend: small is keep, large is remove
-    ids_restore = torch.argsort(ids_shuffle, dim=1).cuda()
-
-    # keep the first subset
-    ids_keep = ids_shuffle[:, :len_keep].cuda()
-
-    # generate the binary mask: 0 is keep, 1 is remove
-    mask = torch.ones([N, L], device=x.device).cuda()
-    mask[:, :len_keep] = 0
-    # unshuffle to get the binary mask
-    mask = torch.gather(mask, dim=1, index=ids_restore)
-    return ids_keep, mask, ids_restore
-
-def predict(F, C, img, lbl):
-    input_img = classifier_transform()(img).unsqueeze(0).cuda()
-    out = C(F(input_img))
-    sm = nn.Softmax(dim=1)
-    probs = sm(out)
-    return probs[0][lbl].item()
-
-def save_mask(vals, input_img, mae):
+def save_mask(vals, input_img, mae, path="mask.png"):
     vals[np.isnan(vals)] = 0
     vals -= vals.min()
     vals /= vals.max()
-    mask = torch.tensor(vals).unsqueeze(0).cuda()
+    mask = torch.tensor(vals).unsqueeze(0).to(input_img.device)
     mask = mask.detach()
     mask = mask.unsqueeze(-1).repeat(1, 1, mae.patch_embed.patch_size[0]**2 *3)  # (N, H*W, p*p*3)
     mask = mae.unpatchify(mask)[0]
-    clr = torch.zeros_like(mask).cuda()
+    clr = torch.zeros_like(mask)
     clr[1, :, :] = 1.0
     out = input_img * (1 - mask) + clr * mask
-    to_pil(out).save("mask.png")
+    to_pil(out).save(path)
+
+"""
+RISE style patch attribution. K random masks are reconstructed and scored per
+forward pass, all on tensors, and every score is scatter-added onto the
+patches its mask removed. A patch's importance is the mean score of the masks
+that removed it.
+"""
 
-def dist(a, b):
-    ab_dist = torch.sqrt(((a-b)**2).sum())
-    return ab_dist.item()
+def random_masks(K, L, ratio=0.75, device="cuda"):
+    # K masks, each removing a random ratio of the L patches: ids kept, ids removed, restore order
+    len_keep = int(L * (1 - ratio))
+    ids_shuffle = torch.argsort(torch.rand(K, L, device=device), dim=1)
+    ids_restore = torch.argsort(ids_shuffle, dim=1)
+    return ids_shuffle[:, :len_keep], ids_shuffle[:, len_keep:], ids_restore
+
+def reconstruct_batch(tokens, input_img, ids_keep, ids_removed, ids_restore, mae, no_mae=False):
+    # tokens: the position embedded patches of input_img, computed once per image
+    K, L = ids_restore.shape
+    mask = torch.zeros((K, L), device=tokens.device)
+    mask.scatter_(1, ids_removed, 1.0)
+    mask = mae.unpatchify(mask.unsqueeze(-1).repeat(1, 1, mae.patch_embed.patch_size[0]**2 *3))
+    if no_mae:
+        return input_img * (1-mask)
+
+    x = torch.gather(tokens.expand(K, -1, -1), dim=1, index=ids_keep.unsqueeze(-1).repeat(1, 1, tokens.shape[2]))
+    cls_token = mae.cls_token + mae.pos_embed[:, :1, :]
+    x = torch.cat((cls_token.expand(K, -1, -1), x), dim=1)
+    for blk in mae.blocks:
+        x = blk(x)
+    x = mae.norm(x)
+    rv = mae.unpatchify(mae.forward_decoder(x, ids_restore))
+    return rv * mask + input_img * (1-mask)
+
+def to_classifier_input(imgs, crop_size=128):
+    # MAE input -> classifier input (resized to crop_size), on tensors
+    imgs = UNNORMALIZE(imgs).clamp(0, 1)
+    imgs = nn.functional.interpolate(imgs, size=(crop_size, crop_size), mode='bilinear', align_corners=False, antialias=True)
+    return NORMALIZE(imgs)
+
+def get_criteria_fn(criteria, F, C, input_img, lbl, mae):
+    # Batched criteria, [K] per mask or [K, L] per patch
+    sm = nn.Softmax(dim=1)
+    if criteria == 'conf':
+        return lambda recon: sm(C(F(to_classifier_input(recon))))[:, lbl]
+    if criteria == 'dist':
+        org_feat = F(input_img)
+        return lambda recon: torch.sqrt(((F(to_classifier_input(recon)) - org_feat)**2).flatten(1).sum(1))
+    org_patches = mae.patch_embed(input_img)
+    return lambda recon: torch.sqrt(((mae.patch_embed(recon) - org_patches)**2).sum(2))
+
+def mask_attribution(input_img, criteria_fn, mae, num_masks, batch_size=64, ratio=0.75, no_mae=False, checkpoint_fn=None, save_every=0):
+    L = mae.patch_embed.num_patches
+    device = input_img.device
+    vals = torch.zeros(L, device=device)
+    counts = torch.zeros(L, device=device)
+    best_val = 0
+    best_img = None
+    with torch.no_grad():
+        tokens = mae.patch_embed(input_img) + mae.pos_embed[:, 1:, :]
+        for start in tqdm(range(0, num_masks, batch_size)):
+            K = min(batch_size, num_masks - start)
+            ids_keep, ids_removed, ids_restore = random_masks(K, L, ratio=ratio, device=device)
+            recon = reconstruct_batch(tokens, input_img, ids_keep, ids_removed, ids_restore, mae, no_mae)
+            criteria = criteria_fn(recon)
+            if criteria.dim() == 1:
+                removed_vals = criteria.unsqueeze(1).expand(-1, ids_removed.shape[1])
+            else:
+                removed_vals = torch.gather(criteria, 1, ids_removed)
+            vals.scatter_add_(0, ids_removed.flatten(), removed_vals.flatten())
+            counts.scatter_add_(0, ids_removed.flatten(), torch.ones(ids_removed.numel(), device=device))
 
-def patch_dist(org, recon, mask_ids, mae):
-    up_ids = list(set(range(mae.patch_embed.num_patches)).difference(set(mask_ids[0].detach().cpu().numpy())))
-    up_ids = torch.tensor(up_ids).unsqueeze(0).cuda()
-    org_patches = mae.patch_embed(org)
-    org_patches = torch.gather(org_patches, dim=1, index=up_ids.unsqueeze(-1).repeat(1, 1, org_patches.shape[2]))
-    recon_patches = mae.patch_embed(recon)
-    recon_patches = torch.gather(recon_patches, dim=1, index=up_ids.unsqueeze(-1).repeat(1, 1, recon_patches.shape[2]))
+            totals = removed_vals.sum(1) if criteria.dim() > 1 else criteria
+            if best_val < totals.max().item():
+                best_val = totals.max().item()
+                best_img = recon[totals.argmax()]
 
-    patch_distances = torch.sqrt(((org_patches - recon_patches)**2).sum(2))
-    return patch_distances[0].detach().cpu().numpy()
+            done = start + K
+            if checkpoint_fn is not None and save_every > 0 and done // save_every > start // save_every:
+                checkpoint_fn(vals / counts, best_img)
+    return vals / counts, best_img
 
 if __name__ == "__main__":
     # Setup
@@ -161,52 +164,24 @@ if __name__ == "__main__":
 
     # Load models
     F, C, MAE = load_all_models(args.backbone, args.classifier, args.mae)
-    MAE = MAE.cuda()
-
-    # load input
-    x = load_input(args.img).cuda()
-    tmp = x.clone().detach()
-    org_feat = F(tmp)
-    base_prob = predict(F, C, to_pil(x[0]), args.lbl)
-    print(f"Base confidence: {round(base_prob*100, 2)}%")
-
-    num_patches = MAE.patch_embed.num_patches
-    counts = np.zeros(num_patches)
-    vals = np.zeros(num_patches)
-    best_val = 0
-    for step in range(args.steps):
-        mask_ids, mask, ids_restore = create_random_mask(1, num_patches, ratio=args.ratio)
-        out = reconstruct(x, mask_ids, ids_restore, MAE, args.no_mae)
-        img = to_pil(out[0])
-        criteria = 0
-        if args.criteria == 'conf':
-            criteria = predict(F, C, img, args.lbl)
-            print(f"{step}: Mask confidence: {round(criteria*100, 2)}%")
-        elif args.criteria == 'dist':
-            criteria = dist(org_feat, F(classifier_transform()(img).unsqueeze(0).cuda()))
-            print(f"{step}: Mask dist: {criteria}")
-        elif args.criteria == 'patch_dist':
-            criteria = patch_dist(x, out, mask_ids, MAE)
-            print(f"{step}: Mask patch dist: {criteria.sum()}")
-
-        up_ids = set(range(num_patches)).difference(set(mask_ids[0].detach().cpu().numpy()))
-        for i, mask_id in enumerate(up_ids):
-            counts[mask_id] += 1
-            if args.criteria != "patch_dist":
-                vals[mask_id] += criteria
-            else:
-                vals[mask_id] += criteria[i]
-        save_mask(vals/counts, x[0], MAE)
-
-        if best_val < criteria.sum():
-            best_val = criteria.sum()
-            img.save("test.png")
-    
-
-
-    
-
-
-
-
-    
\ No newline at end of file
+    device = next(F.parameters()).device
+    MAE = MAE.to(device)
+
+    for img_path in args.img:
+        prefix = "" if len(args.img) == 1 else os.path.splitext(os.path.basename(img_path))[0] + "_"
+
+        # load input
+        x = load_input(img_path).to(device)
+        with torch.no_grad():
+            base_prob = nn.Softmax(dim=1)(C(F(to_classifier_input(x))))[0][args.lbl].item()
+        print(f"Base confidence: {round(base_prob*100, 2)}%")
+
+        def save(importance, best_img):
+            save_mask(importance.cpu().numpy(), x[0], MAE, path=f"{prefix}mask.png")
+            if best_img is not None:
+                to_pil(best_img).save(f"{prefix}test.png")
+
+        criteria_fn = get_criteria_fn(args.criteria, F, C, x, args.lbl, MAE)
+        importance, best_img = mask_attribution(x, criteria_fn, MAE, args.steps, batch_size=args.batch_size, ratio=args.ratio, \
+                                                no_mae=args.no_mae, checkpoint_fn=save, save_every=args.save_every)
+        save(importance, best_img)
@@ -2,20 +2,20 @@ import os
 import random
 from argparse import ArgumentParser
 
-from tqdm import tqdm 
-
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.manifold import TSNE
 
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 from torchvision import transforms
 
 from PIL import Image
 
 from models import Res50, VGG16, Classifier
 from loggers import Logger
+from feature_bank import FeatureBank, extract
+from helpers import get_device
 
 NORMALIZE = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                   std=[0.229, 0.224, 0.225])
@@ -107,30 +107,25 @@ def setup():
     # Set CUDA device
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
 
+DATA_PATH = "../datasets/high_res_butterfly_data_train.txt"
+BACKBONE_PATH = "../saved_models/resnet_backbone.pt"
+
 def get_dataset():
-    data_path = "../datasets/high_res_butterfly_data_train.txt"
-    dataset = ImageList(data_path, transform=test_transform())
+    dataset = ImageList(DATA_PATH, transform=test_transform())
     return dataset
 
 def load_model():
-    model = Res50(pretrain=False).cuda()
-    model.load_state_dict(torch.load("../saved_models/resnet_backbone.pt"))
+    device = get_device()
+    model = Res50(pretrain=False).to(device)
+    model.load_state_dict(torch.load(BACKBONE_PATH, map_location=device))
     return model
 
-def get_features_and_labels(dataset, model):
-    dataloader = DataLoader(dataset, batch_size=64, shuffle=False, num_workers=4)
-    model.eval()
-    all_features = []
-    all_labels = []
-    with torch.no_grad():
-        for imgs, lbls, _ in tqdm(dataloader, desc="Extracting Features", position=0, ncols=50, leave=False):
-            features = model(imgs.cuda())
-            for feat, lbl in zip(features, lbls):
-                all_features.append(feat.detach().cpu().numpy())
-                all_labels.append(lbl.item())
-    all_features = np.array(all_features)
-    all_labels = np.array(all_labels)
-    return all_features, all_labels
+def get_features_and_labels(dataset, model, checkpoint=None, root=""):
+    # With a checkpoint the features come from (and are stored in) a feature bank
+    if checkpoint is None:
+        return extract(model, dataset)["features"], np.array(dataset.labels)
+    bank = FeatureBank.load_or_build(model, checkpoint, dataset, root=root, extra="test_transform")
+    return np.asarray(bank.features, dtype=np.float32), bank.labels
 
 def tsne_reduce(features):
     return TSNE(random_state=2022, n_components=2).fit_transform(features)    
@@ -147,7 +142,7 @@ if __name__ == "__main__":
     setup()
     dataset = get_dataset()
     model = load_model()
-    features, labels = get_features_and_labels(dataset, model)
+    features, labels = get_features_and_labels(dataset, model, checkpoint=BACKBONE_PATH, root=DATA_PATH)
 
     print(f"Dataset Size:")
     print(f"{features.shape[0]} instances")
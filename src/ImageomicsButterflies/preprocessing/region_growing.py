@@ -0,0 +1,45 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Region growing background segmentation. Starting from seed pixels, a pixel
+# joins the background when its color is within thresh (euclidean RGB
+# distance) of an 8-connected neighbour already in the background. The grown
+# region is the connected component of the "similar neighbour" graph that
+# contains a seed, so it is computed with a single connected components pass
+# over that graph instead of a pixel-by-pixel flood fill.
+#
+# Masks follow the old convention: 0 = background, 1 = foreground.
+
+# Half of the 8-neighbourhood, the graph is undirected
+NEIGHBOR_OFFSETS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+def corner_seeds(h, w, top_center=False):
+    seeds = [(0, 0), (0, w-1), (h-1, w-1), (h-1, 0)]
+    if top_center:
+        seeds = [(0, w//2)] + seeds
+    return seeds
+
+def similar_neighbor_graph(img, thresh):
+    h, w = img.shape[:2]
+    img = img.reshape(h, w, -1).astype(np.int32)
+    idx = np.arange(h * w, dtype=np.int32).reshape(h, w)
+    rows = []
+    cols = []
+    for dy, dx in NEIGHBOR_OFFSETS:
+        x0, x1 = max(0, -dx), w - max(0, dx)
+        src = img[:h-dy, x0:x1]
+        dst = img[dy:, x0+dx:x1+dx]
+        close = ((src - dst) ** 2).sum(-1) < thresh ** 2
+        rows.append(idx[:h-dy, x0:x1][close])
+        cols.append(idx[dy:, x0+dx:x1+dx][close])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    return coo_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)), shape=(h * w, h * w))
+
+def region_growing(img, seeds, thresh=4):
+    h, w = img.shape[:2]
+    _, labels = connected_components(similar_neighbor_graph(img, thresh), directed=False)
+    seed_labels = labels[[row * w + col for row, col in seeds]]
+    background = np.isin(labels, seed_labels).reshape(h, w)
+    return np.logical_not(background).astype(np.uint8)
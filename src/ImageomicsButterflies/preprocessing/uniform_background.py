@@ -5,6 +5,8 @@ import cv2
 import numpy as np
 from PIL import Image
 
+from region_growing import region_growing, corner_seeds
+
 def get_args():
     parser = ArgumentParser()
     parser.add_argument("--dataset", type=str, default="/local/scratch/datasets/butterflies")
@@ -34,38 +36,7 @@ def dist(a, b):
 def region_growing_mask(path, thresh=3):
     img = np.array(Image.open(path))
     h, w = img.shape[:2]
-    visited = ["0_0", f"0_{w-1}", f"{h-1}_{w-1}", f"{h-1}_0"]
-    queue = [(0, 0, img[0, 0]), (0, w-1, img[0, w-1]), (h-1, w-1, img[h-1, w-1]), (h-1, 0, img[h-1, 0])]
-    background = np.ones_like(img[:, :, 0]).astype(np.uint8)
-    background[0,0] = 0
-    background[0,w-1] = 0
-    background[h-1,w-1] = 0
-    background[h-1,0] = 0
-    i = 0
-
-    def get_neighbor_points(row, col):
-        points = []
-        for x in [-1, 0, 1]:
-            for y in [-1, 0, 1]:
-                if x == 0 and y == 0: continue
-                points.append((max(min(row + y, img.shape[0]-1), 0), max(min(col + x, img.shape[1]-1), 0)))
-        return points
-    while len(queue) > 0:
-        i += 1
-        if i % 1000 == 0:
-            Image.fromarray(background * 255).save("in_progress_mask.png")
-        row, col, color = queue.pop(0)
-        points = get_neighbor_points(row, col)
-        for y, x in points:
-            c = img[y, x]
-            d = dist(color, c)
-            if d < thresh:
-                background[y, x] = 0
-                if f"{y}_{x}" not in visited:
-                    queue.append((y, x, c))
-                    visited.append(f"{y}_{x}")
-
-    return background
+    return region_growing(img, corner_seeds(h, w), thresh=thresh)
 
 def threshold_mask(path, thresh=5):
     img = np.array(Image.open(path))
@@ -1,3 +1,4 @@
+import os
 import copy
 
 import numpy as np
@@ -9,6 +10,9 @@ import stylegan3_org.dnnlib as dnnlib
 from superpixel import superpixel
 from PIL import Image
 
+from helpers import get_device
+from scoring_model import get_scoring_model, scores
+
 NORMALIZE = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                   std=[0.229, 0.224, 0.225])
 UNNORMALIZE = transforms.Normalize(mean=[-0.485/0.229, -0.456/0.224, -0.406/0.225],
@@ -34,9 +38,9 @@ def calc_w(G, start_zs, start_ws, learnable, learn_param="w", batch=False, multi
 
     if learn_param == "w":
         if multi_w:
-            new_param = (start_ws + expanded).cuda()
+            new_param = (start_ws + expanded).to(learnable.device)
         else:
-            new_param = (start_ws.unsqueeze(1) + expanded).cuda()
+            new_param = (start_ws.unsqueeze(1) + expanded).to(learnable.device)
             new_param = new_param.clone().repeat([1, G.mapping.num_ws, 1])
         return new_param
     
@@ -45,26 +49,36 @@ def calc_w(G, start_zs, start_ws, learnable, learn_param="w", batch=False, multi
 
     assert False, "Invalide learn_param"
 
-def load_learnable(start_zs, start_ws, learn_param="w", batch=False, multi_w=False):
+def load_learnable(start_zs, start_ws, learn_param="w", batch=False, multi_w=False, device=None):
+    device = device if device is not None else get_device()
     if learn_param == "w":
-        tmp = start_ws.unsqueeze(1).clone().detach().cuda()
+        tmp = start_ws.unsqueeze(1).clone().detach().to(device)
         if multi_w:
-            tmp = start_ws.clone().detach().cuda()
+            tmp = start_ws.clone().detach().to(device)
         if batch:
-            learnable = torch.zeros_like(tmp).cuda().requires_grad_()
+            learnable = torch.zeros_like(tmp).to(device).requires_grad_()
         else:
-            learnable = torch.zeros_like(tmp[0]).cuda().requires_grad_()
+            learnable = torch.zeros_like(tmp[0]).to(device).requires_grad_()
     elif learn_param == "z":
-        tmp = start_zs.clone().detach().cuda()
+        tmp = start_zs.clone().detach().to(device)
         if batch:
-            learnable = torch.zeros_like(tmp).cuda().requires_grad_()
+            learnable = torch.zeros_like(tmp).to(device).requires_grad_()
         else:
-            learnable = torch.zeros_like(tmp[0]).cuda().requires_grad_()
+            learnable = torch.zeros_like(tmp[0]).to(device).requires_grad_()
     else:
         assert False, "Invalide learn_param"
     
     return learnable
 
+def default_feat_extractor():
+    url = 'https://nvlabs-fi-cdn.nvidia.com/stylegan2-ada-pytorch/pretrained/metrics/vgg16.pt'
+    with dnnlib.util.open_url(url) as f:
+        vgg16 = torch.jit.load(f, map_location=get_device()).eval()
+    return lambda x: vgg16(x.clone() * 255, resize_images=False, return_lpips=True)
+
+# capture_every: copy the synthesized images to the host every capture_every
+# steps (the last step is always kept). debug_dir: dump test.png (and the
+# superpixel gradient image) there every debug_every steps.
 def project(
     images,
     G,
@@ -89,7 +103,11 @@ def project(
     smooth_beta                = 2,
     smooth_eps                 = 1e-3,
     use_superpixel             = False,
-    multi_w                    = False
+    multi_w                    = False,
+    trajectory                 = None,
+    capture_every              = 1,
+    debug_dir                  = None,
+    debug_every                = 100
 
 
 ):
@@ -102,39 +120,41 @@ def project(
 
     # =====================================================================
     # Preparing models
-    G = copy.deepcopy(G).eval().requires_grad_(False).cuda() # type: ignore
+    device = next(G.parameters()).device
+    G = copy.deepcopy(G).eval().requires_grad_(False).to(device) # type: ignore
     if D is not None:
-        D = copy.deepcopy(D).eval().requires_grad_(False).cuda() # type: ignore
+        D = copy.deepcopy(D).eval().requires_grad_(False).to(device) # type: ignore
 
     # Load VGG16 feature detector.
     feat_extractor = None
     if F is None or use_default_feat_extractor:
-        url = 'https://nvlabs-fi-cdn.nvidia.com/stylegan2-ada-pytorch/pretrained/metrics/vgg16.pt'
-        with dnnlib.util.open_url(url) as f:
-            vgg16 = torch.jit.load(f).eval().cuda()
-        feat_extractor = lambda x: vgg16(x.clone() * 255, resize_images=False, return_lpips=True)
+        feat_extractor = default_feat_extractor()
     else:
         feat_extractor = lambda x: F(NORMALIZE(x))
 
+    # C(F(NORMALIZE(.))) fused into one model, shared between calls
+    scorer = None
+    if C is not None and F is not None:
+        scorer = get_scoring_model(F, C)
+
     # =====================================================================
 
     # Features for target image. pretrained expects image to be unnormalized, but our feature extractor is already normalized.
     if images is not None:
         target_images = images.to(torch.float32)
-        target_features = feat_extractor(target_images)
+        # Constant target, no graph through F is kept around between steps
+        with torch.no_grad():
+            target_features = feat_extractor(target_images)
 
-    learnable = load_learnable(start_zs, start_ws, learn_param=learn_param, batch=(batch or img_to_img), multi_w=multi_w)
+    # The start latents are constants, a graph attached to them would have to be retained across steps
+    start_zs = start_zs.detach() if start_zs is not None else None
+    start_ws = start_ws.detach() if start_ws is not None else None
+    learnable = load_learnable(start_zs, start_ws, learn_param=learn_param, batch=(batch or img_to_img), multi_w=multi_w, device=device)
     optimizer = torch.optim.Adam([learnable], betas=(0.9, 0.999), lr=init_lr)
 
-    w_opt = calc_w(G, start_zs, start_ws, learnable, learn_param, batch=(batch or img_to_img), multi_w=multi_w)
-
-    if multi_w:
-        w_out = torch.zeros([num_steps] + [len(w_opt), start_ws.shape[1], start_ws.shape[2]], dtype=torch.float32)
-    else:
-        w_out = torch.zeros([num_steps] + [len(w_opt), start_ws.shape[1]], dtype=torch.float32)
-    z_out = None
-    if learn_param == "z":
-        z_out = torch.zeros([num_steps] + [len(w_opt), start_zs.shape[1]], dtype=torch.float32)
+    # Per step records stay on the device and are copied to the host once, after the loop
+    w_hist = []
+    z_hist = []
     all_synth_images = []
     pixel_losses = []
     perceptual_losses = []
@@ -142,11 +162,12 @@ def project(
     image_confs = []
 
     # Load loss functions
-    MSELoss = nn.MSELoss().cuda()
-    CELoss = nn.CrossEntropyLoss().cuda()
-    L1Loss = nn.L1Loss().cuda()
-    sm = nn.Softmax(dim=1).cuda()
+    MSELoss = nn.MSELoss()
+    CELoss = nn.CrossEntropyLoss()
+    L1Loss = nn.L1Loss()
 
+    if debug_dir is not None:
+        os.makedirs(debug_dir, exist_ok=True)
 
     # NOTE the last update is not saved
     for step in range(num_steps):
@@ -162,10 +183,13 @@ def project(
         #####################################################################
         # Generate images
         #####################################################################
+        # One mapping / synthesis forward per step, its graph is freed by the backward below
+        w_opt = calc_w(G, start_zs, start_ws, learnable, learn_param, batch=(batch or img_to_img), multi_w=multi_w)
         synth_images = G.synthesis(w_opt, noise_mode='const')
         synth_images = (synth_images + 1) * (1/2)
         synth_images = synth_images.clamp(0, 1)
-        Image.fromarray(np.transpose((synth_images[0] * 255).detach().cpu().numpy().astype(np.uint8), [1, 2, 0])).save("test.png")
+        if debug_dir is not None and step % debug_every == 0:
+            Image.fromarray(np.transpose((synth_images[0] * 255).detach().cpu().numpy().astype(np.uint8), [1, 2, 0])).save(os.path.join(debug_dir, "test.png"))
         if step == 0:
             start_images = synth_images.detach().clone()
             if use_superpixel:
@@ -202,36 +226,41 @@ def project(
                         if j < 3: continue
                         mask = mask_vals[j][0]
                         gradient[i][:, mask] = 0.0
-                save_img(gradient[0], "gradient_after.png")
+                if debug_dir is not None and step % debug_every == 0:
+                    save_img(gradient[0], os.path.join(debug_dir, "gradient_after.png"))
             return gradient
                     
-        grad_hook = synth_images.register_hook(img_grad_hook)
+        # Only needed for the superpixel gradient masking
+        grad_hook = None
+        if use_superpixel:
+            grad_hook = synth_images.register_hook(img_grad_hook)
         #####################################################################
 
-        all_synth_images.append(synth_images.detach().cpu().numpy())
+        # Images are copied to the host every capture_every steps (and at the last step),
+        # or streamed to disk when a trajectory writer is given
+        if trajectory is None:
+            if step % capture_every == 0 or step == num_steps - 1:
+                all_synth_images.append(synth_images.detach().cpu().numpy())
+        elif trajectory.should_record(step) or step == num_steps - 1:
+            trajectory.append(synth_images.detach().cpu().numpy(), step)
         # Save projected W for each optimization step.
         if multi_w:
-            w_out[step] = w_opt.detach().cpu().clone()
+            w_hist.append(w_opt.detach().clone())
         else:
-            w_out[step] = w_opt.detach().cpu().clone()[:, 0, :]
+            w_hist.append(w_opt.detach()[:, 0, :].clone())
         if learn_param == "z":
             if img_to_img or batch:
-                z_out[step] = learnable.detach().cpu().clone()
+                z_hist.append(learnable.detach().clone())
             else:
                 new_param = (start_zs + learnable.repeat([len(start_zs), 1]))
-                z_out[step] = new_param.detach().cpu().clone()
+                z_hist.append(new_param.detach().clone())
 
-        synth_features = feat_extractor(synth_images)
-        
         # This should only be used with a pretrained feature extractor for the classifier on butterflies
         synth_conf = 0.0
-        if C is not None and F is not None:
-            out = C(F(NORMALIZE(synth_images)))
-            conf = sm(out)
-            image_confs.append(conf.detach().cpu().numpy().tolist())
-            #print(conf[0, projection_lbl].item())
-            synth_conf = round(conf[:, projection_lbl].mean().item(), 4)*100
-            lbls = torch.tensor([projection_lbl] * len(w_opt)).cuda()
+        if scorer is not None:
+            out, conf, _ = scores(scorer, synth_images)
+            image_confs.append(conf.detach())
+            lbls = torch.tensor([projection_lbl] * len(w_opt), device=device)
             class_loss = CELoss(out, lbls)
 
         #####################################################################
@@ -242,46 +271,59 @@ def project(
         dist_loss_lambda = 0.01
         smooth_loss_lambda = 0.001
         if img_to_img:
+            # Perceptual features are only needed here, class fooling runs F once (in the scorer)
+            synth_features = feat_extractor(synth_images)
             dist = MSELoss(target_features, synth_features)
-            perceptual_losses.append(dist.item())
+            perceptual_losses.append(dist.detach())
             l1_loss = L1Loss(target_images, synth_images)
-            pixel_losses.append(l1_loss.item())
+            pixel_losses.append(l1_loss.detach())
             loss = l1_loss + dist_loss_lambda * dist
-            logprint(f'step {step+1:>4d}/{num_steps}: loss {float(loss):<5.2f} perceptual loss {float(dist):<5.2f} pixel loss {float(l1_loss):<5.2f} avg confidence: {synth_conf}%')
+            if verbose:
+                synth_conf = round(image_confs[-1][:, projection_lbl].mean().item(), 4)*100 if scorer is not None else 0.0
+                logprint(f'step {step+1:>4d}/{num_steps}: loss {float(loss):<5.2f} perceptual loss {float(dist):<5.2f} pixel loss {float(l1_loss):<5.2f} avg confidence: {synth_conf}%')
         else:
+            smooth_loss = 0.0
+            smooth_str = ""
             if no_regularizer:
                 min_loss = 0.0
-                min_losses.append(min_loss)
+                min_losses.append(torch.zeros((), device=device))
             else:
-                smooth_loss = 0.0
-                smooth_str = ""
                 if smooth_change:
                     img_diff = synth_images - start_images
                     x_diff = img_diff[:, :, :-1, :-1] - img_diff[:, :, :-1, 1:]
                     y_diff = img_diff[:, :, :-1, :-1] - img_diff[:, :, 1:, :-1]
                     sq_diff = torch.clamp(x_diff * x_diff + y_diff * y_diff, smooth_eps, 10000000)
                     smooth_loss = torch.norm(sq_diff, smooth_beta / 2.0) ** (smooth_beta / 2.0)
-                    smooth_str = f'smooth loss: {float(smooth_loss * smooth_loss_lambda):<4.2f} '
+                    if verbose:
+                        smooth_str = f'smooth loss: {float(smooth_loss * smooth_loss_lambda):<4.2f} '
                 min_loss = L1Loss(learnable, torch.zeros_like(learnable))
                 if use_entropy:
                     dim = 1 if (batch or img_to_img) else 0
-                    ent_sm = nn.Softmax(dim=dim).cuda()
+                    ent_sm = nn.Softmax(dim=dim)
                     sm_out = ent_sm(torch.abs(learnable))
                     min_loss = -(sm_out * torch.log(sm_out)).sum()
-                min_losses.append(min_loss.item())
+                min_losses.append(min_loss.detach())
             loss = class_loss * class_loss_lambda + min_loss * min_loss_lambda + smooth_loss * smooth_loss_lambda
-            logprint(f'step {step+1:>4d}/{num_steps}: loss {float(loss):<5.2f} {smooth_str}class loss {float(class_loss * class_loss_lambda):<4.2f} min loss {float(min_loss*min_loss_lambda):<5.2f} avg confidence: {synth_conf}%')
+            if verbose:
+                synth_conf = round(image_confs[-1][:, projection_lbl].mean().item(), 4)*100 if scorer is not None else 0.0
+                logprint(f'step {step+1:>4d}/{num_steps}: loss {float(loss):<5.2f} {smooth_str}class loss {float(class_loss * class_loss_lambda):<4.2f} min loss {float(min_loss*min_loss_lambda):<5.2f} avg confidence: {synth_conf}%')
         #####################################################################
 
         # Step
         optimizer.zero_grad(set_to_none=True)
-        loss.backward(retain_graph=True)
+        loss.backward()
         optimizer.step()
 
-        # Update w_opt
-        w_opt = calc_w(G, start_zs, start_ws, learnable, learn_param, batch=(batch or img_to_img), multi_w=multi_w)
-
         # Remove hook
-        grad_hook.remove()
+        if grad_hook is not None:
+            grad_hook.remove()
+
+    # Host copies of the per step records
+    w_out = torch.stack(w_hist).cpu().float()
+    z_out = torch.stack(z_hist).cpu().float() if learn_param == "z" else None
+    pixel_losses = torch.stack(pixel_losses).cpu().tolist() if len(pixel_losses) else []
+    perceptual_losses = torch.stack(perceptual_losses).cpu().tolist() if len(perceptual_losses) else []
+    min_losses = torch.stack(min_losses).cpu().tolist() if len(min_losses) else []
+    image_confs = torch.stack(image_confs).cpu().numpy().tolist() if len(image_confs) else []
 
     return w_out, z_out, all_synth_images, pixel_losses, perceptual_losses, image_confs, min_losses
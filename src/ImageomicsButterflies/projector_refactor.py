@@ -25,6 +25,7 @@ import cv2
 
 from models import Classifier, VGG16
 from helpers import cuda_setup, set_random_seed
+from scoring_model import get_scoring_model, scores
 
 NORMALIZE = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                   std=[0.229, 0.224, 0.225])
@@ -331,7 +332,7 @@ def project_tmp(
         #input_img = PIL.Image.fromarray(input_img, 'RGB')
         #input_img.save("test.png")
         if C is not None:
-            out = C(feat_extractor(synth_images))
+            out = get_scoring_model(F, C)(synth_images)
             lbls = torch.tensor([target_lbl] * len(images)).cuda()
             class_loss = CELoss(out, lbls)
 
@@ -445,6 +446,12 @@ def visualize(
     print("Calculating difference images")
     max_v = 0
     os.makedirs(os.path.join(outdir, "img_frames"), exist_ok=True)
+    # Every frame's target confidence, scored in batches
+    scorer = get_scoring_model(F, C)
+    device = next(F.parameters()).device
+    with torch.no_grad():
+        frames = torch.stack([synth_image[0] for synth_image in synth_imgs])
+        frame_confs = torch.cat([scores(scorer, frames[i:i+64].to(device), target_lbl)[2] for i in range(0, len(frames), 64)]).cpu()
     for w_i, [projected_w, synth_image] in enumerate(zip(projected_ws, synth_imgs)):
         synth_image = synth_image[0]
         transforms.ToPILImage()(synth_image).save(f'{os.path.join(outdir, "img_frames")}/{w_i}.png')
@@ -459,9 +466,7 @@ def visualize(
             diff_image = np.transpose(np.stack((diff_image, diff_image, diff_image)), (1, 2, 0))
         diffs.append(diff_image)
         imgs.append(np.copy(np.transpose(synth_image.cpu().numpy(), (1, 2, 0))))
-        input_img = NORMALIZE(synth_image)
-        out = C(F(input_img.unsqueeze(0).cuda()))[0]
-        conf = round(sm(out)[target_lbl].item(), 4) * 100
+        conf = round(frame_confs[w_i].item(), 4) * 100
         confs.append(conf)
         if w_i == 0:
             conf_composite_add = np.zeros_like(diff_image[:, :, 0].astype(np.float64))
@@ -589,14 +594,14 @@ def visualize(
         projected_w = projected_ws[-1][i].unsqueeze(0).unsqueeze(0)
         projected_w = projected_w.repeat([1, G.mapping.num_ws, 1])
         synth_image = G.synthesis(projected_w.cuda(), noise_mode='const')
-        conf = round(sm(C(F(NORMALIZE(((synth_image+1)*(1/2)).clamp(0, 1))))[0])[target_lbl].item(), 4)
+        conf = round(scores(scorer, ((synth_image+1)*(1/2)).clamp(0, 1), target_lbl)[2][0].item(), 4)
         synth_image = (synth_image + 1) * (255/2)
         synth_image = synth_image.permute(0, 2, 3, 1).clamp(0, 255).to(torch.uint8)[0].cpu().numpy()
         PIL.Image.fromarray(synth_image, 'RGB').save(f'{outdir}/projections/proj_{i}_{conf}.png')
         projected_w = projected_ws[0][i].unsqueeze(0).unsqueeze(0)
         projected_w = projected_w.repeat([1, G.mapping.num_ws, 1])
         synth_image = G.synthesis(projected_w.cuda(), noise_mode='const')
-        conf = round(sm(C(F(NORMALIZE(((synth_image+1)*(1/2)).clamp(0, 1))))[0])[target_lbl].item(), 4)
+        conf = round(scores(scorer, ((synth_image+1)*(1/2)).clamp(0, 1), target_lbl)[2][0].item(), 4)
         synth_image = (synth_image + 1) * (255/2)
         synth_image = synth_image.permute(0, 2, 3, 1).clamp(0, 255).to(torch.uint8)[0].cpu().numpy()
         PIL.Image.fromarray(synth_image, 'RGB').save(f'{outdir}/projections/proj_{i}_start.png')
@@ -41,25 +41,15 @@ def get_args():
 def sample_w_global_mean(samples, G):
     print(f'Computing {args.samples} W samples...')
     z_samples = np.random.RandomState(123).randn(args.samples, G.z_dim)
-    w_samples = G.mapping(torch.from_numpy(z_samples).cuda(), None)  # [N, L, C]
+    w_samples = G.mapping(torch.from_numpy(z_samples).to(next(G.parameters()).device), None)  # [N, L, C]
     w_samples = w_samples[:, 0, :].cpu().numpy().astype(np.float32)       # [N, 1, C]
     w_avg = np.mean(w_samples, axis=0, keepdims=False)
     return w_avg
 
-def pca(data, dim=2):
-    data = np.array(data)
-    mu = data.mean(0)
-    center = data - mu
-    cov = (1/len(data))*(center.T @ center)
-    eig_val, eig_vec = np.linalg.eig(cov)
-    W = eig_vec[:dim]
-
-    return data @ W.T
-
 def pca_analysis(args, G):
     print(f'Computing {args.samples} W samples...')
     z_samples = np.random.RandomState(123).randn(args.samples, G.z_dim)
-    w_samples = G.mapping(torch.from_numpy(z_samples).cuda(), None)  # [N, L, C]
+    w_samples = G.mapping(torch.from_numpy(z_samples).to(next(G.parameters()).device), None)  # [N, L, C]
     w_samples = w_samples[:, 0, :].cpu().numpy().astype(np.float32)       # [N, 1, C]
     w_avg = np.mean(w_samples, axis=0, keepdims=False)      # [1, 1, C]
 
@@ -86,22 +76,23 @@ def get_images(G, w):
 def calc_percep_loss(F, img1, img2):
     feat1 = F(img1)
     feat2 = F(img2)
-    MSELoss = nn.MSELoss().cuda()
+    MSELoss = nn.MSELoss()
     return MSELoss(feat1, feat2).item()
 
 def initialize_w(G, path, E, F, num_samples=100, E_type='e4e'):
+    device = next(G.parameters()).device
     if E is not None:
         if E_type == 'e4e':
             target_pil = Image.open(path).convert('RGB') # (res, res, # channels)
             images = encoder_transform()(target_pil)
-            start_ws = E(images.unsqueeze(0).cuda())
+            start_ws = E(images.unsqueeze(0).to(device))
             start_ws = start_ws.view(1, G.num_ws, -1).mean(1)
         elif E_type == 'simple':
             pass
     else:
         images = load_imgs(path, view="D")
         projected_zs = np.random.RandomState(123).randn(num_samples, G.z_dim)
-        projected_zs = torch.from_numpy(projected_zs).cuda()
+        projected_zs = torch.from_numpy(projected_zs).to(device)
         projected_zs = projected_zs.repeat([len(images), 1])
         projected_ws = G.mapping(projected_zs, None)[:, :1, :]  # [N, L, C]
         start_ws = []
@@ -118,7 +109,7 @@ def initialize_w(G, path, E, F, num_samples=100, E_type='e4e'):
                     best_loss = loss
                     best_w = w
             start_ws.append(w.detach().cpu().numpy())
-        start_ws = torch.from_numpy(np.array(start_ws)).cuda()
+        start_ws = torch.from_numpy(np.array(start_ws)).to(device)
     return start_ws
     #start_zs, start_ws = load_latents(G, None, batch_size=len(images))
 
@@ -196,7 +187,6 @@ if __name__ == "__main__":
 
     # Load Generator
     G, _, F, _ = load_models(args.network, f_path=args.backbone, c_path=None)
-    G = G.cuda()
 
     # Reconstruct
     w, synth_img, pix_loss, percep_loss = reconstruct(args.img, 0, E, G, F, steps=args.steps, E_type=args.encoder_type)
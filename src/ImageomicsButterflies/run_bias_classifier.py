@@ -17,16 +17,12 @@ from PIL import Image
 
 from models import Res50, VGG16, Classifier
 from loggers import Logger
+from bias_probe import extract_features, knn_accuracy, FEATURE_TYPES, BIAS_CACHE_DIR
+from helpers import get_device
 
 NORMALIZE = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                   std=[0.229, 0.224, 0.225])
 
-def KNN_transform(resize_size=128):
-    return transforms.Compose([
-        transforms.Resize((resize_size, resize_size)),
-        transforms.ToTensor()
-    ])
-
 def train_transform(resize_size=128, crop_size=128, normalize=NORMALIZE):
     return transforms.Compose([
         transforms.Resize((resize_size, resize_size)),
@@ -58,6 +54,11 @@ def get_args():
     parser.add_argument("--gpus", nargs="+", type=int, default=[0])
     parser.add_argument("--output", type=str, default="../output")
     parser.add_argument("--exp_name", type=str, default="debug")
+    parser.add_argument("--knn_only", action="store_true", default=False)
+    parser.add_argument("--knn_k", nargs="+", type=int, default=[1, 5, 10])
+    parser.add_argument("--knn_features", nargs="+", type=str, choices=FEATURE_TYPES, default=["pixel"])
+    parser.add_argument("--knn_method", type=str, choices=["matrix", "kdtree"], default="matrix")
+    parser.add_argument("--bias_cache_dir", type=str, default=BIAS_CACHE_DIR)
 
 
     args = parser.parse_args()
@@ -137,53 +138,25 @@ def compute_accuracy(backbone, classifier, dataloader):
     classifier.eval()
     total = 0
     correct = 0
+    device = next(backbone.parameters()).device
     with torch.no_grad():
         for imgs, lbls, _ in tqdm(dataloader, desc="Computing Accuracy", position=1, ncols=50, leave=False):
-            features = backbone(imgs.cuda()[:, :, 0, 0])
+            features = backbone(imgs.to(device)[:, :, 0, 0])
             out = classifier(features)
             _, preds = torch.max(out, dim=1)
             total += len(lbls)
             correct += (preds.cpu() == lbls).sum()
     return (correct / total).item()
 
-def run_KNN(train_dset, test_dset, K=5):
-    train_pixels = []
-    train_lbls = []
-    for img, lbl, _ in train_dset:
-        px = img[:, 0,0]
-        train_pixels.append(list(px.detach().cpu().numpy()))
-        train_lbls.append(lbl)
-    test_pixels = []
-    test_lbls = []
-    for img, lbl, _ in test_dset:
-        px = img[:, 0,0]
-        test_pixels.append(list(px.detach().cpu().numpy()))
-        test_lbls.append(lbl)
-
-    train_pixels = np.array(train_pixels)
-    train_pixel_lbls = np.array(train_lbls)
-    test_pixels = np.array(test_pixels)
-
-    def dist(query_px, dset):
-        diff = dset - query_px
-        px_dist = (diff ** 2).sum(1)
-        return px_dist
-
-    def mode(x):
-        vals, counts = np.unique(x, return_counts=True)
-        mode_val = np.argwhere(counts==np.max(counts))
-        return vals[mode_val].flatten().tolist()
+def run_KNN(train_dset, test_dset, Ks=[1, 5, 10], features=["pixel"], method="matrix", train_root="", test_root="", cache_dir=BIAS_CACHE_DIR, workers=4):
+    # {feature type : {K : accuracy}}
+    train_feats = extract_features(train_dset.paths, root=train_root, cache_dir=cache_dir, workers=workers)
+    test_feats = extract_features(test_dset.paths, root=test_root, cache_dir=cache_dir, workers=workers)
 
-    correct = 0
-    for px, lbl in zip(test_pixels, test_lbls):
-        query_px = np.tile(px, (train_pixels.shape[0], 1))
-        px_dist = dist(query_px, train_pixels)
-        lbls = train_pixel_lbls[np.argsort(px_dist)[:K]]
-        pred = mode(lbls)
-        if lbl in pred:
-            correct += 1
-
-    return correct / len(test_lbls)
+    accs = {}
+    for feature in features:
+        accs[feature] = knn_accuracy(train_feats[feature], train_dset.labels, test_feats[feature], test_dset.labels, Ks=Ks, method=method)
+    return accs
 
 def run_MLP(train_dl, test_dl):
     class MLP(nn.Module):
@@ -195,8 +168,9 @@ def run_MLP(train_dl, test_dl):
         def forward(self, x, compute_z=False):
             return self.layer(x).view(x.size(0), -1)
         
-    backbone = MLP().cuda()
-    classifier = Classifier(backbone.in_features, train_dset.get_num_classes()).cuda()
+    device = get_device()
+    backbone = MLP().to(device)
+    classifier = Classifier(backbone.in_features, train_dset.get_num_classes()).to(device)
 
     optimizer = SGD(list(backbone.parameters()) + list(classifier.parameters()), lr=args.lr)
     loss_fn = CrossEntropyLoss()
@@ -206,8 +180,8 @@ def run_MLP(train_dl, test_dl):
         backbone.train()
         classifier.train()
         for imgs, lbls, _ in tqdm(dataloader, desc="Batch", position=1, ncols=50, leave=False):
-            imgs = imgs.cuda()
-            lbls = lbls.cuda()
+            imgs = imgs.to(device)
+            lbls = lbls.to(device)
             features = backbone(imgs[:, :, 0, 0])
             out = classifier(features)
             loss = loss_fn(out, lbls)
@@ -237,17 +211,13 @@ if __name__ == "__main__":
     test_dset = ImageList(args.test_dataset, view=args.view, transform=test_transform())
     test_dataloader = DataLoader(test_dset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
 
-    acc = run_MLP(dataloader, test_dataloader)
-    print(f"MLP Accuracy: {round(acc, 4)*100}%")
-
-    train_dset = ImageList(args.train_dataset, view=args.view, transform=KNN_transform())
-    test_dset = ImageList(args.test_dataset, view=args.view, transform=KNN_transform())
+    if not args.knn_only:
+        acc = run_MLP(dataloader, test_dataloader)
+        print(f"MLP Accuracy: {round(acc, 4)*100}%")
 
     # Nearest Neighbor
-    knn_1_acc = run_KNN(train_dset, test_dset, K=1)
-    knn_5_acc = run_KNN(train_dset, test_dset, K=5)
-    knn_10_acc = run_KNN(train_dset, test_dset, K=10)
-
-    print(f"KNN 1 Accuracy: {round(knn_1_acc, 4)*100}%")
-    print(f"KNN 5 Accuracy: {round(knn_5_acc, 4)*100}%")
-    print(f"KNN 10 Accuracy: {round(knn_10_acc, 4)*100}%")
\ No newline at end of file
+    knn_accs = run_KNN(train_dset, test_dset, Ks=args.knn_k, features=args.knn_features, method=args.knn_method, \
+                       train_root=args.train_dataset, test_root=args.test_dataset, cache_dir=args.bias_cache_dir, workers=args.workers)
+    for feature, accs in knn_accs.items():
+        for K, acc in accs.items():
+            print(f"KNN {K} ({feature}) Accuracy: {round(acc, 4)*100}%")
@@ -3,10 +3,13 @@ from argparse import ArgumentParser
 from time import perf_counter
 
 import numpy as np
+import torch
 
 from helpers import set_random_seed, cuda_setup
 from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
 from project import project
+from batch_project import project_batch, stack_histories
+from trajectory_store import TrajectoryWriter, GroupedTrajectoryWriter
 
 def get_args():
     parser = ArgumentParser()
@@ -21,11 +24,89 @@ def get_args():
     parser.add_argument('--experiments_path', type=str, default="../experiments/class_fooling.json")
     parser.add_argument('--mimic_pairs_path', type=str, default="../experiments/mimic_pairs_filtered.json")
     parser.add_argument('--dataset_root', type=str, default="../datasets/high_res_butterfly_data_test/")
+    parser.add_argument('--batch_size', type=int, default=64, help='targets optimized together in batched experiments')
+    parser.add_argument('--trajectory_every', type=int, default=1, help='keep every n-th step of the projection trajectory')
+    parser.add_argument('--quantize_trajectory', action="store_true", default=False, help='store trajectory images as uint8')
 
     args = parser.parse_args()
     args.gpu_ids = ",".join(map(lambda x: str(x), args.gpu_ids))
     return args
 
+def run_batched(G, F, C, exp, outdir, image_paths, projection_labels, target_species, args):
+    all_start_zs = []
+    all_start_ws = []
+    all_labels = []
+    owners = []
+    for species_i, (img_path, proj_lbl) in enumerate(zip(image_paths, projection_labels)):
+        subspecies = img_path.split(os.path.sep)[-1]
+        start_zs, start_ws = load_latents(G, os.path.join(exp["latent_start"], subspecies, "latents.npz"))
+        if exp["learn_param"] == "z":
+            all_start_zs.append(start_zs)
+        all_start_ws.append(start_ws)
+        all_labels.extend([proj_lbl] * len(start_ws))
+        owners.extend([species_i] * len(start_ws))
+    owners = np.array(owners)
+
+    butterfly_outdirs = []
+    for img_path, tgt_species in zip(image_paths, target_species):
+        subspecies = img_path.split(os.path.sep)[-1]
+        butterfly_outdir = os.path.join(outdir, f"{subspecies}_to_{tgt_species}")
+        os.makedirs(butterfly_outdir, exist_ok=args.overwrite)
+        butterfly_outdirs.append(butterfly_outdir)
+    trajectory_writer = GroupedTrajectoryWriter([os.path.join(d, "projections") for d in butterfly_outdirs], owners,
+                                                quantize=args.quantize_trajectory, every=args.trajectory_every)
+    w_records = [[] for _ in range(len(owners))]
+    z_records = [[] for _ in range(len(owners))]
+    def on_record(targets, steps, synth_images, ws, zs):
+        trajectory_writer(targets, steps, synth_images)
+        for i, (t, w) in enumerate(zip(targets, ws)):
+            w_records[t].append(w)
+            if zs is not None:
+                z_records[t].append(zs[i])
+
+    results = project_batch(
+        G,
+        F,
+        C,
+        torch.cat(all_start_ws),
+        labels                     = all_labels,
+        start_zs                   = torch.cat(all_start_zs) if len(all_start_zs) > 0 else None,
+        learn_param                = exp["learn_param"],
+        batch_size                 = args.batch_size,
+        num_steps                  = exp["num_steps"],
+        init_lr                    = exp["lr"],
+        pixel_lambda               = 0.0,
+        perceptual_lambda          = 0.0,
+        class_lambda               = 1.0,
+        min_loss_lambda            = 0.0 if exp["no_regularizer"] else 0.01,
+        on_record                  = on_record,
+        record_every               = args.trajectory_every,
+        verbose                    = args.verbose
+    )
+    trajectory_writer.close()
+
+    for species_i, (butterfly_outdir, proj_lbl) in enumerate(zip(butterfly_outdirs, projection_labels)):
+        idx = np.nonzero(owners == species_i)[0]
+
+        # Save Data (steps x batch layout, as before)
+        w_steps = np.transpose(stack_histories([w_records[i] for i in idx]), axes=(1, 0, 2))
+        if results["zs"] is None:
+            np.savez(f'{butterfly_outdir}/latents.npz', w=results["ws"][idx])
+            np.savez(f'{butterfly_outdir}/all_steps_latents.npz', w=w_steps)
+        else:
+            # Absolute z (start + learned offset), the z load_latents maps back to w
+            z_steps = np.transpose(stack_histories([z_records[i] for i in idx]), axes=(1, 0, 2))
+            np.savez(f'{butterfly_outdir}/latents.npz', w=results["ws"][idx], z=results["zs"][idx])
+            np.savez(f'{butterfly_outdir}/all_steps_latents.npz', w=w_steps, z=z_steps)
+
+        image_confs = np.transpose(stack_histories([results["image_confs"][i] for i in idx]), axes=(1, 0, 2))
+        min_losses = stack_histories([results["min_losses"][i] for i in idx]).mean(0)
+        np.savez(f'{butterfly_outdir}/statistics.npz',
+            image_confs=image_confs,
+            min_losses=min_losses
+        )
+        print(f"{species_i+1}/{len(image_paths)} {butterfly_outdir.split(os.path.sep)[-1]} | avg_conf: {round(image_confs[-1][:, proj_lbl].mean(), 4)}")
+
 if __name__ == "__main__":
     # Time
     all_start_time = perf_counter()
@@ -90,14 +171,23 @@ if __name__ == "__main__":
         os.makedirs(outdir, exist_ok=args.overwrite)
         save_json(exp, os.path.join(outdir, f"exp_args.json"))
 
+        # Independent per-image offsets with no image-space regularizers can share one batched run
+        if use_batch and not (smooth or use_entropy or superpixel):
+            run_batched(G, F, C, exp, outdir, image_paths, projection_labels, target_species, args)
+            exp_time = f'{(perf_counter()-exp_start_time):.1f} s'
+            print(f"Exp {exp_i+1}/{len(experiments)} run time: {exp_time}")
+            continue
+
         for species_i, (img_path, proj_lbl, tgt_species) in enumerate(zip(image_paths, projection_labels, target_species)):
             subspecies = img_path.split(os.path.sep)[-1]
             butterfly_outdir = os.path.join(outdir, f"{subspecies}_to_{tgt_species}")
             os.makedirs(butterfly_outdir, exist_ok=args.overwrite)
             latents = os.path.join(latent_path, subspecies, "latents.npz")
             start_zs, start_ws = load_latents(G, latents)
+            trajectory = TrajectoryWriter(os.path.join(butterfly_outdir, "projections"), len(start_ws),
+                                          quantize=args.quantize_trajectory, every=args.trajectory_every)
 
-            w_out, z_out, all_synth_images, _, _, image_confs, min_losses = project(
+            w_out, z_out, _, _, _, image_confs, min_losses = project(
                 None,
                 G,
                 D,
@@ -116,8 +206,10 @@ if __name__ == "__main__":
                 use_default_feat_extractor = False,
                 no_regularizer             = no_regularizer,
                 smooth_change              = smooth,
-                use_superpixel             = superpixel
+                use_superpixel             = superpixel,
+                trajectory                 = trajectory
             )
+            trajectory.close()
 
             # Save Data
             if z_out is None:
@@ -126,8 +218,7 @@ if __name__ == "__main__":
             else:
                 np.savez(f'{butterfly_outdir}/latents.npz', w=w_out[-1].cpu().numpy(), z=z_out[-1].cpu().numpy())
                 np.savez(f'{butterfly_outdir}/all_steps_latents.npz', w=w_out.cpu().numpy(), z=z_out.cpu().numpy())
-            
-            np.savez(f'{butterfly_outdir}/projections.npz', projections=np.array(all_synth_images))
+
             np.savez(f'{butterfly_outdir}/statistics.npz',
                 image_confs=np.array(image_confs),
                 min_losses=np.array(min_losses)
@@ -8,7 +8,9 @@ import numpy as np
 from models import Encoder
 from helpers import set_random_seed, cuda_setup
 from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
-from project import project
+from project import default_feat_extractor
+from batch_project import project_batch, stack_histories
+from trajectory_store import GroupedTrajectoryWriter
 
 def get_args():
     parser = ArgumentParser()
@@ -24,6 +26,11 @@ def get_args():
     parser.add_argument('--experiments_path', type=str, default="../experiments/img_to_img.json")
     parser.add_argument('--mimic_pairs_path', type=str, default="../experiments/mimic_pairs_filtered.json")
     parser.add_argument('--dataset_root', type=str, default="../datasets/high_res_butterfly_data_test_norm/")
+    parser.add_argument('--max_images', type=int, default=8, help='images per subspecies')
+    parser.add_argument('--batch_size', type=int, default=64, help='targets optimized together')
+    parser.add_argument('--patience', type=int, default=0, help='stop a target after this many steps without improvement (0 = off)')
+    parser.add_argument('--trajectory_every', type=int, default=1, help='keep every n-th step of the projection trajectory')
+    parser.add_argument('--quantize_trajectory', action="store_true", default=False, help='store trajectory images as uint8')
 
     args = parser.parse_args()
     args.gpu_ids = ",".join(map(lambda x: str(x), args.gpu_ids))
@@ -62,8 +69,9 @@ if __name__ == "__main__":
 
     # Load autoencoder
 
-    encoder = Encoder(size=128).cuda()
-    encoder.load_state_dict(torch.load(args.encoder))
+    device = next(G.parameters()).device
+    encoder = Encoder(size=128).to(device)
+    encoder.load_state_dict(torch.load(args.encoder, map_location=device))
 
 
     results_dir = os.path.join(args.outdir_root, "img_to_img")
@@ -87,56 +95,94 @@ if __name__ == "__main__":
         if latent_path is None:
             zs, ws = load_latents(G, None)
 
+        # Pack every subspecies into one batched projection run
+        all_images = []
+        all_start_zs = []
+        all_start_ws = []
+        all_labels = []
+        owners = []
         for species_i, (img_path, img_lbl) in enumerate(zip(image_paths, image_labels)):
-            subspecies = img_path.split(os.path.sep)[-1]
-            butterfly_outdir = os.path.join(outdir, subspecies)
-            os.makedirs(butterfly_outdir, exist_ok=args.overwrite)
             images = load_imgs(img_path, view="D")
-            if len(images) > 8:
-                images = images[:8]
+            if len(images) > args.max_images:
+                images = images[:args.max_images]
             if latent_path == "autoencoder":
                 start_zs = None
-                start_ws, _ = encoder(images)
+                with torch.no_grad():
+                    start_ws, _ = encoder(images)
                 start_ws = start_ws.view(len(images), 12, -1).mean(1)
             else:
-                if learn_param == "w":
-                    start_ws = ws.repeat([len(images), 1]).clone()
-                    start_zs = None
-                elif learn_param == "z":
-                    start_zs = zs.repeat([len(images), 1]).clone()
-                    start_ws = ws.repeat([len(images), 1]).clone()
-            w_out, z_out, all_synth_images, pixel_losses, perceptual_losses, image_confs, _ = project(
-                images,
-                G,
-                D,
-                F,
-                C,
-                img_lbl,
-                learn_param                = learn_param,
-                start_zs                   = start_zs,
-                start_ws                   = start_ws,
-                num_steps                  = num_steps,
-                init_lr                    = lr,
-                img_to_img                 = True,
-                batch                      = True,
-                verbose                    = args.verbose,
-                use_default_feat_extractor = use_default_feat_extractor
-            )
-
-            # Save Data
-            if z_out is None:
-                np.savez(f'{butterfly_outdir}/latents.npz', w=w_out[-1].cpu().numpy())
-                np.savez(f'{butterfly_outdir}/all_steps_latents.npz', w=w_out.cpu().numpy())
+                start_ws = ws.repeat([len(images), 1]).clone()
+                start_zs = zs.repeat([len(images), 1]).clone() if learn_param == "z" else None
+            all_images.append(images)
+            all_start_ws.append(start_ws)
+            if start_zs is not None:
+                all_start_zs.append(start_zs)
+            all_labels.extend([img_lbl] * len(images))
+            owners.extend([species_i] * len(images))
+        all_images = torch.cat(all_images)
+        all_start_ws = torch.cat(all_start_ws)
+        all_start_zs = torch.cat(all_start_zs) if len(all_start_zs) > 0 else None
+        owners = np.array(owners)
+
+        # Trajectories stream to a chunked store per subspecies; only the small w records stay in memory
+        butterfly_outdirs = []
+        for img_path in image_paths:
+            butterfly_outdir = os.path.join(outdir, img_path.split(os.path.sep)[-1])
+            os.makedirs(butterfly_outdir, exist_ok=args.overwrite)
+            butterfly_outdirs.append(butterfly_outdir)
+        trajectory_writer = GroupedTrajectoryWriter([os.path.join(d, "projections") for d in butterfly_outdirs], owners,
+                                                    quantize=args.quantize_trajectory, every=args.trajectory_every)
+        w_records = [[] for _ in range(len(owners))]
+        z_records = [[] for _ in range(len(owners))]
+        def on_record(targets, steps, synth_images, ws, zs):
+            trajectory_writer(targets, steps, synth_images)
+            for i, (t, w) in enumerate(zip(targets, ws)):
+                w_records[t].append(w)
+                if zs is not None:
+                    z_records[t].append(zs[i])
+
+        results = project_batch(
+            G,
+            F,
+            C,
+            all_start_ws,
+            images                     = all_images,
+            labels                     = all_labels,
+            start_zs                   = all_start_zs,
+            feat_extractor             = default_feat_extractor() if use_default_feat_extractor else None,
+            learn_param                = learn_param,
+            batch_size                 = args.batch_size,
+            num_steps                  = num_steps,
+            init_lr                    = lr,
+            patience                   = args.patience,
+            on_record                  = on_record,
+            record_every               = args.trajectory_every,
+            verbose                    = args.verbose
+        )
+        trajectory_writer.close()
+
+        for species_i, butterfly_outdir in enumerate(butterfly_outdirs):
+            idx = np.nonzero(owners == species_i)[0]
+
+            # Save Data (steps x batch layout, as before)
+            w_steps = np.transpose(stack_histories([w_records[i] for i in idx]), axes=(1, 0, 2))
+            if results["zs"] is None:
+                np.savez(f'{butterfly_outdir}/latents.npz', w=results["ws"][idx])
+                np.savez(f'{butterfly_outdir}/all_steps_latents.npz', w=w_steps)
             else:
-                np.savez(f'{butterfly_outdir}/latents.npz', w=w_out[-1].cpu().numpy(), z=z_out[-1].cpu().numpy())
-                np.savez(f'{butterfly_outdir}/all_steps_latents.npz', w=w_out.cpu().numpy(), z=z_out.cpu().numpy())
-            
-            np.savez(f'{butterfly_outdir}/originals.npz', originals=images.detach().cpu().numpy())
-            np.savez(f'{butterfly_outdir}/projections.npz', projections=np.array(all_synth_images))
+                # Absolute z (start + learned offset), the z load_latents maps back to w
+                z_steps = np.transpose(stack_histories([z_records[i] for i in idx]), axes=(1, 0, 2))
+                np.savez(f'{butterfly_outdir}/latents.npz', w=results["ws"][idx], z=results["zs"][idx])
+                np.savez(f'{butterfly_outdir}/all_steps_latents.npz', w=w_steps, z=z_steps)
+
+            pixel_losses = stack_histories([results["pixel_losses"][i] for i in idx]).mean(0)
+            perceptual_losses = stack_histories([results["perceptual_losses"][i] for i in idx]).mean(0)
+            image_confs = np.transpose(stack_histories([results["image_confs"][i] for i in idx]), axes=(1, 0, 2))
+            np.savez(f'{butterfly_outdir}/originals.npz', originals=all_images[idx].detach().cpu().numpy())
             np.savez(f'{butterfly_outdir}/statistics.npz', 
-                pixel_losses=np.array(pixel_losses),
-                perceptual_losses=np.array(perceptual_losses),
-                image_confs=np.array(image_confs) 
+                pixel_losses=pixel_losses,
+                perceptual_losses=perceptual_losses,
+                image_confs=image_confs
             )
             print(f"Exp {exp_i+1}/{len(experiments)} {species_i+1}/{len(image_paths)} {butterfly_outdir.split(os.path.sep)[-1]} | pixel loss: {round(pixel_losses[-1], 4)}")
         exp_time = f'{(perf_counter()-exp_start_time):.1f} s'
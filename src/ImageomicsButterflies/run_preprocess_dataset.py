@@ -1,10 +1,13 @@
 import os
 from argparse import ArgumentParser
+from multiprocessing import Pool
 
+from tqdm import tqdm
 import numpy as np
 from PIL import Image
 
 from helpers import parse_xlsx_labels
+from preprocessing.region_growing import region_growing, corner_seeds
 
 def get_args():
     parser = ArgumentParser()
@@ -13,6 +16,8 @@ def get_args():
     parser.add_argument('--dset', type=str, default='../datasets/')
     parser.add_argument('--split', type=float, default=0.8)
     parser.add_argument('--remove_hybrids', action="store_true", default=False)
+    parser.add_argument('--thresh', type=float, default=4, help='max color distance between neighbouring background pixels')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
 
     return parser.parse_args()
 
@@ -49,93 +54,61 @@ def split_data(paths, labels, split):
     
     return train_data, test_data
 
-def dist(a, b):
-    return np.sqrt(((a - b) ** 2).sum())
-
 def get_background(path, thresh=4):
     img = np.array(Image.open(path))
     h, w = img.shape[:2]
-    visited = ["0_{w//2}", "0_0", f"0_{w-1}", f"{h-1}_{w-1}", f"{h-1}_0"]
-    queue = [(0, w//2, img[0, w//2]),(0, 0, img[0, 0]), (0, w-1, img[0, w-1]), (h-1, w-1, img[h-1, w-1]), (h-1, 0, img[h-1, 0])]
-    background = np.ones_like(img[:, :, 0]).astype(np.uint8)
-    background[0,0] = 0
-    background[0,w-1] = 0
-    background[h-1,w-1] = 0
-    background[h-1,0] = 0
-    background[0, w//2] = 0
-    i = 0
-
-    def get_neighbor_points(row, col):
-        points = []
-        for x in [-1, 0, 1]:
-            for y in [-1, 0, 1]:
-                if x == 0 and y == 0: continue
-                points.append((max(min(row + y, img.shape[0]-1), 0), max(min(col + x, img.shape[1]-1), 0)))
-        return points
-    while len(queue) > 0:
-        i += 1
-        if i % 1000 == 0:
-            Image.fromarray(background * 255).save("in_progress_mask.png")
-        row, col, color = queue.pop(0)
-        points = get_neighbor_points(row, col)
-        for y, x in points:
-            c = img[y, x]
-            d = dist(color, c)
-            if d < thresh:
-                background[y, x] = 0
-                if f"{y}_{x}" not in visited:
-                    queue.append((y, x, c))
-                    visited.append(f"{y}_{x}")
-
-    return background
-
-def remove_background(path):
-    mask = get_background(path)
+    return region_growing(img, corner_seeds(h, w, top_center=True), thresh=thresh)
+
+def remove_background(path, thresh=4):
+    mask = get_background(path, thresh=thresh)
     new_image = np.array(Image.open(path))
     new_image[mask == 0] = np.array([210, 210, 210])
     return Image.fromarray(new_image)
 
-def preprocess_dataset(dataset_path, labels_path, destination, split=0.8):
+def process_file(job):
+    # Skips finished files so an interrupted run can be resumed
+    path, out_path, thresh = job
+    if os.path.exists(out_path):
+        return False
+    img = remove_background(path, thresh=thresh)
+    tmp_path = f"{out_path}.tmp.png"
+    img.save(tmp_path)
+    os.replace(tmp_path, out_path)
+    return True
+
+def get_jobs(data, out_dir, thresh):
+    jobs = []
+    for subspecies in data:
+        cur_dir = os.path.join(out_dir, subspecies)
+        os.makedirs(cur_dir, exist_ok=True)
+        for path in data[subspecies]:
+            name = path.split(os.path.sep)[-1].split(".")[0]
+            jobs.append((path, os.path.join(cur_dir, f"{name}.png"), thresh))
+    return jobs
+
+def run_jobs(jobs, desc, workers=1):
+    if workers > 1:
+        with Pool(workers) as pool:
+            done = list(tqdm(pool.imap_unordered(process_file, jobs), total=len(jobs), desc=desc))
+    else:
+        done = [process_file(job) for job in tqdm(jobs, desc=desc)]
+    print(f"Completed {desc} preprocessing ({sum(done)} new, {len(done) - sum(done)} already done).")
+
+def preprocess_dataset(dataset_path, labels_path, destination, split=0.8, thresh=4, workers=1):
     paths, labels = get_data(dataset_path, labels_path)
 
     if split == 0.0 or split == 1.0:
         print(split)
         data = split_data(paths, labels, split)
-        for subspecies in data:
-            cur_dir = os.path.join(destination, subspecies)
-            os.makedirs(cur_dir, exist_ok=True)
-            for path in data[subspecies]:
-                img = remove_background(path)
-                name = path.split(os.path.sep)[-1].split(".")[0]
-                img.save(os.path.join(cur_dir, f"{name}.png"))
-                print(f"Completed {subspecies} preprocessing.")
+        run_jobs(get_jobs(data, destination, thresh), "dataset", workers)
         return
 
-
     train_data, test_data = split_data(paths, labels, split)
-
-    # train
-    for subspecies in train_data:
-        cur_dir = os.path.join(destination, "train", subspecies)
-        os.makedirs(cur_dir, exist_ok=True)
-        for path in train_data[subspecies]:
-            img = remove_background(path)
-            name = path.split(os.path.sep)[-1].split(".")[0]
-            img.save(os.path.join(cur_dir, f"{name}.png"))
-        print(f"Completed {subspecies} training preprocessing.")
-    
-    # test
-    for subspecies in test_data:
-        cur_dir = os.path.join(destination, "test", subspecies)
-        os.makedirs(cur_dir, exist_ok=True)
-        for path in test_data[subspecies]:
-            img = remove_background(path)
-            name = path.split(os.path.sep)[-1].split(".")[0]
-            img.save(os.path.join(cur_dir, f"{name}.png"))
-        print(f"Completed {subspecies} testing preprocessing.")
+    run_jobs(get_jobs(train_data, os.path.join(destination, "train"), thresh), "training", workers)
+    run_jobs(get_jobs(test_data, os.path.join(destination, "test"), thresh), "testing", workers)
 
 if __name__ == "__main__":
     args = get_args()
     print(args.dset_root)
     print(args.dset)
-    preprocess_dataset(args.dset_root, args.labels, args.dset, args.split)
+    preprocess_dataset(args.dset_root, args.labels, args.dset, args.split, thresh=args.thresh, workers=args.workers)
@@ -0,0 +1,95 @@
+import os
+import json
+import inspect
+import resource
+import importlib.util
+import multiprocessing as mp
+from time import perf_counter
+from argparse import ArgumentParser
+
+import torch
+
+from helpers import cpu_setup, set_random_seed
+from loading_helpers import load_models, load_latents
+
+# Steps per second and peak memory of project.project for a few batch sizes.
+# --baseline takes another copy of project.py (e.g. from an older revision:
+# git show <rev>:src/ImageomicsButterflies/project.py > /tmp/project_old.py)
+# and runs it on the same inputs for a before / after comparison.
+#
+# Peak memory is torch.cuda.max_memory_allocated on GPU. On CPU every run is
+# done in a forked child and the child's peak RSS is reported.
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument("--network", type=str, required=True)
+    parser.add_argument("--backbone", type=str, required=True)
+    parser.add_argument("--classifier", type=str, required=True)
+    parser.add_argument("--num_classes", type=int, default=27)
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[1, 8, 64])
+    parser.add_argument("--num_steps", type=int, default=20)
+    parser.add_argument("--learn_param", type=str, default="w", choices=["w", "z"])
+    parser.add_argument("--capture_every", type=int, default=None, help="Passed to implementations that support it")
+    parser.add_argument("--baseline", type=str, default=None, help="Another project.py to compare against")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None, help="Optional json file for the results")
+    return parser.parse_args()
+
+def load_project_fn(path):
+    spec = importlib.util.spec_from_file_location(f"project_{abs(hash(path))}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.project
+
+def run_projection(project_fn, G, F, C, batch_size, args):
+    set_random_seed(2023)
+    start_zs, start_ws = load_latents(G, None, batch_size=batch_size)
+    kwargs = {}
+    if args.capture_every is not None and "capture_every" in inspect.signature(project_fn).parameters:
+        kwargs["capture_every"] = args.capture_every
+
+    # Short warm up run (allocator, cudnn autotuning), then the timed run
+    project_fn(None, G, None, F, C, 0, learn_param=args.learn_param, start_zs=start_zs, start_ws=start_ws, num_steps=2, batch=True, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = perf_counter()
+    project_fn(None, G, None, F, C, 0, learn_param=args.learn_param, start_zs=start_zs, start_ws=start_ws, num_steps=args.num_steps, batch=True, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {"steps_per_sec" : args.num_steps / (perf_counter() - start), "peak_mem_mb" : peak / 2**20}
+
+def run_in_child(project_fn, G, F, C, batch_size, args):
+    # Fresh process per run so ru_maxrss is this run's peak
+    ctx = mp.get_context("fork")
+    queue = ctx.Queue()
+    p = ctx.Process(target=lambda: queue.put(run_projection(project_fn, G, F, C, batch_size, args)))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+if __name__ == "__main__":
+    args = get_args()
+    if not torch.cuda.is_available():
+        cpu_setup(args.threads)
+    G, _, F, C = load_models(args.network, args.backbone, args.classifier, args.num_classes)
+
+    impls = {"current" : load_project_fn(os.path.join(os.path.dirname(os.path.abspath(__file__)), "project.py"))}
+    if args.baseline is not None:
+        impls = {"baseline" : load_project_fn(args.baseline), **impls}
+
+    results = []
+    for batch_size in args.batch_sizes:
+        for name, project_fn in impls.items():
+            run = run_projection if torch.cuda.is_available() else run_in_child
+            result = {"impl" : name, "batch_size" : batch_size, **run(project_fn, G, F, C, batch_size, args)}
+            results.append(result)
+            print(f"{name:>8} batch={batch_size:<3}: {result['steps_per_sec']:.2f} steps/s | peak memory {result['peak_mem_mb']:.1f} MB")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -10,9 +10,10 @@ import matplotlib.colors as mcolors
 from PIL import Image
 from torchvision import transforms
 
-from helpers import set_random_seed, cuda_setup
+from helpers import set_random_seed, cuda_setup, get_device
 from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
 from superpixel import superpixel
+from trajectory_store import load_trajectory
 
 NORMALIZE = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                   std=[0.229, 0.224, 0.225])
@@ -39,7 +40,7 @@ def save_img(x, path):
     Image.fromarray((x * 255).astype(np.uint8)).save(path)
 
 def convert_to_input(x):
-    img = torch.from_numpy(np.transpose(x, axes=[2, 0, 1])).unsqueeze(0).cuda()
+    img = torch.from_numpy(np.transpose(x, axes=[2, 0, 1])).unsqueeze(0).to(get_device())
     return NORMALIZE(img)
 
 if __name__ == "__main__":
@@ -93,8 +94,9 @@ if __name__ == "__main__":
             final_outdir = os.path.join(exp_outdir, cls_fool_path)
             os.makedirs(final_outdir, exist_ok=args.overwrite)
             data_path = os.path.join(projection_path, cls_fool_path)
-            projections = np.load(os.path.join(data_path, "projections.npz"))["projections"] # steps x batch x 3 x 128 x 128
-            projections = np.transpose(projections, axes=[0, 1, 3, 4, 2])
+            # Only the first and last steps are used
+            projections = load_trajectory(data_path, channels_last=True)
+            projections = np.array([projections[0], projections[-1]]) # 2 x batch x 128 x 128 x 3
 
             confs = np.load(os.path.join(data_path, "statistics.npz"))["image_confs"] # steps x batch x # classes
             #prev_confs = confs[0, :, tgt_lbl]
@@ -0,0 +1,61 @@
+import json
+from argparse import ArgumentParser
+
+import torch
+
+from models import Res50, VGG16, Classifier
+from helpers import cpu_setup, get_device, prepare_model, autocast, measure_throughput
+from data_tools import NORMALIZE
+
+# Images per second of the classifier pipeline C(F(NORMALIZE(x))) for every
+# combination of thread count, memory format and bfloat16 autocast. Run it on
+# a node before a sweep to pick the settings and to predict the sweep's length.
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument("--net", type=str, default="vgg", choices=["vgg", "resnet"])
+    parser.add_argument("--backbone", type=str, default=None)
+    parser.add_argument("--classifier", type=str, default=None)
+    parser.add_argument("--num_classes", type=int, default=27)
+    parser.add_argument("--res", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--threads", nargs="+", type=int, default=[None])
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--output", type=str, default=None, help="Optional json file for the results")
+    return parser.parse_args()
+
+def load_classifier(args, device):
+    F = Res50(pretrain=False) if args.net == "resnet" else VGG16(pretrain=False)
+    if args.backbone is not None:
+        F.load_state_dict(torch.load(args.backbone, map_location=device))
+    C = Classifier(F.in_features, args.num_classes)
+    if args.classifier is not None:
+        C.load_state_dict(torch.load(args.classifier, map_location=device))
+    return F, prepare_model(C, device)
+
+if __name__ == "__main__":
+    args = get_args()
+    device = torch.device(args.device) if args.device is not None else get_device()
+    F, C = load_classifier(args, device)
+
+    results = []
+    for threads in args.threads:
+        if device.type == "cpu":
+            cpu_setup(threads)
+        for channels_last in [False, True]:
+            F_run = prepare_model(F, device, channels_last=channels_last)
+            x = torch.rand((args.batch_size, 3, args.res, args.res), device=device)
+            if channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            for bf16 in [False, True]:
+                def run(batch):
+                    with autocast(bf16, device):
+                        return C(F_run(NORMALIZE(batch)))
+                ips = measure_throughput(run, x, iters=args.iters)
+                results.append({"device" : str(device), "threads" : torch.get_num_threads(), "channels_last" : channels_last, "bf16" : bf16, "images_per_sec" : ips})
+                print(f"threads={torch.get_num_threads()} channels_last={channels_last} bf16={bf16}: {round(ips, 2)} images/s")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
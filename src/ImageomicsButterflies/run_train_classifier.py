@@ -18,6 +18,7 @@ from PIL import Image
 from models import Res50, VGG16, Classifier
 from loggers import Logger
 from datasets import ImageFolder
+from helpers import get_device
 
 NORMALIZE = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                   std=[0.229, 0.224, 0.225])
@@ -47,6 +48,7 @@ def get_args():
     parser.add_argument("--net", type=str, choices=["resnet", "vgg"], default="vgg")
     parser.add_argument("--lr", type=float, default=0.003)
     parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--cache_images", action="store_true", default=False, help="serve pre-resized images from a memory mapped cache")
     parser.add_argument("--batch_size", type=int, default=64)
     parser.add_argument("--pretrain", action="store_true", default=False)
     parser.add_argument("--train_dataset", type=str, default="../datasets/train")
@@ -77,9 +79,10 @@ def compute_accuracy(backbone, classifier, dataloader):
     classifier.eval()
     total = 0
     correct = 0
+    device = next(backbone.parameters()).device
     with torch.no_grad():
         for imgs, lbls, _ in tqdm(dataloader, desc="Computing Accuracy", position=1, ncols=50, leave=False):
-            features = backbone(imgs.cuda())
+            features = backbone(imgs.to(device))
             out = classifier(features)
             _, preds = torch.max(out, dim=1)
             total += len(lbls)
@@ -94,18 +97,20 @@ if __name__ == "__main__":
     logger = Logger(log_output="file", save_path=args.output, exp_name=args.exp_name)
     # Save Args
     logger.save_json(args.__dict__, "args.json")
-    train_dset = ImageFolder(args.train_dataset, transform=train_transform(augment=args.augment_strength))
+    cache_resolution = 128 if args.cache_images else None
+    train_dset = ImageFolder(args.train_dataset, transform=train_transform(augment=args.augment_strength), cache_resolution=cache_resolution)
     dataloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
-    test_dset = ImageFolder(args.test_dataset, transform=test_transform())
+    test_dset = ImageFolder(args.test_dataset, transform=test_transform(), cache_resolution=cache_resolution)
     test_dataloader = DataLoader(test_dset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
 
+    device = get_device()
     backbone = None
     if args.net == "resnet":
-        backbone = Res50(pretrain=args.pretrain).cuda()
+        backbone = Res50(pretrain=args.pretrain).to(device)
     elif args.net == "vgg":
-        backbone = VGG16(pretrain=args.pretrain).cuda()
+        backbone = VGG16(pretrain=args.pretrain).to(device)
 
-    classifier = Classifier(backbone.in_features, train_dset.get_num_classes()).cuda()
+    classifier = Classifier(backbone.in_features, train_dset.get_num_classes()).to(device)
 
     optimizer = SGD(list(backbone.parameters()) + list(classifier.parameters()), lr=args.lr)
     loss_fn = CrossEntropyLoss()
@@ -115,8 +120,8 @@ if __name__ == "__main__":
         backbone.train()
         classifier.train()
         for imgs, lbls, _ in tqdm(dataloader, desc="Batch", position=1, ncols=50, leave=False):
-            imgs = imgs.cuda()
-            lbls = lbls.cuda()
+            imgs = imgs.to(device)
+            lbls = lbls.to(device)
             features = backbone(imgs)
             out = classifier(features)
             loss = loss_fn(out, lbls)
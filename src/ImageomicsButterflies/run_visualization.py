@@ -10,6 +10,7 @@ from PIL import Image
 from helpers import set_random_seed, cuda_setup
 from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
 from superpixel import superpixel
+from trajectory_store import load_trajectory
 
 def get_args():
     parser = ArgumentParser()
@@ -204,8 +205,7 @@ if __name__ == "__main__":
             final_outdir = os.path.join(exp_outdir, cls_fool_path)
             os.makedirs(final_outdir, exist_ok=args.overwrite)
             data_path = os.path.join(projection_path, cls_fool_path)
-            projections = np.load(os.path.join(data_path, "projections.npz"))["projections"] # steps x batch x 3 x 128 x 128
-            projections = np.transpose(projections, axes=[0, 1, 3, 4, 2])
+            projections = load_trajectory(data_path, channels_last=True) # steps x batch x 128 x 128 x 3
             if not confidence_visualize:
                 diff = compute_diff(projections[0], projections[-1], colorspace)
                 if use_median_filter:
@@ -0,0 +1,142 @@
+import copy
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as Fn
+
+from data_tools import NORMALIZE
+
+# Fused classifier scoring: C(F(NORMALIZE(x))) as a single module taking
+# images in [0, 1]. The normalization is folded into the backbone's first
+# convolution (W' = W / std, b' = b - sum(W' * mean)), and backbone and head
+# run as one forward without the compute_z branches.
+#
+# Zero padding of the normalized image is not zero padding of the raw image.
+# The folded conv is exact in the interior, and the border outputs get a
+# per-resolution correction (the response to the padded mean image), so the
+# scores match the unfused path.
+#
+# half runs the fused model in float16 on GPU / bfloat16 on CPU, for
+# inference only. The result can be torch.compile'd or traced to TorchScript.
+#
+# The fused model holds copies of F and C. get_scoring_model rebuilds it when
+# their weights change after it was built: in place (optimizer steps,
+# load_state_dict) or by moving / replacing tensors.
+
+_shared = {}
+
+class NormalizedConv2d(nn.Module):
+    def __init__(self, conv, mean, std):
+        super().__init__()
+        assert conv.groups == 1 and conv.dilation == (1, 1) and conv.padding_mode == "zeros", "Only plain convolutions can be folded"
+        mean = torch.tensor(mean, dtype=torch.float64, device=conv.weight.device)
+        std = torch.tensor(std, dtype=torch.float64, device=conv.weight.device)
+        weight = conv.weight.detach().double() / std.view(1, -1, 1, 1)
+        bias = conv.bias.detach().double() if conv.bias is not None else torch.zeros(len(weight), dtype=torch.float64, device=weight.device)
+        bias = bias - (weight * mean.view(1, -1, 1, 1)).sum((1, 2, 3))
+
+        self.conv = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding)
+        self.conv.weight = nn.Parameter(weight.to(conv.weight.dtype), requires_grad=False)
+        self.conv.bias = nn.Parameter(bias.to(conv.weight.dtype), requires_grad=False)
+        self.register_buffer("mean", mean.float())
+        self.border = None
+
+    def border_correction(self, size):
+        # Output rows / cols whose window reaches into the padding, and the
+        # correction over the whole output (zero in the interior)
+        H, W = size
+        (kh, kw), (sh, sw), (ph, pw) = self.conv.kernel_size, self.conv.stride, self.conv.padding
+        Ho, Wo = (H + 2 * ph - kh) // sh + 1, (W + 2 * pw - kw) // sw + 1
+        top, left = min(Ho, math.ceil(ph / sh)), min(Wo, math.ceil(pw / sw))
+        bottom = min(Ho - top, sum(1 for i in range(Ho) if i * sh - ph + kh > H))
+        right = min(Wo - left, sum(1 for j in range(Wo) if j * sw - pw + kw > W))
+
+        weight = self.conv.weight.double()
+        mean_img = self.mean.double().view(1, -1, 1, 1).expand(1, -1, H, W)
+        corr = (weight * self.mean.double().view(1, -1, 1, 1)).sum((1, 2, 3)).view(1, -1, 1, 1) \
+            - Fn.conv2d(mean_img, weight, stride=self.conv.stride, padding=self.conv.padding)
+        return (H, W), (top, bottom, left, right), corr.to(self.conv.weight.dtype)
+
+    def forward(self, x):
+        y = self.conv(x)
+        if self.border is None or self.border[0] != tuple(x.shape[-2:]) or self.border[2].dtype != y.dtype:
+            self.border = self.border_correction(tuple(x.shape[-2:]))
+        _, (top, bottom, left, right), corr = self.border
+        Ho, Wo = y.shape[-2:]
+        # Only the thin border strips are touched
+        y[:, :, :top] += corr[:, :, :top]
+        y[:, :, Ho-bottom:] += corr[:, :, Ho-bottom:]
+        y[:, :, top:Ho-bottom, :left] += corr[:, :, top:Ho-bottom, :left]
+        y[:, :, top:Ho-bottom, Wo-right:] += corr[:, :, top:Ho-bottom, Wo-right:]
+        return y
+
+def fold_normalization(backbone, mean=NORMALIZE.mean, std=NORMALIZE.std):
+    # Replaces the first Conv2d of backbone (in place) with its normalized version
+    for parent in backbone.modules():
+        for name, child in parent.named_children():
+            if isinstance(child, nn.Conv2d):
+                setattr(parent, name, NormalizedConv2d(child, mean, std))
+                return backbone
+    raise ValueError("Backbone has no Conv2d to fold the normalization into")
+
+class ScoringModel(nn.Module):
+    def __init__(self, F, C, half=False, channels_last=False):
+        super().__init__()
+        # Copies, F and C are still used unfused elsewhere (e.g. perceptual features)
+        self.backbone = fold_normalization(copy.deepcopy(F)).eval().requires_grad_(False)
+        self.head = copy.deepcopy(C).eval().requires_grad_(False)
+        device = next(self.head.parameters()).device
+        self.dtype = (torch.float16 if device.type == "cuda" else torch.bfloat16) if half else torch.float32
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.to(dtype=self.dtype, memory_format=self.memory_format)
+
+    def forward(self, x):
+        # x: [N, 3, H, W] images in [0, 1] -> [N, num_classes] float32 logits
+        x = x.to(dtype=self.dtype).contiguous(memory_format=self.memory_format)
+        return self.head(torch.flatten(self.backbone(x), 1)).float()
+
+def scores(scorer, imgs, lbls=None):
+    """
+    Logits, softmax probabilities and (when lbls is given, an int or a [N]
+    tensor) the target class confidences of imgs, in one call. scorer is a
+    ScoringModel or its compiled / traced version.
+    """
+    logits = scorer(imgs)
+    probs = nn.functional.softmax(logits, dim=1)
+    if lbls is None:
+        return logits, probs, None
+    if isinstance(lbls, int):
+        return logits, probs, probs[:, lbls]
+    return logits, probs, probs.gather(1, lbls.view(-1, 1).to(probs.device))[:, 0]
+
+def compile_scorer(scorer, mode="eager", example=None):
+    """
+    mode: eager (as is), compile (torch.compile) or trace (TorchScript, needs
+    an example batch; the traced graph is specialized to its resolution).
+    """
+    assert mode in ["eager", "compile", "trace"], f"Invalid mode: {mode}"
+    if mode == "compile":
+        return torch.compile(scorer)
+    if mode == "trace":
+        assert example is not None, "Tracing needs an example batch"
+        with torch.no_grad():
+            return torch.jit.trace(scorer, example, check_trace=False)
+    return scorer
+
+def export_scorer(scorer, path, example):
+    # TorchScript file, loadable with torch.jit.load without this repo's models
+    compile_scorer(scorer, "trace", example).save(path)
+
+def weights_version(*modules):
+    # Changes whenever a parameter or buffer is updated in place, moved or replaced
+    return tuple((t.data_ptr(), t._version) for m in modules for t in list(m.parameters()) + list(m.buffers()))
+
+def get_scoring_model(F, C, half=False, channels_last=False, mode="eager", example=None):
+    # The process wide fused model of (F, C), built on first use and whenever their weights changed
+    key = (id(F), id(C), half, channels_last, mode)
+    version = weights_version(F, C)
+    if key not in _shared or _shared[key][2] != version:
+        # F and C are kept in the entry so their ids can't be reused
+        _shared[key] = (F, C, version, compile_scorer(ScoringModel(F, C, half=half, channels_last=channels_last), mode, example))
+    return _shared[key][3]
@@ -0,0 +1,129 @@
+import os
+import json
+import hashlib
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from helpers import cpu_setup
+
+# Sharded, resumable processing of a list of items (e.g. image paths). The
+# items are split into fixed size shards, and every finished shard is written
+# to shard_dir as its own .npz (tmp file + rename, so a shard file on disk is
+# always complete). A rerun only processes the shards that are missing, and
+# merge_shards concatenates them back in item order.
+#
+# Shards are handed out to one worker process per device from a shared queue.
+# Every worker builds its own state once with init_fn(device, *init_args)
+# (models etc.) and then calls work_fn(state, items) -> {name : [n, ...] array}
+# for each shard it takes. With a single device everything runs in process.
+
+META_FILE = "meta.json"
+
+def items_hash(items):
+    return hashlib.sha1("\n".join(map(str, items)).encode()).hexdigest()
+
+def shard_ranges(num_items, shard_size):
+    return [(start, min(start + shard_size, num_items)) for start in range(0, num_items, shard_size)]
+
+def shard_path(shard_dir, start, end):
+    return os.path.join(shard_dir, f"shard_{start:08d}_{end:08d}.npz")
+
+def write_shard(path, arrays):
+    tmp_path = path[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def check_meta(shard_dir, items, shard_size, extra=None):
+    # Shards are only reused for the same items, shard size and settings
+    os.makedirs(shard_dir, exist_ok=True)
+    meta = {"items" : items_hash(items), "num_items" : len(items), "shard_size" : shard_size, "extra" : extra}
+    meta_path = os.path.join(shard_dir, META_FILE)
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            old = json.load(f)
+        if old != json.loads(json.dumps(meta)):
+            raise ValueError(f"{shard_dir} holds shards of a different run, remove it or use another directory")
+        return
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+def pending_shards(shard_dir, num_items, shard_size):
+    return [(start, end) for start, end in shard_ranges(num_items, shard_size) if not os.path.exists(shard_path(shard_dir, start, end))]
+
+def process_shards(state, work_fn, items, shard_dir, ranges, log_prefix=""):
+    for start, end in ranges:
+        write_shard(shard_path(shard_dir, start, end), work_fn(state, items[start:end]))
+        print(f"{log_prefix}Finished items {start}-{end}")
+
+def worker_main(rank, devices, queue, init_fn, init_args, work_fn, items, shard_dir):
+    device = torch.device(devices[rank])
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    else:
+        # CPU workers split the cores instead of all using every core
+        cpu_setup(max(1, (os.cpu_count() or 1) // len(devices)))
+    state = init_fn(device, *init_args)
+    while True:
+        shard = queue.get()
+        if shard is None:
+            break
+        try:
+            process_shards(state, work_fn, items, shard_dir, [shard], log_prefix=f"[worker {rank} {device}] ")
+        except Exception:
+            # The shard stays missing and is picked up again on the next run
+            traceback.print_exc()
+            raise
+
+def run_shards(items, shard_dir, init_fn, work_fn, shard_size=64, devices=["cpu"], init_args=(), extra=None):
+    """
+    Processes every missing shard of items and returns merge_shards(...).
+    init_fn / work_fn must be module level functions (they are pickled into
+    the worker processes). extra: settings that change the results, shards
+    written with other settings are not reused.
+    """
+    check_meta(shard_dir, items, shard_size, extra=extra)
+    pending = pending_shards(shard_dir, len(items), shard_size)
+    done = len(shard_ranges(len(items), shard_size)) - len(pending)
+    if done > 0:
+        print(f"Resuming: {done} shards already done, {len(pending)} left")
+
+    if len(pending) > 0 and len(devices) <= 1:
+        state = init_fn(torch.device(devices[0]), *init_args)
+        process_shards(state, work_fn, items, shard_dir, pending)
+    elif len(pending) > 0:
+        ctx = mp.get_context("spawn")
+        queue = ctx.Queue()
+        for shard in pending:
+            queue.put(shard)
+        for _ in devices:
+            queue.put(None)
+        workers = [ctx.Process(target=worker_main, args=(rank, devices, queue, init_fn, init_args, work_fn, items, shard_dir)) for rank in range(len(devices))]
+        for p in workers:
+            p.start()
+        for p in workers:
+            p.join()
+        failed = [rank for rank, p in enumerate(workers) if p.exitcode != 0]
+        if len(failed) > 0:
+            raise RuntimeError(f"Workers {failed} failed, rerun to finish the missing shards")
+
+    return merge_shards(shard_dir, len(items), shard_size)
+
+def merge_shards(shard_dir, num_items, shard_size):
+    # {name : [num_items, ...]} from every shard, in item order
+    missing = pending_shards(shard_dir, num_items, shard_size)
+    assert len(missing) == 0, f"{len(missing)} shards are missing from {shard_dir}"
+    merged = {}
+    for start, end in shard_ranges(num_items, shard_size):
+        with np.load(shard_path(shard_dir, start, end)) as data:
+            for name in data.files:
+                merged.setdefault(name, []).append(data[name])
+    return {name : np.concatenate(arrays) for name, arrays in merged.items()}
+
+def default_devices(workers=1):
+    # One worker per visible GPU (cycled when there are more workers), CPU workers otherwise
+    if torch.cuda.is_available():
+        return [f"cuda:{i % torch.cuda.device_count()}" for i in range(max(workers, 1))]
+    return ["cpu"] * max(workers, 1)
@@ -4,7 +4,6 @@ from time import perf_counter
 from tqdm import tqdm
 
 import torch
-import torch.nn as nn
 import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw
@@ -12,10 +11,11 @@ from torchvision import transforms
 import imageio
 
 from models import Encoder
-from helpers import set_random_seed, cuda_setup
+from helpers import set_random_seed, cuda_setup, get_device
 from loading_helpers import save_json, load_json, load_imgs, load_latents, load_models
-from data_tools import NORMALIZE
 from project import project
+from w_sensitivity import render_and_score, perturbation_scores
+from scoring_model import get_scoring_model
 
 def get_args():
     parser = ArgumentParser()
@@ -27,6 +27,10 @@ def get_args():
     parser.add_argument('--tgt_sub', type=str, default='emma')
     parser.add_argument('--filter_sub', action='store_true', default=False)
     parser.add_argument('--save_freq', type=int, default=10)
+    parser.add_argument('--search_attributes', action='store_true', default=False)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--prune_to', type=int, default=None, help="Only render the dims with the largest gradient estimated change")
+    parser.add_argument('--half', action='store_true', default=False, help="Score in float16 (GPU) / bfloat16 (CPU)")
 
     # Best lambdas
     """
@@ -138,7 +142,7 @@ def create_images(G, w, no_repeat=False):
     if no_repeat:
         w_input = w
     else:
-        w_input = w.unsqueeze(1).repeat((1, G.num_ws, 1)).cuda()
+        w_input = w.unsqueeze(1).repeat((1, G.num_ws, 1))
     synth_images = G.synthesis(w_input, noise_mode='const')
     synth_images = (synth_images + 1) * (1/2)
     synth_images = synth_images.clamp(0, 1)
@@ -183,16 +187,6 @@ def get_diff_img(a, b):
     return diff_img
 
 
-def pca(data):
-    data = np.array(data)
-    mu = data.mean(0)
-    center = data - mu
-    cov = (1/len(data))*(center.T @ center)
-    eig_val, eig_vec = np.linalg.eig(cov)
-    W = np.copy(eig_vec)
-
-    return (data - mu) @ W.T, W, mu, eig_vec, eig_val
-
 def add_text(img, text=""):
     TEXT_HEIGHT = 20
     PAD = 4
@@ -234,10 +228,12 @@ if __name__ == "__main__":
     src_w = np.array(src_ws_list)
     tgt_w = np.array(tgt_ws_list)
     
-    G, _, F, C = load_models(args.network, args.backbone, args.classifier, args.num_classes)
+    device = get_device()
+    G, _, F, C = load_models(args.network, args.backbone, args.classifier, args.num_classes, device=device)
+    scorer = get_scoring_model(F, C, half=args.half)
 
-    tgt_lbl = torch.tensor([sub_lbl_map[args.tgt_sub]]).cuda()
-    src_lbl = torch.tensor([sub_lbl_map[args.src_sub]]).cuda()
+    tgt_lbl = torch.tensor([sub_lbl_map[args.tgt_sub]], device=device)
+    src_lbl = torch.tensor([sub_lbl_map[args.src_sub]], device=device)
 
     attributes = []
     directions = []
@@ -252,28 +248,16 @@ if __name__ == "__main__":
     directions.extend([0, 0])
 
     new_src_w = []
-    while len(attributes) < M and len(src_w) > 0 and False:
-        diffs = np.zeros((len(src_w), src_w.shape[-1], 2))
-        for w_dim in range(src_w.shape[-1]):
-            if w_dim in attributes: continue
-            for i, w in enumerate(src_w):
-                w_ten = torch.tensor(w).cuda()
-                d_pos = w_ten.clone().detach()
-                d = (d_scale_max[w_dim] - d_pos[w_dim]) * shift_size
-                d_pos[w_dim] += torch.tensor(d).cuda()
-                d_neg = w_ten.clone().detach()
-                d = (d_scale_min[w_dim] - d_neg[w_dim]) * shift_size
-                d_neg[w_dim] += torch.tensor(d).cuda()
-                all_ws = torch.cat((w_ten.unsqueeze(0), (d_pos).unsqueeze(0), (d_neg).unsqueeze(0)), dim=0)
-                imgs = create_images(G, all_ws)
-                probs = C(F(NORMALIZE(imgs)))[:, tgt_lbl.item()]
-                diffs[i, w_dim, 0] = (probs[1] - probs[0]).item()
-                diffs[i, w_dim, 1] = (probs[2] - probs[0]).item()
-        diffs_avg = diffs.mean(0)
-        for w_dim in range(src_w.shape[-1]):
-            if w_dim in attributes: continue
-            if diffs_avg[w_dim, 0] > 0 and diffs_avg[w_dim, 1] > 0:
-                diffs_avg[w_dim, :] = 0.0
+    src_w = torch.tensor(src_w).to(device)
+    d_scale_min_ten = torch.tensor(d_scale_min).to(device)
+    d_scale_max_ten = torch.tensor(d_scale_max).to(device)
+    # Source images and scores don't change, render them once
+    base_logits = render_and_score(G, scorer, src_w, tgt_lbl.item(), batch_size=args.batch_size)
+    while len(attributes) < M and len(src_w) > 0 and args.search_attributes:
+        diffs = perturbation_scores(G, scorer, src_w, tgt_lbl.item(), d_scale_max_ten, d_scale_min_ten, shift_size=shift_size, \
+                                    skip_dims=attributes, prune_to=args.prune_to, batch_size=args.batch_size, base_scores=base_logits)
+        diffs_avg = diffs.mean(0).cpu().numpy()
+        diffs_avg[(diffs_avg[:, 0] > 0) & (diffs_avg[:, 1] > 0)] = 0.0
         att, direct = np.unravel_index(np.argmax(diffs_avg, axis=None), diffs_avg.shape)
         attributes.append(att)
         directions.append(direct)
@@ -284,41 +268,37 @@ if __name__ == "__main__":
         print(attributes)
         print(directions)
     
-    sm = nn.Softmax(dim=1)
+    # Per source row: original, one image per attribute, all attributes
+    org_probs, org_imgs = render_and_score(G, scorer, src_w, tgt_lbl.item(), batch_size=args.batch_size, softmax=True, keep_images=True)
+    org_nps = [to_numpy_img(img) for img in org_imgs]
+    atts = torch.tensor(np.array(attributes, dtype=np.int64), device=device)
     video_imgs = []
     for shift_size in range(50):
+        d_delta = shift_size
+        #d_delta = (v - d[att]) * shift_size
+        att_ws = src_w.unsqueeze(1).repeat((1, len(attributes) + 1, 1))
+        att_ws[:, torch.arange(len(attributes)), atts] += d_delta
+        for att in attributes:
+            att_ws[:, -1, att] += d_delta
+        probs, imgs = render_and_score(G, scorer, att_ws.view(-1, src_w.shape[-1]), tgt_lbl.item(), batch_size=args.batch_size, softmax=True, keep_images=True)
+        probs = probs.view(len(src_w), -1).cpu().numpy()
+        imgs = imgs.view(len(src_w), len(attributes) + 1, *imgs.shape[1:])
+
         final_img = None
-        for i, w in enumerate(src_w):
-            w_ten = torch.tensor(w).cuda()
-            img_org = create_images(G, w_ten.unsqueeze(0).cuda())
-            org_prob = sm(C(F(NORMALIZE(img_org))))[0][tgt_lbl.item()].item()
-            org_prob = round(org_prob * 100, 2)
-            img_org_np = to_numpy_img(img_org[0])
-            img_org_np_text = add_text(img_org_np, f"SRC: {org_prob}%")
-            row_img = img_org_np_text
-            all_atts = w_ten.clone().detach()
-            for att, direct in zip(attributes, directions):
-                d = w_ten.clone().detach()
-                v = torch.tensor(d_scale_max[att]).cuda() if direct == 0 else torch.tensor(d_scale_min[att]).cuda()
-                #d_delta = (v - d[att]) * shift_size
-                d_delta = shift_size
-                d[att] += d_delta
-                w_ten = torch.tensor(w).cuda()
-                all_atts[att] += d_delta
-                img_new = create_images(G, torch.tensor(d).unsqueeze(0))
-                new_prob = sm(C(F(NORMALIZE(img_new))))[0][tgt_lbl.item()].item()
-                new_prob = round(new_prob * 100, 2)
-                img_new_np = to_numpy_img(img_new[0])
+        for i in range(len(src_w)):
+            img_org_np = org_nps[i]
+            org_prob = round(org_probs[i].item() * 100, 2)
+            row_img = add_text(img_org_np, f"SRC: {org_prob}%")
+            for j, att in enumerate(attributes):
+                new_prob = round(probs[i, j].item() * 100, 2)
+                img_new_np = to_numpy_img(imgs[i, j])
                 img_new_np_text = add_text(img_new_np, f"#{att}: {new_prob}%")
                 row_img = np.concatenate((row_img, img_new_np_text), axis=1)
                 diff_img = get_diff_img(img_org_np, img_new_np)
                 diff_img_text = add_text(diff_img, f"#{att} Diff img")
                 row_img = np.concatenate((row_img, diff_img_text), axis=1)
-            all_atts_img = create_images(G, torch.tensor(all_atts).unsqueeze(0))
-            all_atts_prob = sm(C(F(NORMALIZE(all_atts_img))))[0][tgt_lbl.item()].item()
-            all_atts_prob = round(all_atts_prob * 100, 2)
-            all_atts_np = to_numpy_img(all_atts_img[0])
-            all_atts_text = add_text(all_atts_np, f"All: {all_atts_prob}%")
+            all_atts_prob = round(probs[i, -1].item() * 100, 2)
+            all_atts_text = add_text(to_numpy_img(imgs[i, -1]), f"All: {all_atts_prob}%")
             row_img = np.concatenate((row_img, all_atts_text), axis=1)
             if final_img is None:
                 final_img = row_img
@@ -0,0 +1,172 @@
+import os
+import json
+
+import numpy as np
+
+# Optimization trajectories ([records x batch x ...]) stored on disk as a
+# directory of fixed-size, memory-mapped .npy chunks plus a meta.json.
+# Writers hold no step in memory once it's written; readers map only the chunk
+# a requested record lives in. Images in [0, 1] can be quantized to uint8.
+#
+# Rows may finish at different records (early stopping). On close, every row
+# is padded with its last written record so [-1] is each row's final state.
+
+META_FILE = "meta.json"
+
+def chunk_path(path, chunk_i):
+    return os.path.join(path, f"chunk_{chunk_i:05d}.npy")
+
+class TrajectoryWriter:
+    def __init__(self, path, batch_size, quantize=False, every=1, chunk_records=64):
+        self.path = path
+        self.batch_size = batch_size
+        self.quantize = quantize
+        self.every = every
+        self.chunk_records = chunk_records
+        self.item_shape = None
+        self.num_records = 0
+        self.chunks = {}
+        self.last_record = np.full([batch_size], -1, dtype=np.int64)
+        self.last_step = np.full([batch_size], -1, dtype=np.int64)
+        os.makedirs(path, exist_ok=True)
+
+    def should_record(self, step):
+        return step % self.every == 0
+
+    def get_chunk(self, chunk_i):
+        if chunk_i not in self.chunks:
+            dtype = np.uint8 if self.quantize else np.float32
+            shape = (self.chunk_records, self.batch_size) + self.item_shape
+            self.chunks[chunk_i] = np.lib.format.open_memmap(chunk_path(self.path, chunk_i), mode='w+', dtype=dtype, shape=shape)
+        return self.chunks[chunk_i]
+
+    def write(self, record, rows, values, steps=None):
+        values = np.asarray(values)
+        if self.item_shape is None:
+            self.item_shape = tuple(values.shape[1:])
+        if self.quantize:
+            values = (np.clip(values, 0, 1) * 255).round().astype(np.uint8)
+        chunk = self.get_chunk(record // self.chunk_records)
+        chunk[record % self.chunk_records, rows] = values
+        self.last_record[rows] = np.maximum(self.last_record[rows], record)
+        if steps is not None:
+            self.last_step[rows] = steps
+        self.num_records = max(self.num_records, int(record) + 1)
+
+    def append(self, values, step=None):
+        # Whole batch, next record
+        rows = np.arange(self.batch_size)
+        self.write(self.num_records, rows, values, None if step is None else np.full([self.batch_size], step))
+
+    def close(self):
+        if self.item_shape is None:
+            return
+        # Pad rows that stopped early with their last record
+        for row in range(self.batch_size):
+            last = self.last_record[row]
+            if last < 0 or last == self.num_records - 1: continue
+            value = self.chunks[last // self.chunk_records][last % self.chunk_records, row]
+            for record in range(last + 1, self.num_records):
+                self.get_chunk(record // self.chunk_records)[record % self.chunk_records, row] = value
+        for chunk in self.chunks.values():
+            chunk.flush()
+        meta = {
+            "num_records" : self.num_records,
+            "batch_size" : self.batch_size,
+            "item_shape" : list(self.item_shape),
+            "quantized" : self.quantize,
+            "every" : self.every,
+            "chunk_records" : self.chunk_records,
+            "last_step" : self.last_step.tolist()
+        }
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        self.chunks = {}
+
+class TrajectoryStore:
+    def __init__(self, path, channels_last=False):
+        self.path = path
+        self.channels_last = channels_last
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.num_records = self.meta["num_records"]
+        self.chunk_records = self.meta["chunk_records"]
+        self.chunks = {}
+
+    @property
+    def shape(self):
+        item_shape = list(self.meta["item_shape"])
+        if self.channels_last:
+            item_shape = item_shape[1:] + item_shape[:1]
+        return tuple([self.num_records, self.meta["batch_size"]] + item_shape)
+
+    def __len__(self):
+        return self.num_records
+
+    def get_chunk(self, chunk_i):
+        if chunk_i not in self.chunks:
+            self.chunks[chunk_i] = np.load(chunk_path(self.path, chunk_i), mmap_mode='r')
+        return self.chunks[chunk_i]
+
+    def to_output(self, x):
+        if self.meta["quantized"]:
+            x = x.astype(np.float32) / 255
+        else:
+            x = np.array(x, dtype=np.float32)
+        if self.channels_last:
+            x = np.moveaxis(x, -3, -1)
+        return x
+
+    def get(self, record, rows=slice(None)):
+        if record < 0:
+            record += self.num_records
+        assert 0 <= record < self.num_records, f"Record {record} out of range"
+        chunk = self.get_chunk(record // self.chunk_records)
+        return self.to_output(chunk[record % self.chunk_records, rows])
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self.get(index[0], index[1])
+        if isinstance(index, slice):
+            return np.array([self.get(i) for i in range(*index.indices(self.num_records))])
+        return self.get(index)
+
+    def __iter__(self):
+        for i in range(self.num_records):
+            yield self.get(i)
+
+def load_trajectory(dir_path, name="projections", channels_last=False):
+    # Prefer the chunked store and fall back to the older monolithic npz
+    store_path = os.path.join(dir_path, name)
+    if os.path.isdir(store_path):
+        return TrajectoryStore(store_path, channels_last=channels_last)
+    data = np.load(os.path.join(dir_path, f"{name}.npz"))[name]
+    if channels_last:
+        data = np.moveaxis(data, -3, -1)
+    return data
+
+class GroupedTrajectoryWriter:
+    # Routes per-target records from project_batch into one store per group
+    # (e.g. one per subspecies), so each group keeps the [records x batch] layout.
+    def __init__(self, group_paths, owners, quantize=False, every=1, chunk_records=64):
+        self.owners = np.asarray(owners)
+        self.every = every
+        self.rows = np.zeros(len(self.owners), dtype=np.int64)
+        self.writers = []
+        for group_i, path in enumerate(group_paths):
+            members = np.nonzero(self.owners == group_i)[0]
+            self.rows[members] = np.arange(len(members))
+            self.writers.append(TrajectoryWriter(path, max(len(members), 1), quantize=quantize, every=every, chunk_records=chunk_records))
+
+    def __call__(self, targets, steps, images):
+        # Regular records land on step / every, a final off-stride step on the next record
+        records = -(-np.asarray(steps) // self.every)
+        groups = self.owners[targets]
+        for group_i in np.unique(groups):
+            for record in np.unique(records[groups == group_i]):
+                mask = (groups == group_i) & (records == record)
+                self.writers[group_i].write(record, self.rows[targets[mask]], images[mask], steps[mask])
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
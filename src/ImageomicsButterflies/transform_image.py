@@ -2,8 +2,6 @@ import os
 import random
 from argparse import ArgumentParser
 
-from tqdm import tqdm 
-
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 
@@ -12,14 +10,15 @@ import numpy as np
 import torch
 import torch.nn as nn
 from torch.optim import SGD, Adam, LBFGS
-from torch.utils.data import DataLoader
 from torchvision import transforms
 
 from models import Res50, Classifier, VGG16, VGG16_Decoder
 from loggers import Logger
-from data_tools import NORMALIZE, image_transform, to_tensor, test_image_transform, rgb_img_loader, to_grayscale, cosine_similarity
+from data_tools import NORMALIZE, image_transform, to_tensor, test_image_transform, rgb_img_loader, to_grayscale
 from loss import TransformLoss
 from datasets import ImageList
+from feature_bank import FeatureBank, NeighborIndex
+from helpers import get_device
 
 def get_args():
     parser = ArgumentParser()
@@ -70,19 +69,18 @@ def setup(args):
 
 
 
-def nearest_neighbor(feat, original_features, target_features, args):
-    source_diff = np.sqrt(((original_features - feat) ** 2).sum(1))
-    target_diff = np.sqrt(((target_features - feat) ** 2).sum(1))
-    source_min = source_diff.min()
-    target_min = target_diff.min()
+def nearest_neighbor(feat, source_index, target_index, args):
+    # source_index, target_index: L2 NeighborIndex over each class's features
+    source_min = source_index.search(feat, k=1)[0][0, 0]
+    target_min = target_index.search(feat, k=1)[0][0, 0]
     if source_min < target_min:
         return args.test_lbl, source_min, target_min
     else:
         return args.target_lbl, target_min, source_min
 
 def get_out_of_bounds_loss(z):
-    upper = NORMALIZE(torch.ones_like(z)).cuda()
-    lower = NORMALIZE(torch.zeros_like(z)).cuda()
+    upper = NORMALIZE(torch.ones_like(z))
+    lower = NORMALIZE(torch.zeros_like(z))
     out_loss = ((z[z > upper] - upper[z > upper]) ** 2).sum()
     out_loss += ((lower[z < lower] - z[z < lower]) ** 2).sum()
     return out_loss
@@ -95,69 +93,58 @@ if __name__ == "__main__":
     # Save Args
     logger.save_json(args.__dict__, "args.json")
 
-    train_dset = ImageList(args.train_dataset, transform=image_transform())
-    train_dataloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers)
+    train_dset = ImageList(args.train_dataset, transform=image_transform(), view=args.view)
 
+    device = get_device()
     backbone = None
     if args.net == "resnet":
-        backbone = Res50(pretrain=True).cuda()
+        backbone = Res50(pretrain=True).to(device)
         if args.backbone is not None:
-            backbone.load_state_dict(torch.load(args.backbone))
+            backbone.load_state_dict(torch.load(args.backbone, map_location=device))
     elif args.net == "vgg":
-        backbone = VGG16(pretrain=True).cuda()
+        backbone = VGG16(pretrain=True).to(device)
         if args.backbone is not None:
-            backbone.load_state_dict(torch.load(args.backbone))
+            backbone.load_state_dict(torch.load(args.backbone, map_location=device))
 
-    classifier = Classifier(backbone.in_features, train_dset.get_num_classes()).cuda()
-    classifier.load_state_dict(torch.load(args.classifier))
+    classifier = Classifier(backbone.in_features, train_dset.get_num_classes()).to(device)
+    classifier.load_state_dict(torch.load(args.classifier, map_location=device))
     backbone.eval()
     classifier.eval()
-    original_activations = []
-    target_activations = []
-    original_features = []
-    target_features = []
     test_img = to_tensor(rgb_img_loader(args.test_image))
     test_img_pil = transforms.ToPILImage()(test_img)
-    test_img_input = test_image_transform()(test_img).cuda()
+    test_img_input = test_image_transform()(test_img).to(device)
     with torch.no_grad():
         test_features, test_z = backbone(test_img_input.unsqueeze(0), compute_z=True)
         test_features = test_features[0].detach().cpu().numpy()
         test_z = test_z[0]
-        for imgs, lbls, paths in tqdm(train_dataloader, desc="Computing Features", position=1, ncols=50, leave=False):
-            features, activations = backbone(imgs.cuda(), compute_z=True)
-            for i, lbl in enumerate(lbls):
-                current_view = paths[i].split(os.path.sep)[-1].split("_")[1]
-                if int(lbl.item()) == args.test_lbl and current_view == args.view:
-                    feat = features[i].detach().cpu().numpy()
-                    score = cosine_similarity(feat, test_features)
-                    original_activations.append([paths[i], activations[i].detach().cpu().numpy(), score])
-                    original_features.append(feat)
-                elif int(lbl.item()) == args.target_lbl and current_view == args.view:
-                    feat = features[i].detach().cpu().numpy()
-                    score = cosine_similarity(feat, test_features)
-                    target_activations.append([paths[i], activations[i].detach().cpu().numpy(), score])
-                    target_features.append(feat)
-        
-    # NOTE, we do not remove from the features arrays (target_features, original_features)
-    original_features = np.array(original_features)
-    target_features = np.array(target_features)
-    original_activations.sort(key=lambda x: x[2], reverse=True)
-    target_activations.sort(key=lambda x: x[2], reverse=True)
-    original_activations = original_activations[:args.K]
-    target_activations = target_activations[:args.K]
-    avg_original_activations = np.zeros_like(original_activations[0][1])
-    avg_target_activations = np.zeros_like(target_activations[0][1])
-    for act in original_activations:
-        avg_original_activations += act[1]
-    for act in target_activations:
-        avg_target_activations += act[1]
+
+    # Features and activations of the source and target classes are extracted once per backbone
+    subset = [i for i, lbl in enumerate(train_dset.labels) if lbl in [args.test_lbl, args.target_lbl]]
+    bank = FeatureBank.load_or_build(backbone, args.backbone, train_dset, root=args.train_dataset, indices=subset, compute_z=True, \
+                                     extra=[args.net, args.view, "image_transform"], batch_size=args.batch_size, workers=args.workers)
+    source_rows = bank.select(labels=[args.test_lbl])
+    target_rows = bank.select(labels=[args.target_lbl])
+
+    # NOTE, the nearest neighbor indices use every row of each class, not only the top K
+    original_features = np.asarray(bank.features[source_rows], dtype=np.float32)
+    target_features = np.asarray(bank.features[target_rows], dtype=np.float32)
+    source_index = NeighborIndex(original_features, metric="l2")
+    target_index = NeighborIndex(target_features, metric="l2")
+
+    # Average activations of the K most (cosine) similar images of each class
+    _, source_top = NeighborIndex(original_features, metric="cosine").search(test_features, k=args.K)
+    _, target_top = NeighborIndex(target_features, metric="cosine").search(test_features, k=args.K)
+    original_activations = source_rows[source_top[0]]
+    target_activations = target_rows[target_top[0]]
+    avg_original_activations = np.asarray(bank.z[np.sort(original_activations)], dtype=np.float32).sum(0)
+    avg_target_activations = np.asarray(bank.z[np.sort(target_activations)], dtype=np.float32).sum(0)
 
     logger.log(f"Size of source set: {len(original_activations)}")
     logger.log(f"Size of target set: {len(target_activations)}")
     avg_original_activations = avg_original_activations / len(original_activations)
     avg_target_activations = avg_target_activations / len(target_activations)
 
-    attribute_vector = torch.tensor(avg_target_activations - avg_original_activations).cuda()
+    attribute_vector = torch.tensor(avg_target_activations - avg_original_activations).to(device)
     att_size = attribute_vector.shape[0]
     logger.log(f"Number of features in attribute vector: {att_size}")
     print(f"Number of features in attribute vector: {att_size}")
@@ -194,7 +181,7 @@ if __name__ == "__main__":
     #logger.log(f"Alpha: {alpha}")
 
 
-    z = nn.Parameter(test_img_input.detach().clone().cuda())
+    z = nn.Parameter(test_img_input.detach().clone())
     optimizer = LBFGS([z], lr=args.lr)
 
     # Freeze backbone
@@ -213,7 +200,7 @@ if __name__ == "__main__":
     loss_fn = TransformLoss(test_img_input, test_z + attribute_vector*alpha, beta=args.reg_beta, reg_lambda=args.reg_lambda, reg_original=args.reg_original)
     loss_v = args.min_loss + 1
     i = 0
-    target_lbl_cuda = torch.tensor(args.target_lbl).unsqueeze(0).cuda()
+    target_lbl_cuda = torch.tensor(args.target_lbl).unsqueeze(0).to(device)
     while loss_v > args.min_loss and i < args.max_iters:
         i += 1
         #z = reset_inbounds(z)
@@ -250,7 +237,7 @@ if __name__ == "__main__":
         calc_alpha = torch.linalg.vector_norm(proj_vec) / torch.linalg.vector_norm(u)
         calc_alpha = calc_alpha.item()
         vec_dist = torch.linalg.norm(act - (test_z + attribute_vector*alpha))
-        lbl, dist, other_dist = nearest_neighbor(feat.detach().cpu().numpy(), original_features, target_features, args)
+        lbl, dist, other_dist = nearest_neighbor(feat.detach().cpu().numpy(), source_index, target_index, args)
         out = classifier(feat)
         target_conf = sm(out)[0][args.target_lbl].item()
         print(target_conf)
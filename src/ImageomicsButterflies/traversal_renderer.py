@@ -0,0 +1,106 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import imageio
+from PIL import Image
+
+from w_stats import network_hash
+
+# Latent traversal rendering. A traversal is a base w moved along a direction
+# by a schedule of alphas (frame k = base + direction * alphas[k]). All frames
+# missing from the cache, across every requested traversal, are synthesized in
+# batch_size chunks. Rendered frames are kept in an LRU cache keyed by
+# (snapshot, base, direction, alpha), and strips are written in a single
+# reshape instead of one concatenation per frame.
+
+def array_key(x):
+    return hashlib.sha1(np.ascontiguousarray(x, dtype=np.float32).tobytes()).hexdigest()
+
+def to_strip(frames):
+    # [A, H, W, 3] -> [H, A*W, 3]
+    A, H, W, C = frames.shape
+    return np.ascontiguousarray(frames.transpose(1, 0, 2, 3)).reshape(H, A * W, C)
+
+def write_video(frames, path, fps=10):
+    # frames: any iterable of [H, W, 3], appended to the encoder one at a time
+    video = imageio.get_writer(path, mode='I', fps=fps, codec='libx264')
+    for frame in frames:
+        video.append_data(frame)
+    video.close()
+
+class TraversalRenderer:
+    def __init__(self, G, network_path=None, batch_size=64, max_cached=10000):
+        self.G = G
+        self.snapshot = network_hash(network_path)[:16] if network_path is not None else str(id(G))
+        self.batch_size = batch_size
+        self.max_cached = max_cached
+        self.frames = OrderedDict()
+
+    def synthesize(self, ws):
+        # [N, w_dim] -> [N, H, W, 3] uint8
+        device = next(self.G.parameters()).device
+        ws = torch.as_tensor(ws, dtype=torch.float32, device=device)
+        with torch.no_grad():
+            synth_images = self.G.synthesis(ws.unsqueeze(1).repeat((1, self.G.num_ws, 1)), noise_mode='const')
+            synth_images = ((synth_images + 1) * (1/2)).clamp(0, 1)
+            out_images = (synth_images * 255).to(torch.uint8).permute(0, 2, 3, 1)
+        return out_images.cpu().numpy()
+
+    def cache(self, key, frame):
+        if self.max_cached <= 0: return
+        self.frames[key] = frame
+        self.frames.move_to_end(key)
+        while len(self.frames) > self.max_cached:
+            self.frames.popitem(last=False)
+
+    def iter_traversals(self, traversals):
+        """
+        traversals: list of (base, direction, alphas). Yields the [A, H, W, 3]
+        frames of each traversal in order, as soon as all of its frames exist.
+        """
+        keys = []
+        for base, direction, alphas in traversals:
+            base_key, dir_key = array_key(base), array_key(direction)
+            keys.append([(self.snapshot, base_key, dir_key, float(alpha)) for alpha in alphas])
+
+        # Cached frames are held here too, so evictions while rendering can't lose them.
+        # A frame is dropped once the last traversal that uses it is handed out.
+        frames = {key : self.frames[key] for t_keys in keys for key in t_keys if key in self.frames}
+        last_use = {key : t for t, t_keys in enumerate(keys) for key in t_keys}
+        missing = [(t, k) for t, t_keys in enumerate(keys) for k, key in enumerate(t_keys) if key not in frames]
+        done = 0
+        for start in range(0, len(missing), self.batch_size):
+            chunk = missing[start:start+self.batch_size]
+            ws = np.stack([traversals[t][0] + traversals[t][1] * traversals[t][2][k] for t, k in chunk])
+            for (t, k), frame in zip(chunk, self.synthesize(ws)):
+                frames[keys[t][k]] = frame
+                self.cache(keys[t][k], frame)
+            # missing is ordered by traversal, everything before the next missing frame is complete
+            next_t = missing[start+self.batch_size][0] if start + self.batch_size < len(missing) else len(traversals)
+            while done < next_t:
+                yield self.collect(frames, keys[done], last_use, done)
+                done += 1
+        while done < len(traversals):
+            yield self.collect(frames, keys[done], last_use, done)
+            done += 1
+
+    def collect(self, frames, keys, last_use, t):
+        out = np.stack([frames[key] for key in keys])
+        for key in keys:
+            if last_use[key] == t:
+                frames.pop(key, None)
+        return out
+
+    def render(self, traversals):
+        return list(self.iter_traversals(traversals))
+
+    def save_strips(self, traversals, paths):
+        # One horizontal strip image per traversal
+        for frames, path in zip(self.iter_traversals(traversals), paths):
+            Image.fromarray(to_strip(frames)).save(path)
+
+    def save_video(self, traversals, path, fps=10):
+        # Frames go to the encoder as they are rendered, traversals play one after another
+        write_video((frame for frames in self.iter_traversals(traversals) for frame in frames), path, fps=fps)
@@ -4,6 +4,8 @@ from argparse import ArgumentParser
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
+from trajectory_store import load_trajectory
+
 TEXT_HEIGHT = 20
 PADDING = 2
 
@@ -21,10 +23,10 @@ if __name__ == "__main__":
 
     final_img = None
     for root, dirs, files in os.walk(args.exp_dir):
-        if "projections.npz" not in files:
+        if "projections.npz" not in files and "projections" not in dirs:
             continue
         subspecies = root.split(os.path.sep)[-1]
-        projections = np.transpose(np.load(os.path.join(root, "projections.npz"))['projections'][-1], axes=[0, 2, 3, 1])
+        projections = load_trajectory(root, channels_last=True)[-1]
         originals = np.transpose(np.load(os.path.join(root, "originals.npz"))['originals'], axes=[0, 2, 3, 1])
         all_subspecies = None
         for proj, org in zip(projections, originals):
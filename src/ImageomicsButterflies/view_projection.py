@@ -1,8 +1,11 @@
+import os
 from argparse import ArgumentParser
 
 import numpy as np
 import PIL.Image as Image
 
+from trajectory_store import load_trajectory
+
 def get_args():
     parser = ArgumentParser()
     parser.add_argument("--projections", type=str, default="styleGAN/results/img_to_img/random_default_z/rosina_M/projections.npz")
@@ -13,6 +16,8 @@ def get_args():
 
 if __name__ == "__main__":
     args = get_args()
-    projections = np.load(args.projections)['projections']
-    projection = (np.transpose(projections[-1][args.img_num], axes=[1, 2, 0]) * 255).astype(np.uint8)
+    # Accepts either projections.npz or a chunked trajectory directory
+    path = os.path.normpath(args.projections)
+    projections = load_trajectory(os.path.dirname(path), name=os.path.splitext(os.path.basename(path))[0], channels_last=True)
+    projection = (projections[-1][args.img_num] * 255).astype(np.uint8)
     Image.fromarray(projection).save("test.png")
@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+
+from scoring_model import scores
+
+# Sensitivity of a classifier score to single w dimension shifts (StylEx style
+# attribute search). All (source, dimension, direction) perturbations are
+# rendered and scored in fixed-size batches, the unperturbed source scores are
+# computed once, and a first-order (gradient) estimate can prune the
+# dimensions that are evaluated exactly.
+#
+# Direction 0 moves a dimension towards shift_max, direction 1 towards
+# shift_min, by (target - w[dim]) * shift_size. scorer is the fused
+# C(F(NORMALIZE(.))) model (scoring_model.get_scoring_model).
+
+def synthesize(G, ws):
+    synth_images = G.synthesis(ws.unsqueeze(1).repeat((1, G.num_ws, 1)), noise_mode='const')
+    return ((synth_images + 1) * (1/2)).clamp(0, 1)
+
+def class_scores(scorer, imgs, lbl, softmax=False):
+    logits, probs, conf = scores(scorer, imgs, lbl)
+    if softmax:
+        return conf
+    return logits[:, lbl]
+
+def render_and_score(G, scorer, ws, lbl, batch_size=256, softmax=False, keep_images=False):
+    all_scores = []
+    images = []
+    with torch.no_grad():
+        for i in range(0, len(ws), batch_size):
+            imgs = synthesize(G, ws[i:i+batch_size])
+            all_scores.append(class_scores(scorer, imgs, lbl, softmax=softmax))
+            if keep_images:
+                images.append(imgs)
+    all_scores = torch.cat(all_scores)
+    if keep_images:
+        return all_scores, torch.cat(images)
+    return all_scores
+
+def shift_deltas(src_w, shift_max, shift_min, shift_size=5):
+    # [num_src, w_dim, 2]
+    return torch.stack(((shift_max - src_w) * shift_size, (shift_min - src_w) * shift_size), dim=2)
+
+def gradient_estimate(G, scorer, src_w, lbl, deltas, batch_size=64):
+    # First order estimate of every score change: d score / d w[dim] * delta
+    grads = []
+    with torch.enable_grad():
+        for i in range(0, len(src_w), batch_size):
+            w = src_w[i:i+batch_size].clone().requires_grad_(True)
+            score = class_scores(scorer, synthesize(G, w), lbl).sum()
+            grads.append(torch.autograd.grad(score, w)[0])
+    return torch.cat(grads).unsqueeze(2) * deltas
+
+def perturbation_scores(G, scorer, src_w, lbl, shift_max, shift_min, shift_size=5, skip_dims=[], \
+                        prune_to=None, batch_size=256, base_scores=None):
+    """
+    Returns [num_src, w_dim, 2] score changes for every perturbation.
+    Skipped and pruned dimensions are left at 0. With prune_to, only the
+    prune_to dimensions with the largest estimated (source mean) change are
+    rendered.
+    """
+    device = src_w.device
+    num_src, w_dim = src_w.shape
+    deltas = shift_deltas(src_w, shift_max, shift_min, shift_size)
+    if base_scores is None:
+        base_scores = render_and_score(G, scorer, src_w, lbl, batch_size=batch_size)
+
+    dims = np.setdiff1d(np.arange(w_dim), np.asarray(skip_dims, dtype=np.int64))
+    if prune_to is not None and prune_to < len(dims):
+        estimate = gradient_estimate(G, scorer, src_w, lbl, deltas).mean(0).max(1)[0]
+        estimate = estimate[torch.from_numpy(dims).to(device)]
+        dims = dims[estimate.topk(prune_to)[1].cpu().numpy()]
+    dims = torch.from_numpy(dims).to(device)
+
+    # Every (source, dimension, direction) triple, flattened
+    src_idx, dim_idx, dir_idx = [x.flatten() for x in torch.meshgrid(torch.arange(num_src, device=device), dims, torch.arange(2, device=device), indexing='ij')]
+
+    diffs = torch.zeros((num_src, w_dim, 2), device=device)
+    with torch.no_grad():
+        for i in range(0, len(src_idx), batch_size):
+            s, d, r = src_idx[i:i+batch_size], dim_idx[i:i+batch_size], dir_idx[i:i+batch_size]
+            ws = src_w[s].clone()
+            ws[torch.arange(len(s), device=device), d] += deltas[s, d, r]
+            diffs[s, d, r] = class_scores(scorer, synthesize(G, ws), lbl) - base_scores[s]
+    return diffs
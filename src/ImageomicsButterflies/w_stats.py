@@ -0,0 +1,75 @@
+import os
+import hashlib
+
+import numpy as np
+import torch
+
+from ganspace_pca import PCA
+
+# On-disk cache of W sample statistics (w_avg, covariance and eigenbasis) for a
+# generator snapshot. The statistics are accumulated in chunks with the streaming
+# PCA update, so large sample counts never hold every w at once.
+
+W_STATS_CACHE_DIR = "../cache/w_stats"
+
+_hash_memo = {}
+
+def network_hash(network_path):
+    if not os.path.isfile(network_path):
+        # URLs and other non-local snapshots are keyed by name
+        return hashlib.sha256(network_path.encode()).hexdigest()
+    stat = os.stat(network_path)
+    key = (os.path.abspath(network_path), stat.st_size, stat.st_mtime)
+    if key not in _hash_memo:
+        h = hashlib.sha256()
+        with open(network_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _hash_memo[key] = h.hexdigest()
+    return _hash_memo[key]
+
+def cache_path(network_path, samples, seed, cache_dir=W_STATS_CACHE_DIR):
+    return os.path.join(cache_dir, f"w_stats_{network_hash(network_path)[:16]}_{samples}_{seed}.npz")
+
+def compute_w_stats(G, samples=10000, seed=123, chunk_size=10000):
+    rs = np.random.RandomState(seed)
+    device = next(G.parameters()).device
+    model = PCA()
+    with torch.no_grad():
+        for start in range(0, samples, chunk_size):
+            count = min(chunk_size, samples - start)
+            z_samples = torch.from_numpy(rs.randn(count, G.z_dim).astype(np.float32)).to(device)
+            w_samples = G.mapping(z_samples, None)[:, 0, :].cpu().numpy() # [N, C]
+            model.partial_fit(w_samples)
+    model.finalize()
+
+    return {
+        "w_avg" : model.mean_.astype(np.float32),
+        "cov" : model.covariance_.astype(np.float32),
+        "eig_val" : model.explained_variance_.astype(np.float32),
+        "eig_vec" : model.components_.astype(np.float32),
+        "samples" : model.n_samples_,
+        "seed" : seed
+    }
+
+_z_mean_memo = {}
+
+def z_mean(z_dim, samples=10000, seed=123):
+    # Mean of the seeded z samples ([1, z_dim] float64). It only depends on
+    # the seed and sizes, not on the generator, so it is drawn once per process.
+    key = (z_dim, samples, seed)
+    if key not in _z_mean_memo:
+        _z_mean_memo[key] = torch.from_numpy(np.random.RandomState(seed).randn(samples, z_dim)).mean(0, keepdim=True).numpy()
+    return _z_mean_memo[key]
+
+def load_w_stats(G, network_path, samples=10000, seed=123, cache_dir=W_STATS_CACHE_DIR, chunk_size=10000):
+    path = cache_path(network_path, samples, seed, cache_dir)
+    if os.path.exists(path):
+        data = np.load(path)
+        return {k : data[k] for k in data.files}
+
+    print(f'Computing W statistics using {samples} samples...')
+    stats = compute_w_stats(G, samples=samples, seed=seed, chunk_size=chunk_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(path, **stats)
+    return stats
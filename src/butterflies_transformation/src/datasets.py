@@ -4,6 +4,11 @@ from torch.utils.data import Dataset
 import numpy as np
 from PIL import Image
 
+from image_cache import ImageCache
+from label_index import LabelIndex
+
+IMAGE_CACHE_DIR = "../cache/images"
+
 def collect_paths(path, only_path=False):
     paths = []
     cnames = []
@@ -42,9 +47,17 @@ class CuthillDataset(Dataset):
         self.labels = []
         for cname in cnames:
             self.labels.append(self.name_lbl_map[cname])
+        self.lbl_index = LabelIndex.build(self.labels)
 
         self.num_classes = len(unique_cnames)
 
+        # Opt in with CACHE_RESOLUTION (and optionally CACHE_DIR) in the options
+        self.cache = None
+        cache_resolution = getattr(options, "CACHE_RESOLUTION", None)
+        if cache_resolution is not None:
+            self.cache = ImageCache.load_or_build(options.DATASET, self.paths, self.labels, cache_resolution, \
+                                                  cache_dir=getattr(options, "CACHE_DIR", IMAGE_CACHE_DIR), extra={"train" : train, "split" : options.DATA_TO_TRAIN})
+
     def load_img(self, path):
         img = Image.open(path)
         if self.transform is not None:
@@ -56,15 +69,21 @@ class CuthillDataset(Dataset):
         return self.lbl_map[lbl]
     
     def get_img_by_lbl(self, lbl):
-        for i in range(len(self.labels)):
-            if self.labels[i] == lbl:
-                return self.__getitem__(i)
-        return None
+        # First image of lbl
+        indices = self.lbl_index[lbl]
+        if len(indices) == 0:
+            return None
+        return self.__getitem__(indices[0])
 
     def __getitem__(self, index):
         path = self.paths[index]
         lbl = self.labels[index]
-        img = self.load_img(path)
+        if self.cache is not None:
+            img = self.cache[index]
+            if self.transform is not None:
+                img = self.transform(img)
+        else:
+            img = self.load_img(path)
 
         return img, lbl, path
 
@@ -121,9 +140,17 @@ class MyersJiggins(Dataset):
         self.labels = []
         for cname in cnames:
             self.labels.append(self.name_lbl_map[cname])
+        self.lbl_index = LabelIndex.build(self.labels)
 
         self.num_classes = len(unique_cnames)
 
+        # Opt in with CACHE_RESOLUTION (and optionally CACHE_DIR) in the options
+        self.cache = None
+        cache_resolution = getattr(options, "CACHE_RESOLUTION", None)
+        if cache_resolution is not None:
+            self.cache = ImageCache.load_or_build(options.DATASET, self.paths, self.labels, cache_resolution, \
+                                                  cache_dir=getattr(options, "CACHE_DIR", IMAGE_CACHE_DIR), extra={"train" : train, "split" : options.DATA_TO_TRAIN, "wing" : options.WING_TYPE})
+
     def load_img(self, path):
         img = Image.open(path)
         if self.transform is not None:
@@ -135,15 +162,21 @@ class MyersJiggins(Dataset):
         return self.lbl_map[lbl]
     
     def get_img_by_lbl(self, lbl):
-        for i in range(len(self.labels)):
-            if self.labels[i] == lbl:
-                return self.__getitem__(i)
-        return None
+        # First image of lbl
+        indices = self.lbl_index[lbl]
+        if len(indices) == 0:
+            return None
+        return self.__getitem__(indices[0])
 
     def __getitem__(self, index):
         path = self.paths[index]
         lbl = self.labels[index]
-        img = self.load_img(path)
+        if self.cache is not None:
+            img = self.cache[index]
+            if self.transform is not None:
+                img = self.transform(img)
+        else:
+            img = self.load_img(path)
 
         return img, lbl, path
 
@@ -15,7 +15,7 @@ from options import load_config
 from datasets import CuthillDataset
 from models import Encoder, Decoder, VGG_Classifier, VGG_Encoder, VGG_Decoder
 from tools import tensor_to_numpy_img
-from loss.lpips.lpips import LPIPS
+from loss.lpips.lpips import get_lpips
 
 
 
@@ -175,7 +175,7 @@ for img_num, (img, lbl, path) in enumerate(dloader):
 
     """
     z = z.clone().requires_grad_(True)
-    lpips_loss_fn = LPIPS()
+    lpips_loss_fn = get_lpips()
     l1_loss_fn = torch.nn.L1Loss()
     optimizer = torch.optim.Adam([z], lr=args.lr)
     for i in range(args.recon_iterations):
@@ -0,0 +1,38 @@
+import numpy as np
+
+# Per-class index of a dataset's label array: the dataset indices stably
+# sorted by label, plus the offset of every class in that order, so the
+# indices of a class are one slice, in dataset order.
+#
+# Trimmed copy of LabelIndex from src/class_cvae/label_index.py, which is the
+# reference (with saving / loading and the batch samplers). The source roots
+# run as separate scripts with flat imports and can't import each other, so a
+# change to LabelIndex there has to be made here too.
+
+class LabelIndex:
+    def __init__(self, order, classes, offsets):
+        self.order = order
+        self.classes = classes
+        self.offsets = offsets
+        self.slots = {int(lbl) : i for i, lbl in enumerate(classes)}
+
+    @staticmethod
+    def build(labels):
+        labels = np.asarray(labels).reshape(-1)
+        order = np.argsort(labels, kind="stable")
+        classes, counts = np.unique(labels, return_counts=True)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return LabelIndex(order, classes, offsets)
+
+    def __getitem__(self, lbl):
+        # Dataset indices of label lbl (int, numpy or 1 element tensor), in dataset order
+        slot = self.slots.get(int(lbl))
+        if slot is None:
+            return self.order[:0]
+        return self.order[self.offsets[slot]:self.offsets[slot+1]]
+
+    def __contains__(self, lbl):
+        return int(lbl) in self.slots
+
+    def __len__(self):
+        return len(self.classes)
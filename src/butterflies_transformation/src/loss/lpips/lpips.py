@@ -12,28 +12,75 @@ class LPIPS(nn.Module):
         net_type (str): the network type to compare the features:
                         'alex' | 'squeeze' | 'vgg'. Default: 'alex'.
         version (str): the version of LPIPS. Default: 0.1.
+        half (bool): run the frozen feature network in float16. Default: False.
+        channels_last (bool): run the feature network in channels-last
+                              memory format. Default: False.
     """
-    def __init__(self, net_type: str = 'vgg', version: str = '0.1', cpu=False):
+    def __init__(self, net_type: str = 'vgg', version: str = '0.1', cpu=False, device = None,
+                 half: bool = False, channels_last: bool = False):
 
         assert version in ['0.1'], 'v0.1 is only supported now'
 
         super(LPIPS, self).__init__()
 
         # pretrained network
-        self.net = get_network(net_type)
-        if not cpu:
-            self.net = self.net.cuda()
+
+        if device is None:
+            device = "cpu" if cpu or not torch.cuda.is_available() else "cuda"
+
+        self.half = half
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+        self.net = get_network(net_type).to(device)
+        if half:
+            self.net = self.net.half()
+        self.net = self.net.to(memory_format=self.memory_format)
 
         # linear layers
-        self.lin = LinLayers(self.net.n_channels_list)
-        if not cpu:
-            self.lin = self.lin.cuda()
+        self.lin = LinLayers(self.net.n_channels_list).to(device)
         self.lin.load_state_dict(get_state_dict(net_type, version))
 
-    def forward(self, x: torch.Tensor, y: torch.Tensor):
-        feat_x, feat_y = self.net(x), self.net(y)
+        self.eval()
+
+    def train(self, mode: bool = True):
+        # The feature network and linear layers are frozen, keep them in eval mode
+        return super(LPIPS, self).train(False)
+
+    def features(self, x: torch.Tensor):
+        if self.half:
+            x = x.half()
+        feats = self.net(x.contiguous(memory_format=self.memory_format))
+        return [f.float() for f in feats]
+
+    def distance(self, x: torch.Tensor, y: torch.Tensor):
+        # Per-sample distances [N], one pass through the network for both inputs
+        feats = self.features(torch.cat((x, y), 0))
 
-        diff = [(fx - fy) ** 2 for fx, fy in zip(feat_x, feat_y)]
-        res = [l(d).mean((2, 3), True) for d, l in zip(diff, self.lin)]
+        diff = [(fx - fy) ** 2 for fx, fy in (f.chunk(2, 0) for f in feats)]
+        res = [l(d).mean((2, 3)) for d, l in zip(diff, self.lin)]
 
-        return torch.sum(torch.cat(res, 0)) / x.shape[0]
+        return torch.cat(res, 1).sum(1)
+
+    def forward(self, x: torch.Tensor, y: torch.Tensor, reduction: str = 'mean'):
+        dist = self.distance(x, y)
+        if reduction == 'none':
+            return dist
+        if reduction == 'sum':
+            return dist.sum()
+        return dist.sum() / x.shape[0]
+
+
+_shared = {}
+
+def get_lpips(net_type: str = 'vgg', version: str = '0.1', device = None,
+              half: bool = False, channels_last: bool = False):
+    r"""Returns the process wide LPIPS criterion for these settings, building
+    it on first use. Trainers, evaluators and scripts share the same instance
+    instead of reloading the pretrained network.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    key = (net_type, version, str(torch.device(device)), half, channels_last)
+    if key not in _shared:
+        _shared[key] = LPIPS(net_type, version, device=device, half=half, channels_last=channels_last)
+    return _shared[key]
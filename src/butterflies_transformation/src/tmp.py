@@ -8,7 +8,7 @@ from torchvision.transforms import ToTensor, Resize, Compose
 from options import load_config
 from datasets import CuthillDataset, MyersJiggins
 from models import VGG_VEncoder, Decoder, VGG_Decoder
-from loss.lpips.lpips import LPIPS
+from loss.lpips.lpips import get_lpips
 from tools import show_reconstruction_images, init_weights
 
 
@@ -60,7 +60,7 @@ weights = None
 encoder = encoder.cuda()
 decoder = decoder.cuda()
 
-lpips_loss_fn = LPIPS()
+lpips_loss_fn = get_lpips()
 l1_loss_fn = torch.nn.L1Loss()
 normal_loss_fn = lambda mu, sigma: (sigma**2 + mu**2 - torch.log(sigma) - 0.5).sum(1).mean()
 
@@ -9,7 +9,7 @@ from torchvision.transforms import ToTensor
 from options import load_config
 from datasets import CuthillDataset
 from models import VGG_Encoder
-from loss.lpips.lpips import LPIPS
+from loss.lpips.lpips import get_lpips
 from tools import show_reconstruction_images, init_weights
 
 sys.path.append("externals/stylegan3")
@@ -59,7 +59,7 @@ if args.encoder_resume is not None:
 encoder = encoder.cuda()
 decoder = decoder.cuda()
 
-lpips_loss_fn = LPIPS()
+lpips_loss_fn = get_lpips()
 l1_loss_fn = torch.nn.L1Loss()
 
 def train(epoch, optimizer):
@@ -21,7 +21,7 @@ import os
 from tqdm import tqdm
 
 import torch
-import torch.nn as nn
+from torch.utils.data import DataLoader
 
 from torchvision.datasets import MNIST
 import torchvision.transforms as T
@@ -32,7 +32,10 @@ import matplotlib.pyplot as plt
 from logger import Logger
 from models import IIN_AE_Wrapper, ResNet50
 from options import MNIST_CF_Analysis_Configs
-from utils import create_z_from_label, create_graph_from_tensor, fig_to_numpy, tensor_to_numpy_img, create_diff_img, set_seed
+from utils import create_z_from_label, create_graph_from_tensor, fig_to_numpy, tensor_to_numpy_img, create_diff_img, set_seed, \
+                  get_device, cpu_setup, autocast
+from counterfactual_engine import optimize_deltas
+from label_index import LabelIndex, ClassBatchSampler
 
 def load_models(configs):
     num_att_vars = len(create_z_from_label(torch.tensor([0]))[0])
@@ -44,8 +47,8 @@ def load_models(configs):
     iin_ae = IIN_AE_Wrapper(configs)
     img_classifier = ResNet50(num_classes=10, img_ch=configs.in_channels)
 
-    iin_ae.load_state_dict(torch.load(configs.ae))
-    img_classifier.load_state_dict(torch.load(configs.img_classifier))
+    iin_ae.load_state_dict(torch.load(configs.ae, map_location="cpu"))
+    img_classifier.load_state_dict(torch.load(configs.img_classifier, map_location="cpu"))
 
     return iin_ae, img_classifier
 
@@ -62,107 +65,91 @@ def load_data(configs):
 
     return test_dset
 
-def create_counterfactual(ae, img_classifier, dset, logger, src, tgt, configs):
-    ae = ae.cuda()
-    img_classifier = img_classifier.cuda()
+def create_counterfactuals(ae, img_classifier, dset, logger, pairs, configs, lbl_index=None):
+    # All (src, tgt) pairs are optimized together as one batch
+    device = get_device(configs.device)
+    memory_format = torch.channels_last if configs.channels_last else torch.contiguous_format
+    ae = ae.to(device)
+    img_classifier = img_classifier.to(device, memory_format=memory_format)
     ae.eval()
     img_classifier.eval()
 
-    # Obtain representative Z
-    src_idx = []
-    for i, (img, lbl) in enumerate(dset):
-        if lbl != src: continue
-        src_idx.append(i)
+    if lbl_index is None:
+        lbl_index = LabelIndex.load_or_build(dset)
 
-    org_img = None
-    org_z = None
+    # Obtain representative Z
+    org_imgs = []
+    org_zs = []
     with torch.no_grad():
-        if configs.start_option == "random":
-            i = random.choice(src_idx)
-            org_img = test_dset[i][0].unsqueeze(0)
-            org_z = ae.encode(org_img.cuda())
-        elif configs.start_option == "mean":
-            for i in src_idx:
-                img = test_dset[i][0].unsqueeze(0)
-                z = ae.encode(img.cuda())
-                if org_z is None:
-                    org_z = z
-                else:
-                    org_z += z
-            org_z /= len(src_idx)
-
-
-    src_lbl = torch.tensor([src]).cuda()
-    tgt_lbl = torch.tensor([tgt]).cuda()
-    
-    # Setup Optimization
-    sm = nn.Softmax(dim=1)
-    sigmoid = nn.Sigmoid()
-
-    l1_loss_fn = nn.L1Loss()
-    cel_loss_fn = nn.CrossEntropyLoss()
-
-    z_chg = torch.zeros(configs.num_attributes).cuda()
-    z_chg = z_chg.requires_grad_(True)
-    
-    params = [z_chg]
-    optimizer = torch.optim.Adam(params, lr=configs.lr)
-
+        for src, _ in pairs:
+            src_idx = lbl_index[src]
+            if configs.start_option == "random":
+                i = random.choice(src_idx)
+                org_img = dset[i][0].unsqueeze(0)
+                org_imgs.append(org_img)
+                org_zs.append(ae.encode(org_img.to(device)))
+            elif configs.start_option == "mean":
+                org_imgs.append(None)
+                org_z = None
+                for imgs, _ in DataLoader(dset, batch_sampler=ClassBatchSampler(lbl_index, [src], 256)):
+                    z = ae.encode(imgs.to(device)).sum(0, keepdim=True)
+                    org_z = z if org_z is None else org_z + z
+                org_zs.append(org_z / len(src_idx))
+        org_z = torch.cat(org_zs)
+        recon_imgs = ae.decode(org_z)
+
+    tgt_lbls = torch.tensor([tgt for _, tgt in pairs], device=device)
+
+    # Optional bfloat16 decode / classify, the deltas and losses stay in float32
+    def decode_fn(z):
+        with autocast(configs.bf16, device):
+            return ae.decode(z).float()
+
+    def classify_fn(x):
+        with autocast(configs.bf16, device):
+            return img_classifier(resize(x).contiguous(memory_format=memory_format)).float()
+
+    results = optimize_deltas(
+        org_z,
+        tgt_lbls,
+        configs.num_attributes,
+        decode_fn,
+        classify_fn,
+        lr              = configs.lr,
+        min_chg_lambda  = configs.min_chg_lambda,
+        cls_lambda      = configs.cls_lambda,
+        stop_option     = configs.stop_option,
+        num_iters       = configs.num_iters,
+        max_iters       = configs.max_iters,
+        conf_thresh     = configs.conf_thresh,
+        log_fn          = logger.log
+    )
+
+    outputs = []
     with torch.no_grad():
-        recon_img = ae.decode(org_z)
-
-    loop = True
-    cur_iter = 0
-    while loop:
-        if configs.stop_option == "iters" and cur_iter >= configs.num_iters: break
-        if cur_iter >= configs.max_iters: break
-        cur_iter += 1
-
-        z_edit = org_z.clone()
-        z_edit[:, :configs.num_attributes] += z_chg.unsqueeze(0)
-        min_chg_loss = l1_loss_fn(z_chg, torch.zeros_like(z_chg).cuda()) * configs.min_chg_lambda
+        for row, (src, tgt) in enumerate(pairs):
+            src_conf = results["confs"][row, src].item()
+            tgt_conf = results["confs"][row, tgt].item()
+            logger.log(f"({src}) => ({tgt}) || Iterations: {results['iters'][row].item()} | Source Conf: {src_conf} | Target Conf: {tgt_conf}")
 
-        cf_example = ae.decode(z_edit)
+            # Original, Reconstruction, Counterfactual image, delta z, difference highlights
+            org_img = org_imgs[row]
+            if org_img is not None:
+                org_img = tensor_to_numpy_img(org_img)[0][:, :, 0]
+            recon_img = tensor_to_numpy_img(recon_imgs[row:row+1])[0][:, :, 0]
+            cf_example = tensor_to_numpy_img(results["cf_examples"][row:row+1])[0][:, :, 0]
 
-        out = img_classifier(resize(cf_example))
+            delta_z_fig = create_graph_from_tensor(results["z_edit"][row], configs.font_size)
+            delta_z = fig_to_numpy(delta_z_fig)
+            plt.close()
 
-        cls_loss = cel_loss_fn(out, tgt_lbl) * configs.cls_lambda
-        loss = min_chg_loss + cls_loss
+            diff_img = create_diff_img(recon_img, cf_example)
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+            outputs.append(CounterfactualOutput(org_img, recon_img, cf_example, delta_z, diff_img, src_conf, tgt_conf))
+    return outputs
 
-
-        confs = sm(out)[0]
-        src_conf = confs[src_lbl[0]].item()
-        tgt_conf = confs[tgt_lbl[0]].item()
-        _, pred = torch.max(out, 1)
-        pred = pred[0].item()
-
-        
-        out_str = f"({src}) => ({tgt}) || Iteration: {cur_iter+1} | Loss: {loss.item()} | Min Chg Loss: {min_chg_loss.item()} | Class Loss: {cls_loss.item()} | Source Conf: {src_conf} | Target Conf: {tgt_conf}"
-        if cur_iter % 1000 == 0:
-            logger.log(out_str)
-
-        if configs.stop_option == "flip" and pred == tgt: break
-        if configs.stop_option == "conf" and tgt >= configs.conf_thresh: break
-    
-    logger.log(out_str)
-    with torch.no_grad():
-        # Original, Reconstruction, Counterfactual image, delta z, difference highlights
-        if org_img is not None:
-            org_img = tensor_to_numpy_img(org_img)[0][:, :, 0]
-        recon_img = tensor_to_numpy_img(recon_img)[0][:, :, 0]
-        cf_example = tensor_to_numpy_img(cf_example)[0][:, :, 0]
-
-        delta_z_fig = create_graph_from_tensor(z_edit[0], configs.font_size)
-        delta_z = fig_to_numpy(delta_z_fig)
-        plt.close()
-
-        diff_img = create_diff_img(recon_img, cf_example)
-
-        return CounterfactualOutput(org_img, recon_img, cf_example, delta_z, diff_img, src_conf, tgt_conf)
+def create_counterfactual(ae, img_classifier, dset, logger, src, tgt, configs):
+    return create_counterfactuals(ae, img_classifier, dset, logger, [(src, tgt)], configs)[0]
 
 class CounterfactualOutput():
     def __init__(self, org_img, recon_img, cf_example, delta_z, diff_img, cf_src_conf, cf_tgt_conf):
@@ -196,6 +183,7 @@ if __name__ == "__main__":
         configs.num_attributes = configs.num_features
     
     set_seed(configs.seed)
+    cpu_setup(configs.threads)
         
     ae, img_classifier = load_models(configs)
     test_dset = load_data(configs)
@@ -204,12 +192,9 @@ if __name__ == "__main__":
     results_dir = os.path.join(logger.get_path(), "results")
     os.makedirs(results_dir, exist_ok=True)
 
-    with tqdm(total=100) as pbar:
-        for src in range(10):
-            for tgt in range(10):
-                if src == tgt: continue
-                cf_output = create_counterfactual(ae, img_classifier, test_dset, logger, src, tgt, configs)
-                save_dir = os.path.join(results_dir, f"{src}_to_{tgt}")
-                os.makedirs(save_dir, exist_ok=True)
-                save_results(save_dir, cf_output)
-                pbar.update(1)
\ No newline at end of file
+    pairs = [(src, tgt) for src in range(10) for tgt in range(10) if src != tgt]
+    cf_outputs = create_counterfactuals(ae, img_classifier, test_dset, logger, pairs, configs)
+    for (src, tgt), cf_output in tqdm(zip(pairs, cf_outputs), total=len(pairs), desc="Saving"):
+        save_dir = os.path.join(results_dir, f"{src}_to_{tgt}")
+        os.makedirs(save_dir, exist_ok=True)
+        save_results(save_dir, cf_output)
@@ -0,0 +1,80 @@
+import os
+
+import torch
+import numpy as np
+
+# Class label -> attribute code lookup. The code table is built once per
+# process (and cached on disk), kept on every device it is used from, and a
+# batch of labels is answered with a single index into the table.
+#
+# Encodings of per-class attribute values:
+#   binary      1 where the value is >= threshold
+#   continuous  the values scaled to [0, 1]
+#   topk        1 for the k largest values of each class
+
+ENCODINGS = ["binary", "continuous", "topk"]
+CUB_ATTRIBUTES = "attributes/class_attribute_labels_continuous.txt"
+ATTRIBUTE_CACHE_DIR = "cache/attribute_codes"
+
+class AttributeCodes:
+    def __init__(self, table):
+        self.table = torch.as_tensor(table)
+        self.device_tables = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def num_atts(self):
+        return self.table.shape[1]
+
+    def on(self, device):
+        device = torch.device(device)
+        if device not in self.device_tables:
+            self.device_tables[device] = self.table.to(device)
+        return self.device_tables[device]
+
+    def __call__(self, lbls):
+        lbls = torch.as_tensor(lbls)
+        device = lbls.device
+        if device.type == "cpu" and torch.cuda.is_available():
+            device = torch.device("cuda")
+        return self.on(device)[lbls.to(device).long()]
+
+def encode(values, encoding="binary", threshold=50, k=10, scale=100):
+    assert encoding in ENCODINGS, f"Invalid encoding: {encoding}"
+    if encoding == "continuous":
+        return (values / scale).astype(np.float32)
+    if encoding == "topk":
+        codes = np.zeros(values.shape, dtype=np.uint8)
+        top = np.argpartition(-values, k - 1, axis=1)[:, :k]
+        np.put_along_axis(codes, top, 1, axis=1)
+        return codes
+    return (values >= threshold).astype(np.uint8)
+
+_loaded = {}
+
+def load_cub_codes(root_dset, encoding="binary", threshold=50, k=10, cache_dir=ATTRIBUTE_CACHE_DIR):
+    key = (os.path.abspath(root_dset), encoding, threshold, k)
+    if key in _loaded:
+        return _loaded[key]
+
+    src = os.path.join(root_dset, CUB_ATTRIBUTES)
+    name = f"cub_{encoding}" + (f"_{threshold}" if encoding == "binary" else "") + (f"_{k}" if encoding == "topk" else "")
+    path = os.path.join(cache_dir, f"{name}.npz")
+    table = None
+    if os.path.exists(path):
+        data = np.load(path)
+        if str(data["src"]) == os.path.abspath(src) and float(data["mtime"]) == os.path.getmtime(src):
+            table = data["codes"]
+    if table is None:
+        values = np.loadtxt(src, dtype=np.float32, ndmin=2)
+        table = encode(values, encoding=encoding, threshold=threshold, k=k)
+        # Every DDP rank may get here, write to a private file and move it in place
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = os.path.join(cache_dir, f"{name}.{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, codes=table, src=os.path.abspath(src), mtime=os.path.getmtime(src))
+        os.replace(tmp_path, path)
+
+    _loaded[key] = AttributeCodes(table)
+    return _loaded[key]
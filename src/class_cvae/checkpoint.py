@@ -0,0 +1,110 @@
+import os
+import json
+import shutil
+import threading
+
+import torch
+
+# Full training checkpoints written in the background. save() copies the state
+# to the CPU (the only part the training loop waits for) and hands the copy to
+# a writer thread, which writes it atomically (tmp file + rename) and updates
+# the index. The last `keep` checkpoints are kept, plus best.pt, the one with
+# the best metric so far. Writes go out one at a time, a save waits for the
+# previous write to finish.
+
+INDEX_FILE = "checkpoints.json"
+
+def to_cpu(x):
+    # Detached CPU copies of every tensor in a nested dict / list
+    if torch.is_tensor(x):
+        return x.detach().to("cpu", copy=True)
+    if isinstance(x, dict):
+        return {k : to_cpu(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_cpu(v) for v in x)
+    return x
+
+def atomic_save(obj, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+class CheckpointManager:
+    def __init__(self, path, keep=3):
+        self.path = path
+        self.keep = keep
+        self.thread = None
+        self.error = None
+        os.makedirs(path, exist_ok=True)
+
+    def read_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {"checkpoints" : [], "best" : None}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def write_index(self, index):
+        tmp_path = os.path.join(self.path, f"{INDEX_FILE}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def save(self, state, name, metric=None, exports={}):
+        """
+        state: nested dict of tensors and python values.
+        name: file name of this checkpoint (e.g. from epoch and step).
+        metric: higher is better, decides best.pt.
+        exports: {path : key}, state[key] is also written to path (e.g. the
+        plain ae.pt weights other scripts load).
+        """
+        self.wait()
+        snapshot = to_cpu(state)
+        self.thread = threading.Thread(target=self.write, args=(snapshot, name, metric, exports))
+        self.thread.start()
+
+    def write(self, snapshot, name, metric, exports):
+        try:
+            path = os.path.join(self.path, name)
+            atomic_save(snapshot, path)
+            for export_path, key in exports.items():
+                atomic_save(snapshot[key], export_path)
+
+            index = self.read_index()
+            index["checkpoints"] = [ckpt for ckpt in index["checkpoints"] if ckpt != name] + [name]
+            if metric is not None and (index["best"] is None or metric > index["best"]["metric"]):
+                tmp_path = os.path.join(self.path, f"best.pt.{os.getpid()}.tmp")
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, os.path.join(self.path, "best.pt"))
+                index["best"] = {"checkpoint" : name, "metric" : metric}
+            stale = index["checkpoints"][:-self.keep] if self.keep > 0 else []
+            index["checkpoints"] = index["checkpoints"][len(stale):]
+            self.write_index(index)
+            # Only removed once the index no longer points at them
+            for old in stale:
+                if os.path.exists(os.path.join(self.path, old)):
+                    os.remove(os.path.join(self.path, old))
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        # Blocks until the pending write is on disk, and raises its error if it failed
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def latest(self):
+        # Path of the newest complete checkpoint, None if there is none
+        checkpoints = self.read_index()["checkpoints"]
+        if len(checkpoints) == 0:
+            return None
+        return os.path.join(self.path, checkpoints[-1])
+
+    def load_latest(self, map_location="cpu"):
+        path = self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location=map_location, weights_only=False)
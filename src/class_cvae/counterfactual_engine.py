@@ -0,0 +1,92 @@
+import torch
+import torch.nn as nn
+
+"""
+Batched latent counterfactuals. Every row is its own (start z, target label)
+problem with its own delta on the first num_attributes latent dimensions.
+The loss is a sum of per-row losses and Adam is elementwise, so each row
+follows the same trajectory it would follow when optimized alone.
+
+Stop criteria are applied per row:
+    iters - after num_iters iterations
+    flip  - the moment the prediction is the target
+    conf  - the moment the target confidence is >= conf_thresh
+(and always after max_iters). A stopped row is no longer decoded and its
+outputs are the ones from its last iteration.
+"""
+
+def optimize_deltas(z, tgt_lbls, num_attributes, decode_fn, classify_fn, sample_fn=None, clamp=None, \
+                    lr=0.001, min_chg_lambda=1.0, cls_lambda=1.0, stop_option="iters", num_iters=500, \
+                    max_iters=10000, conf_thresh=0.9, log_fn=None, log_every=1000):
+    assert stop_option in ["iters", "flip", "conf"], f"Invalid stop option: {stop_option}"
+    device = z.device
+    num_rows = len(z)
+    tgt_lbls = tgt_lbls.to(device)
+    limit = min(num_iters, max_iters) if stop_option == "iters" else max_iters
+
+    z_chg = torch.zeros((num_rows, num_attributes), device=device).requires_grad_(True)
+    optimizer = torch.optim.Adam([z_chg], lr=lr)
+    sm = nn.Softmax(dim=1)
+
+    active = torch.ones(num_rows, dtype=torch.bool)
+    out = {
+        "iters" : torch.zeros(num_rows, dtype=torch.long),
+        "z_chg" : torch.zeros((num_rows, num_attributes), device=device)
+    }
+
+    for cur_iter in range(1, limit + 1):
+        rows = active.nonzero()[:, 0].to(device)
+
+        # z is resampled every iteration when a sample_fn is given
+        if sample_fn is not None:
+            with torch.no_grad():
+                z_rows = sample_fn(rows)
+        else:
+            z_rows = z[rows]
+        row_chg = z_chg[rows]
+        z_edit = z_rows.clone()
+        z_edit.view(len(rows), -1)[:, :num_attributes] += row_chg
+        if clamp is not None:
+            z_edit = torch.clamp(z_edit, *clamp)
+
+        cf_examples = decode_fn(z_edit)
+        logits = classify_fn(cf_examples)
+
+        min_chg_loss = row_chg.abs().mean(1) * min_chg_lambda
+        cls_loss = nn.functional.cross_entropy(logits, tgt_lbls[rows], reduction='none') * cls_lambda
+        loss = (min_chg_loss + cls_loss).sum()
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        # Keep every active row's latest outputs, a row's last write is its result
+        with torch.no_grad():
+            confs = sm(logits)
+            if cur_iter == 1:
+                out["org_confs"] = confs.clone()
+                out["confs"] = torch.zeros_like(confs)
+                out["z_edit"] = torch.zeros((num_rows,) + tuple(z_edit.shape[1:]), device=device)
+                out["cf_examples"] = torch.zeros((num_rows,) + tuple(cf_examples.shape[1:]), device=device)
+            out["confs"][rows] = confs
+            out["z_edit"][rows] = z_edit.detach()
+            out["cf_examples"][rows] = cf_examples.detach()
+            out["z_chg"][rows] = row_chg.detach()
+            out["iters"][active] = cur_iter
+
+            done = torch.zeros(len(rows), dtype=torch.bool, device=device)
+            tgt_conf = confs.gather(1, tgt_lbls[rows].unsqueeze(1))[:, 0]
+            if stop_option == "flip":
+                done = logits.argmax(1) == tgt_lbls[rows]
+            elif stop_option == "conf":
+                done = tgt_conf >= conf_thresh
+
+        if log_fn is not None and cur_iter % log_every == 0:
+            log_fn(f"Iteration: {cur_iter} | Active: {len(rows)}/{num_rows} | Loss: {loss.item() / len(rows)} | " \
+                   + f"Min Chg Loss: {min_chg_loss.mean().item()} | Class Loss: {cls_loss.mean().item()} | Target Conf: {tgt_conf.mean().item()}")
+
+        active[rows[done].cpu()] = False
+        if not active.any():
+            break
+
+    return out
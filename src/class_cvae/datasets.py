@@ -2,13 +2,19 @@ import os
 
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.distributed import DistributedSampler
 
 from PIL import Image
 
+from image_cache import ImageCache
+
+IMAGE_CACHE_DIR = "cache/images"
+
 class CUB(Dataset):
-    def __init__(self, root, train=True, bbox=False, transform=None):
+    def __init__(self, root, train=True, bbox=False, transform=None, cache_resolution=None, cache_dir=IMAGE_CACHE_DIR):
         super().__init__()
 
+        self.root = root
         self.transform=transform
         self.use_bbox = bbox
 
@@ -28,30 +34,77 @@ class CUB(Dataset):
 
         self.img_paths = []
         self.img_lbls = []
+        self.path_idx = {}
         with open(os.path.join(root, "images.txt")) as f:
             for line in f.readlines():
                 id, path = line.split()
                 if id not in ids: continue
                 lbl = int(path.split(".")[0]) - 1
+                self.path_idx[os.path.join(root, "images", path)] = len(self.img_paths)
                 self.img_paths.append(os.path.join(root, "images", path))
                 self.img_lbls.append(lbl)
 
+        # Cached images are already cropped to the bounding box and resized
+        self.cache = None
+        if cache_resolution is not None:
+            self.cache = ImageCache.load_or_build(root, self.img_paths, self.img_lbls, cache_resolution, cache_dir=cache_dir, \
+                                                  extra={"train" : train, "bbox" : bbox}, loader=self.load_img)
+
     def __len__(self):
         return len(self.img_paths)
+
+    def load_img(self, path):
+        img = Image.open(path).convert('RGB')
+        if self.use_bbox:
+            img = img.crop(self.bboxs[self.path_idx[path]])
+        return img
     
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        path = self.img_paths[idx]
         lbl = self.img_lbls[idx]
 
-        img = Image.open(path).convert('RGB')
-        if self.use_bbox:
-            img = img.crop(self.bboxs[idx])
+        if self.cache is not None:
+            img = self.cache[idx]
+        else:
+            img = self.load_img(self.img_paths[idx])
         if self.transform:
             img = self.transform(img)
 
         return img, lbl
 
+class EvalDistributedSampler(DistributedSampler):
+    # DistributedSampler for evaluation: in order, and without the padding
+    # samples, so the shards of all ranks cover the dataset exactly once
+    # (their lengths differ by at most one)
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
 
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
+
+class ResumableDistributedSampler(DistributedSampler):
+    # DistributedSampler that can start part way into an epoch, for resuming
+    # from a mid-epoch checkpoint. The order is still fixed by the seed and
+    # the epoch, set_start(n) drops the first n samples of this rank.
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed, drop_last=drop_last)
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start = 0
+
+    def set_start(self, start):
+        # Only applies to the current epoch, set_epoch resets it
+        self.start = start
+
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start, 0)
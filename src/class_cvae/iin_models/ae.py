@@ -331,16 +331,16 @@ class Distribution(object):
         std = torch.exp(0.5*self.logvar)
         var = torch.exp(self.logvar)
         if self.deterministic:
-            self.var = self.std = torch.zeros_like(self.mean).to(self.mean.get_device())
+            self.var = self.std = torch.zeros_like(self.mean).to(self.mean.device)
         else:
             self.var = var
             self.std = std
     def sample(self):
         if self.num_att_vars is not None:
             x_att = self.mean[:, :self.num_att_vars]
-            x_var = self.mean[:, self.num_att_vars:] + self.std[:, self.num_att_vars:]*torch.randn(self.mean[:, self.num_att_vars:].shape).to(self.mean.get_device())
+            x_var = self.mean[:, self.num_att_vars:] + self.std[:, self.num_att_vars:]*torch.randn(self.mean[:, self.num_att_vars:].shape).to(self.mean.device)
             return torch.cat((x_att, x_var), 1)
-        x = self.mean + self.std*torch.randn(self.mean.shape).to(self.mean.get_device())
+        x = self.mean + self.std*torch.randn(self.mean.shape).to(self.mean.device)
         return x
 
     def kl(self, other=None):
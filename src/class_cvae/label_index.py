@@ -0,0 +1,169 @@
+import os
+import hashlib
+
+import numpy as np
+from torch.utils.data import Sampler, Subset
+
+# Per-class index of a dataset. Finding N images of a label costs N image
+# decodes instead of a pass over the whole dataset. The index is built from
+# the dataset's label array (never from its images): the dataset indices
+# stably sorted by label, plus the offset of every class in that order, so the
+# indices of a class are one slice, in dataset order. It is saved next to the
+# dataset (<root>/label_index/<labels hash>.npz) when the dataset has a root.
+#
+# This is the reference copy. src/butterflies_transformation/src/label_index.py
+# carries a trimmed copy of LabelIndex, keep the two in step.
+
+INDEX_DIR = "label_index"
+LABEL_ATTRS = ["targets", "img_lbls", "labels"]
+
+def dataset_labels(dset):
+    # Label array of dset ([N] ints), read without loading any image
+    if isinstance(dset, Subset):
+        return dataset_labels(dset.dataset)[np.asarray(dset.indices)]
+    for attr in LABEL_ATTRS:
+        if hasattr(dset, attr):
+            return np.asarray(getattr(dset, attr)).reshape(-1)
+    raise ValueError(f"{type(dset).__name__} has no label array (one of {', '.join(LABEL_ATTRS)})")
+
+def labels_key(labels):
+    h = hashlib.sha1()
+    h.update(str(labels.dtype).encode())
+    h.update(np.ascontiguousarray(labels).tobytes())
+    return h.hexdigest()[:16]
+
+class LabelIndex:
+    def __init__(self, order, classes, offsets):
+        self.order = order
+        self.classes = classes
+        self.offsets = offsets
+        self.slots = {int(lbl) : i for i, lbl in enumerate(classes)}
+
+    @staticmethod
+    def build(labels):
+        labels = np.asarray(labels).reshape(-1)
+        order = np.argsort(labels, kind="stable")
+        classes, counts = np.unique(labels, return_counts=True)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return LabelIndex(order, classes, offsets)
+
+    def __getitem__(self, lbl):
+        # Dataset indices of label lbl (int, numpy or 1 element tensor), in dataset order
+        slot = self.slots.get(int(lbl))
+        if slot is None:
+            return self.order[:0]
+        return self.order[self.offsets[slot]:self.offsets[slot+1]]
+
+    def __contains__(self, lbl):
+        return int(lbl) in self.slots
+
+    def __len__(self):
+        return len(self.classes)
+
+    def counts(self):
+        return dict(zip(self.slots.keys(), np.diff(self.offsets).tolist()))
+
+    def take(self, lbl, n, rng=None):
+        # The first n indices of lbl, or n random ones when rng (a numpy Generator) is given
+        indices = self[lbl]
+        if rng is not None:
+            return rng.choice(indices, size=min(n, len(indices)), replace=False)
+        return indices[:n]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, order=self.order, classes=self.classes, offsets=self.offsets)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return LabelIndex(data["order"], data["classes"], data["offsets"])
+
+    @staticmethod
+    def load_or_build(dset, root=None):
+        """
+        root: where the index is kept, defaults to dset.root. The file name is
+        the hash of the labels, so a changed label array gets a new index.
+        """
+        labels = dataset_labels(dset)
+        if root is None:
+            root = getattr(dset, "root", None)
+        if root is None:
+            return LabelIndex.build(labels)
+
+        path = os.path.join(root, INDEX_DIR, f"{labels_key(labels)}.npz")
+        if os.path.exists(path):
+            return LabelIndex.load(path)
+        index = LabelIndex.build(labels)
+        try:
+            index.save(path)
+        except OSError:
+            pass # Read-only dataset directory, the index is rebuilt next time
+        return index
+
+class ClassBatchSampler(Sampler):
+    # Batches of a single class: all images of each label in lbls in turn (at
+    # most limit per label), in dataset order or shuffled (seed)
+    def __init__(self, index, lbls, batch_size, limit=None, shuffle=False, seed=0):
+        self.index = index
+        self.lbls = list(lbls)
+        self.batch_size = batch_size
+        self.limit = limit
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        for lbl in self.lbls:
+            indices = self.index[lbl]
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            indices = indices[:self.limit].tolist()
+            for start in range(0, len(indices), self.batch_size):
+                yield indices[start:start+self.batch_size]
+
+    def __len__(self):
+        sizes = [len(self.index[lbl][:self.limit]) for lbl in self.lbls]
+        return sum((size + self.batch_size - 1) // self.batch_size for size in sizes)
+
+class BalancedBatchSampler(Sampler):
+    # Class balanced batches: per_class random images of every label in lbls
+    # (default: all labels) per batch. Each label goes through its images in a
+    # new random order every pass, so small classes repeat before large ones
+    # do. One epoch is num_batches batches, by default enough for one pass
+    # over the largest class.
+    def __init__(self, index, per_class, lbls=None, num_batches=None, seed=0):
+        self.index = index
+        self.per_class = per_class
+        self.lbls = list(index.slots.keys()) if lbls is None else list(lbls)
+        assert all(len(index[lbl]) > 0 for lbl in self.lbls), "Every label needs at least one image"
+        if num_batches is None:
+            num_batches = (max(len(index[lbl]) for lbl in self.lbls) + per_class - 1) // per_class
+        self.num_batches = max(num_batches, 1)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        needed = self.num_batches * self.per_class
+        streams = []
+        for lbl in self.lbls:
+            indices = self.index[lbl]
+            passes = (needed + len(indices) - 1) // len(indices)
+            streams.append(np.concatenate([rng.permutation(indices) for _ in range(passes)])[:needed])
+        # [num_batches, labels * per_class]
+        batches = np.stack([s.reshape(self.num_batches, self.per_class) for s in streams], 1)
+        for batch in batches.reshape(self.num_batches, -1):
+            yield batch.tolist()
+
+    def __len__(self):
+        return self.num_batches
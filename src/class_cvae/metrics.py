@@ -0,0 +1,71 @@
+from time import perf_counter
+
+import torch
+import torch.distributed as dist
+
+# Training metrics that don't stall the device. Loss sums, correct counts and
+# totals are accumulated as tensors on the training device, so adding a value
+# never waits for the queued work. They are read back once per logging
+# interval: every value is stacked into one tensor, summed over the DDP ranks
+# with a single all_reduce (when a process group is running) and copied to the
+# host in one go.
+
+class Metrics:
+    def __init__(self, device, names=()):
+        """
+        names: the values every rank reports. Under DDP each rank has to
+        reduce the same names, so declare them all up front.
+        """
+        self.device = torch.device(device)
+        self.sums = {}
+        for name in names:
+            self.sums[name] = torch.zeros((), dtype=torch.float64, device=self.device)
+
+    def add(self, name, value):
+        # value: a tensor (summed, detached) or a python number
+        if name not in self.sums:
+            self.sums[name] = torch.zeros((), dtype=torch.float64, device=self.device)
+        if torch.is_tensor(value):
+            value = value.detach().sum()
+        self.sums[name] += value
+
+    def reduce(self):
+        # {name : float}, summed over all ranks
+        names = sorted(self.sums.keys())
+        if len(names) == 0:
+            return {}
+        values = torch.stack([self.sums[name] for name in names])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(values)
+        return dict(zip(names, values.cpu().tolist()))
+
+class StepTimer:
+    def __init__(self, device=None, sync=False):
+        """
+        Wall time of each phase of the training steps. mark(phase) charges the
+        time since the previous mark to phase. With sync=True the device is
+        synchronized at every mark, so queued GPU work is charged to the phase
+        that launched it (one sync per phase, only meant for profiling).
+        """
+        self.device = torch.device(device) if device is not None else None
+        self.sync = sync and self.device is not None and self.device.type == "cuda"
+        self.times = {}
+        self.steps = 0
+        self.last = None
+
+    def start(self):
+        self.last = perf_counter()
+
+    def mark(self, phase):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        now = perf_counter()
+        if len(self.times) == 0 or phase == next(iter(self.times)):
+            self.steps += 1
+        self.times[phase] = self.times.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def summary(self):
+        # Average milliseconds per step of each phase
+        steps = max(self.steps, 1)
+        return "Step Time (ms): " + " | ".join(f"{phase} {round(t / steps * 1000, 2)}" for phase, t in self.times.items())
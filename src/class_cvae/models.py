@@ -287,7 +287,7 @@ class Encoder(nn.Module):
         mu = self.linear_mean(x)
         std = self.linear_std(x)
 
-        z = mu + std * torch.normal(mean=0, std=1, size=std.shape).cuda()
+        z = mu + std * torch.normal(mean=0, std=1, size=std.shape, device=std.device)
 
         if self.use_sigmoid:
             z = self.sigmoid(z)
@@ -363,7 +363,7 @@ class HandCraftedMNISTDecoder(nn.Module):
 
     def forward(self, x):
         batch = len(x)
-        base = torch.zeros(batch, 1, 28, 28).cuda() # Blank Images
+        base = torch.zeros(batch, 1, 28, 28, device=x.device) # Blank Images
         base[:, 0, 2:4, 6:22] = x[:, 0].view(batch, 1).repeat(1, 2*16).view(batch, 2, 16) # Top Line
         base[:, 0, 13:15, 6:22] = x[:, 1].view(batch, 1).repeat(1, 2*16).view(batch, 2, 16) # Middle Line
         base[:, 0, 24:26, 6:22] = x[:, 2].view(batch, 1).repeat(1, 2*16).view(batch, 2, 16) # Bottom Line
@@ -422,4 +422,4 @@ class NLayerDiscriminator(nn.Module):
 
     def forward(self, input):
         """Standard forward."""
-        return self.main(input)
\ No newline at end of file
+        return self.main(input)
\ No newline at end of file
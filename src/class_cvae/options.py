@@ -32,6 +32,8 @@ class Configs:
         parser.add_argument('--exp_name', type=str, default="debug")
         parser.add_argument('--seed', type=int, default=2023)
         parser.add_argument('--configs', type=str, default=None)
+        parser.add_argument('--device', type=str, default=None) # cuda when available, else cpu
+        parser.add_argument('--threads', type=int, default=None) # intra-op threads on CPU
         self.add_arguments(parser)
 
         args = parser.parse_args()
@@ -57,7 +59,8 @@ class MNIST_Classifier_Configs(Configs):
 class CUB_VAEGAN_Configs(Configs):
     def add_arguments(self, parser):
         parser.add_argument('--use_bbox', action='store_true', default=False)
-        parser.add_argument('--continue_checkpoint', action='store_true', default=False)
+        parser.add_argument('--cache_images', action='store_true', default=False)
+        parser.add_argument('--continue_checkpoint', action='store_true', default=False) # resume exp_name from its latest full checkpoint (only the weights for runs without one)
         parser.add_argument('--no_scheduler', action='store_true', default=False)
         parser.add_argument('--img_classifier', type=str, default=None)
         parser.add_argument('--add_real_cls_vec', action='store_true', default=False)
@@ -84,6 +87,13 @@ class CUB_VAEGAN_Configs(Configs):
         parser.add_argument('--g_lambda', type=float, default=1)
         parser.add_argument('--gamma', type=float, default=5)
         parser.add_argument('--pixel_loss', type=str, default="l1", choices=["l1", "mse"])
+        parser.add_argument('--lpips_half', action='store_true', default=False)
+        parser.add_argument('--lpips_channels_last', action='store_true', default=False)
+        parser.add_argument('--fused_decode', action='store_true', default=False) # one decoder / classifier / LPIPS pass for all loss branches
+        parser.add_argument('--sync_timing', action='store_true', default=False) # exact per-phase step times, syncs the gpu after every phase
+        parser.add_argument('--eval_every', type=int, default=1) # epochs between test set evaluations (the last epoch is always evaluated)
+        parser.add_argument('--checkpoint_every', type=int, default=0) # training steps between mid-epoch checkpoints (0: only at the end of each epoch)
+        parser.add_argument('--keep_checkpoints', type=int, default=3) # most recent full checkpoints kept, besides best.pt
         parser.add_argument('--num_features', type=int, default=512)
         parser.add_argument('--img_size', type=int, default=256)
         parser.add_argument('--depth', type=int, default=7)
@@ -91,10 +101,13 @@ class CUB_VAEGAN_Configs(Configs):
         parser.add_argument('--in_channels', type=int, default=3)
         parser.add_argument('--port', type=str, default="5001")
         parser.add_argument('--root_dset', type=str, default="/local/scratch/cv_datasets/CUB_200_2011/")
+        parser.add_argument('--att_encoding', type=str, default="binary", choices=["binary", "continuous", "topk"])
+        parser.add_argument('--att_threshold', type=float, default=50)
+        parser.add_argument('--att_topk', type=int, default=10)
 
 class MNIST_VAEGAN_Configs(Configs):
     def add_arguments(self, parser):
-        parser.add_argument('--continue_checkpoint', action='store_true', default=False)
+        parser.add_argument('--continue_checkpoint', action='store_true', default=False) # resume exp_name from its latest full checkpoint (only the weights for runs without one)
         parser.add_argument('--img_classifier', type=str, default=None)
         parser.add_argument('--add_real_cls_vec', action='store_true', default=False)
         parser.add_argument('--force_hardcode', action='store_true', default=False)
@@ -121,6 +134,13 @@ class MNIST_VAEGAN_Configs(Configs):
         parser.add_argument('--g_lambda', type=float, default=1)
         parser.add_argument('--gamma', type=float, default=10)
         parser.add_argument('--pixel_loss', type=str, default="l1", choices=["l1", "mse"])
+        parser.add_argument('--lpips_half', action='store_true', default=False)
+        parser.add_argument('--lpips_channels_last', action='store_true', default=False)
+        parser.add_argument('--fused_decode', action='store_true', default=False) # one decoder / classifier / LPIPS pass for all loss branches
+        parser.add_argument('--sync_timing', action='store_true', default=False) # exact per-phase step times, syncs the gpu after every phase
+        parser.add_argument('--eval_every', type=int, default=1) # epochs between test set evaluations (the last epoch is always evaluated)
+        parser.add_argument('--checkpoint_every', type=int, default=0) # training steps between mid-epoch checkpoints (0: only at the end of each epoch)
+        parser.add_argument('--keep_checkpoints', type=int, default=3) # most recent full checkpoints kept, besides best.pt
         parser.add_argument('--num_features', type=int, default=10)
         parser.add_argument('--img_size', type=int, default=32)
         parser.add_argument('--depth', type=int, default=4)
@@ -154,4 +174,6 @@ class MNIST_CF_Analysis_Configs(Configs):
         parser.add_argument('--depth', type=int, default=4)
         parser.add_argument('--in_channels', type=int, default=1)
         parser.add_argument('--font_size', type=int, default=12)
-        parser.add_argument('--root_dset', type=str, default="data")
\ No newline at end of file
+        parser.add_argument('--root_dset', type=str, default="data")
+        parser.add_argument('--channels_last', action='store_true', default=False)
+        parser.add_argument('--bf16', action='store_true', default=False)
\ No newline at end of file
@@ -1,7 +1,26 @@
 import os
 
 from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+from torchvision.datasets import MNIST
+from torchvision.transforms import ToTensor, Compose, Resize
+
 from logger import Logger
+from models import ImageClassifier
+from iin_models.ae import IIN_AE
+from utils import save_imgs, set_seed, save_tensor_as_graph, get_device
+from counterfactual_engine import optimize_deltas
+from label_index import LabelIndex
+
+"""
+Runs the visual_counter_factual_iin_ae.py experiment (--force_disentanglement,
+image classifier loss) for every (src, tgt) digit pair in one process, with all
+pair deltas optimized as one batch.
+"""
+
+NUM_ATTRIBUTES = 7
 
 def get_args():
     parser = ArgumentParser()
@@ -10,6 +29,9 @@ def get_args():
     parser.add_argument("--gpu", type=int, default=0)
     parser.add_argument("--no_sample", action="store_true", default=False)
     parser.add_argument("--num_iters", type=int, default=10000)
+    parser.add_argument("--max_iters", type=int, default=10000)
+    parser.add_argument("--stop_option", type=str, choices=["iters", "flip", "conf"], default="iters")
+    parser.add_argument("--conf_thresh", type=float, default=0.9)
     parser.add_argument("--num_features", type=int, default=20)
     parser.add_argument("--lr", type=float, default=0.001)
     parser.add_argument("--exp_name", type=str, default="all_cf")
@@ -23,25 +45,76 @@ def get_lbl_pairs(args):
             lbl_pairs.append([i, j])
     return lbl_pairs
 
+def resize(img):
+    return Resize((28, 28))(img)
+
+def load_data():
+    transform = Compose([
+        Resize((32, 32)),
+        ToTensor()
+    ])
+    return MNIST(root="data", train=False, transform=transform)
+
+def load_models(args):
+    iin_ae = IIN_AE(4, args.num_features, 32, 1, 'an', False)
+    img_classifier = ImageClassifier(10)
+    iin_ae.load_state_dict(torch.load(args.iin_ae, map_location="cpu"))
+    img_classifier.load_state_dict(torch.load(args.img_classifier, map_location="cpu"))
+
+    iin_ae.to(get_device()).eval()
+    img_classifier.to(get_device()).eval()
+    return iin_ae, img_classifier
+
 if __name__ == "__main__":
+    set_seed()
     args = get_args()
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.gpu)
+    device = get_device()
     logger = Logger(output_dir="output", exp_name=args.exp_name)
     lbl_pairs = get_lbl_pairs(args)
 
-    for src_lbl, tgt_lbl in lbl_pairs:
-        logger.log(f"Running experiment for {src_lbl} => {tgt_lbl}")
-        cmd = f'CUDA_VISIBLE_DEVICES={args.gpu} python visual_counter_factual_iin_ae.py' + f' --iin_ae {args.iin_ae}' \
-               + f' --img_classifier {args.img_classifier}' + f' --src_lbl {src_lbl}' \
-               + f' --tgt_lbl {tgt_lbl}' + f' --num_iters {args.num_iters}' \
-               + f' --output_dir {logger.get_path()}' + f' --exp_name {src_lbl}_to_{tgt_lbl}' \
-               + ' --force_disentanglement' + f' --num_features {args.num_features}' + f' --lr {args.lr}'
-        
-        if args.no_sample:
-            cmd += ' --no_sample'
-        
-        logger.log(cmd)
-        output = os.popen(cmd)
-        for line in output.readlines():
-            logger.log(line)
+    test_dset = load_data()
+    lbl_index = LabelIndex.load_or_build(test_dset)
+    iin_ae, img_classifier = load_models(args)
+    sigmoid = nn.Sigmoid()
+
+    # First test image of each source label, one row per pair
+    org_imgs = torch.stack([test_dset[lbl_index[src][0]][0] for src, _ in lbl_pairs]).to(device)
+    tgt_lbls = torch.tensor([tgt for _, tgt in lbl_pairs], device=device)
+
+    def sample_z(rows):
+        return sigmoid(iin_ae.encode(org_imgs[rows]).sample())
+
+    with torch.no_grad():
+        z = sample_z(torch.arange(len(lbl_pairs), device=device))
+
+    logger.log(f"Running experiments for {len(lbl_pairs)} label pairs")
+    results = optimize_deltas(
+        z,
+        tgt_lbls,
+        NUM_ATTRIBUTES,
+        iin_ae.decode,
+        lambda x: img_classifier(resize(x)),
+        sample_fn       = None if args.no_sample else sample_z,
+        clamp           = (0, 1),
+        lr              = args.lr,
+        stop_option     = args.stop_option,
+        num_iters       = args.num_iters,
+        max_iters       = args.max_iters,
+        conf_thresh     = args.conf_thresh,
+        log_fn          = logger.log
+    )
+
+    with torch.no_grad():
+        org_img_recon = iin_ae.decode(z)
+        for row, (src_lbl, tgt_lbl) in enumerate(lbl_pairs):
+            exp_name = f"{src_lbl}_to_{tgt_lbl}"
+            tgt_conf = results["confs"][row, tgt_lbl]
+            logger.log(f"{src_lbl} => {tgt_lbl} | Iterations: {results['iters'][row].item()} | Target Conf: {tgt_conf.item()}")
+            save_tensor_as_graph(results["z_chg"][row], os.path.join(logger.get_path(), exp_name + "_z_chg.png"))
+            save_tensor_as_graph(results["z_edit"][row, :, 0, 0], os.path.join(logger.get_path(), exp_name + "_z_edit.png"))
+            save_imgs(org_img_recon[row:row+1], results["cf_examples"][row:row+1], tgt_conf.view(1), \
+                      results["org_confs"][row, tgt_lbl].view(1), os.path.join(logger.get_path(), exp_name + ".png"))
 
     logger.log("Program complete")
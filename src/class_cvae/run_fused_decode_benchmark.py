@@ -0,0 +1,111 @@
+import copy
+from time import perf_counter
+from argparse import ArgumentParser
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from models import IIN_AE_Wrapper, ResNet50
+from options import Options
+from trainers.ae_trainer import AE_Trainer
+from utils import create_z_from_label, cpu_setup, set_seed, get_device
+
+# Training step throughput of AE_Trainer.compute_loss with and without
+# --fused_decode, on small MNIST-sized IIN_AE configs (CPU unless a GPU is
+# present). For every batch size both modes start from the same weights and
+# batch. Reported per mode: ms per step (loss + backward), aten ops launched
+# per step and bytes allocated per step (from the profiler), and the largest
+# loss / gradient difference to the unfused path.
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[16, 64])
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--num_features", type=int, default=16)
+    parser.add_argument("--img_size", type=int, default=32)
+    parser.add_argument("--in_channels", type=int, default=1)
+    parser.add_argument("--swap_lambda", type=float, default=1)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=2023)
+    return parser.parse_args()
+
+def get_configs(args, fused):
+    return Options({
+        "num_att_vars" : len(create_z_from_label(torch.tensor([0]))[0]),
+        "depth" : args.depth,
+        "num_features" : args.num_features,
+        "img_size" : args.img_size,
+        "in_channels" : args.in_channels,
+        "extra_layers" : 0,
+        "inject_z" : False,
+        "add_real_cls_vec" : False,
+        "add_gan" : False,
+        "force_hardcode" : True,
+        "pixel_loss" : "l1",
+        "lpips_half" : False,
+        "lpips_channels_last" : False,
+        "recon_lambda" : 1,
+        "recon_zero_lambda" : 1,
+        "cls_lambda" : 0.1,
+        "cls_zero_lambda" : 0.1,
+        "kl_lambda" : 0.0001,
+        "force_dis_lambda" : 1,
+        "swap_lambda" : args.swap_lambda,
+        "fused_decode" : fused
+    })
+
+def train_step(trainer, imgs, lbls, configs):
+    trainer.ae.zero_grad(set_to_none=True)
+    loss, _ = trainer.compute_loss(imgs, lbls, trainer.init_stats(), configs)
+    loss.backward()
+    return loss.detach()
+
+def run_mode(ae, img_classifier, imgs, lbls, args, fused):
+    configs = get_configs(args, fused)
+    trainer = AE_Trainer(copy.deepcopy(ae), img_classifier, create_z_from_label)
+    trainer.ae.train()
+
+    # Warm up (builds the shared LPIPS network, which draws random numbers),
+    # then one step from the same seed in both modes for the equivalence check
+    train_step(trainer, imgs, lbls, configs)
+    set_seed(args.seed)
+    loss = train_step(trainer, imgs, lbls, configs)
+    grads = [p.grad.clone() for p in trainer.ae.module.get_ae_parameters() if p.grad is not None]
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        train_step(trainer, imgs, lbls, configs)
+    events = [e for e in prof.key_averages() if e.key.startswith("aten::")]
+    ops = sum(e.count for e in events)
+    allocated = sum(max(e.self_cpu_memory_usage, 0) for e in events)
+
+    start = perf_counter()
+    for _ in range(args.steps):
+        train_step(trainer, imgs, lbls, configs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    ms = (perf_counter() - start) / args.steps * 1000
+    return {"loss" : loss, "grads" : grads, "ms" : ms, "ops" : ops, "allocated" : allocated}
+
+if __name__ == "__main__":
+    args = get_args()
+    cpu_setup(args.threads)
+    set_seed(args.seed)
+
+    ae = IIN_AE_Wrapper(get_configs(args, False))
+    img_classifier = ResNet50(pretrain=False, num_classes=10, img_ch=args.in_channels).eval()
+
+    for batch_size in args.batch_sizes:
+        imgs = torch.rand(batch_size, args.in_channels, args.img_size, args.img_size).to(get_device())
+        lbls = torch.randint(0, 10, (batch_size,)).to(get_device())
+        results = {}
+        for name, fused in [("unfused", False), ("fused", True)]:
+            results[name] = run_mode(ae, img_classifier, imgs, lbls, args, fused)
+
+        base = results["unfused"]
+        for name, r in results.items():
+            loss_diff = (r["loss"] - base["loss"]).abs().item()
+            grad_diff = max((g - bg).abs().max().item() for g, bg in zip(r["grads"], base["grads"]))
+            print(f"batch={batch_size:<4} {name:>8}: {r['ms']:8.1f} ms/step | {base['ms'] / r['ms']:.2f}x | " \
+                  + f"{r['ops']:5d} ops/step | {r['allocated'] / 2**20:8.1f} MB allocated/step | " \
+                  + f"max loss diff {loss_diff:.2e} | max grad diff {grad_diff:.2e}")
@@ -14,7 +14,7 @@ from PIL import Image
 
 from models import Encoder, Decoder, Classifier, ImageClassifier, SimpleEncoder, HandCraftedMNISTDecoder
 from logger import Logger
-from lpips.lpips import LPIPS
+from lpips.lpips import get_lpips
 
 from utils import init_weights, get_hardcode_mnist_latent_map, create_z_from_label
 
@@ -181,7 +181,7 @@ if __name__ == "__main__":
     normal_loss_fn = nn.L1Loss()
     recon_loss_fn = nn.L1Loss()
     if args.use_handcraft:
-        recon_loss_fn = LPIPS()
+        recon_loss_fn = get_lpips()
     class_loss_fn = nn.CrossEntropyLoss()
     params = list(encoder.parameters()) + list(decoder.parameters())
     if args.add_classifier:
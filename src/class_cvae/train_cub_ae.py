@@ -4,18 +4,17 @@ from argparse import ArgumentParser
 import torch
 from torch.utils.data import DataLoader
 import torchvision.transforms as T
-import numpy as np
 
 import torch.multiprocessing as mp
-from torch.utils.data.distributed import DistributedSampler
 from torch.distributed import init_process_group, destroy_process_group
 
 from trainers.ae_trainer import AE_Trainer
 from models import IIN_AE_Wrapper, ResNet50
-from datasets import CUB
+from datasets import CUB, EvalDistributedSampler, ResumableDistributedSampler
 from logger import Logger
 from utils import cub_pad
 from options import CUB_VAEGAN_Configs
+from attribute_codes import load_cub_codes
 
 def load_data(args):
     all_transforms = []
@@ -42,11 +41,13 @@ def load_data(args):
 
     test_transform = T.Compose(test_transform_arr)
 
-    train_dset = CUB(args.root_dset, train=True, bbox=args.use_bbox, transform=train_transform)
-    test_dset = CUB(args.root_dset, train=False, bbox=args.use_bbox, transform=test_transform)
+    # Only bounding box crops have a fixed size to cache at
+    cache_resolution = args.img_size if args.cache_images and args.use_bbox else None
+    train_dset = CUB(args.root_dset, train=True, bbox=args.use_bbox, transform=train_transform, cache_resolution=cache_resolution)
+    test_dset = CUB(args.root_dset, train=False, bbox=args.use_bbox, transform=test_transform, cache_resolution=cache_resolution)
     
-    train_dloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=False, sampler=DistributedSampler(train_dset), num_workers=4, pin_memory=True)
-    test_dloader = DataLoader(test_dset, batch_size=args.batch_size, shuffle=False, pin_memory=True, num_workers=4)
+    train_dloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=False, sampler=ResumableDistributedSampler(train_dset), num_workers=4, pin_memory=True)
+    test_dloader = DataLoader(test_dset, batch_size=args.batch_size, shuffle=False, sampler=EvalDistributedSampler(test_dset), pin_memory=True, num_workers=4)
 
     return train_dloader, test_dloader
 
@@ -56,7 +57,7 @@ def multi_gpu_setup(rank, world_size, port="5001"):
     init_process_group(backend="nccl", rank=rank, world_size=world_size)
 
 def load_models(configs):
-    num_att_vars = len(cub_z_from_label(torch.tensor([0]), configs.root_dset)[0])
+    num_att_vars = get_cub_codes(configs).num_atts
     if configs.only_recon:
         num_att_vars = None
 
@@ -76,26 +77,8 @@ def load_models(configs):
 
     return iin_ae, img_classifier
 
-def get_hardcode_cub_latent_map(root_dset):
-    cub_map = {}
-    with open(os.path.join(root_dset, "attributes/class_attribute_labels_continuous.txt")) as f:
-        lines = f.readlines()
-        for i, line in enumerate(lines):
-            f_vals = np.array(list(map(float, line.split())))
-            code = np.zeros_like([f_vals])
-            code[0][f_vals[0] >= 50] = 1
-            cub_map[i] = code.astype(np.uint8)
-
-    return cub_map
-
-def cub_z_from_label(lbls, root_dset):
-    z_map = get_hardcode_cub_latent_map(root_dset)
-
-    z = z_map[lbls[0].item()]
-    for i in range(1, len(lbls)):
-        z = np.concatenate((z, z_map[lbls[i].item()]), axis=0)
-
-    return torch.tensor(z).cuda()
+def get_cub_codes(configs):
+    return load_cub_codes(configs.root_dset, encoding=configs.att_encoding, threshold=configs.att_threshold, k=configs.att_topk)
 
 def main(rank, world_size, configs):
     multi_gpu_setup(rank, world_size, port=configs.port)
@@ -107,7 +90,7 @@ def main(rank, world_size, configs):
     unnormalize = None #T.Normalize([-0.485/0.229, -0.456/0.224, -0.406/0.225], [1/0.229, 1/0.224, 1/0.225])
     normalize = T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 
-    trainer = AE_Trainer(ae, img_classifier, lambda x: cub_z_from_label(x, configs.root_dset), \
+    trainer = AE_Trainer(ae, img_classifier, get_cub_codes(configs), \
                          gpu_id=rank, img_cls_resize_fn=normalize, logger=logger)
     trainer.train(train_dloader, test_dloader, configs)
     
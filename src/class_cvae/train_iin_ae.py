@@ -16,7 +16,7 @@ from PIL import Image
 from models import Classifier, ImageClassifier, ResNet50
 from iin_models.ae import IIN_AE
 from logger import Logger
-from lpips.lpips import LPIPS
+from lpips.lpips import get_lpips
 
 from utils import init_weights, create_z_from_label
 
@@ -193,7 +193,7 @@ if __name__ == "__main__":
 
     normal_loss_fn = nn.L1Loss()
     def recon_loss_fn(s, t): 
-        return nn.L1Loss()(s, t) + LPIPS()(s, t)
+        return nn.L1Loss()(s, t) + get_lpips()(s, t)
     class_loss_fn = nn.CrossEntropyLoss()
     params = list(iin_ae.parameters())
     if args.add_classifier:
@@ -8,10 +8,10 @@ import torchvision.transforms as T
 import numpy as np
 
 import torch.multiprocessing as mp
-from torch.utils.data.distributed import DistributedSampler
 from torch.distributed import init_process_group, destroy_process_group
 
 from trainers.ae_trainer import AE_Trainer
+from datasets import EvalDistributedSampler, ResumableDistributedSampler
 from models import IIN_AE_Wrapper, ResNet50
 from logger import Logger
 from utils import create_z_from_label
@@ -34,8 +34,8 @@ def load_data(configs):
     ])
     train_dset = MNIST(root="data", train=True, transform=train_transform, download=True)
     test_dset = MNIST(root="data", train=False, transform=test_transform)
-    train_dloader = DataLoader(train_dset, batch_size=configs.batch_size, shuffle=False, sampler=DistributedSampler(train_dset), num_workers=4, pin_memory=True)
-    test_dloader = DataLoader(test_dset, batch_size=configs.batch_size, shuffle=False)
+    train_dloader = DataLoader(train_dset, batch_size=configs.batch_size, shuffle=False, sampler=ResumableDistributedSampler(train_dset), num_workers=4, pin_memory=True)
+    test_dloader = DataLoader(test_dset, batch_size=configs.batch_size, shuffle=False, sampler=EvalDistributedSampler(test_dset))
 
     return train_dloader, test_dloader
 
@@ -14,8 +14,9 @@ from PIL import Image
 
 from models import Encoder, Decoder, Classifier, ImageClassifier, SimpleEncoder, HandCraftedMNISTDecoder
 from logger import Logger
-from lpips.lpips import LPIPS
+from lpips.lpips import get_lpips
 from utils import init_weights, get_hardcode_mnist_latent_map, create_z_from_label
+from metrics import Metrics, StepTimer
 
 """
 Goal: Train a variational autoencoder with a classification head on the latent space.
@@ -153,6 +154,7 @@ def get_args():
     parser.add_argument('--exp_name', type=str, default="debug_swap")
     parser.add_argument('--num_features', type=int, default=20)
     parser.add_argument('--num_class_features', type=int, default=7)
+    parser.add_argument('--sync_timing', action='store_true', default=False)
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -186,7 +188,7 @@ if __name__ == "__main__":
 
     normal_loss_fn = nn.L1Loss()
     l1_loss_fn = nn.L1Loss()
-    lpips_loss_fn = LPIPS()
+    lpips_loss_fn = get_lpips()
     class_loss_fn = nn.CrossEntropyLoss()
     params = list(encoder.parameters()) + list(decoder.parameters())
     if args.add_img_classifier:
@@ -196,19 +198,14 @@ if __name__ == "__main__":
             params += list(img_classifier.parameters())
         img_classifier.cuda()
     optimizer = torch.optim.Adam(params, lr=args.lr)
+    # Metrics and timings live next to the models
+    device = next(encoder.parameters()).device
 
     for epoch in range(args.epochs):
-        losses = {
-            "recon" : 0,
-            "latent_cls" : 0,
-            "normal" : 0,
-            "img_cls" : 0,
-            "img_swap" : 0,
-            "all" : 0
-        }
+        metrics = Metrics(device, names=["recon", "latent_cls", "normal", "img_cls", "img_swap", "all", "img_correct"])
+        timer = StepTimer(device, sync=args.sync_timing)
         total = 0
         correct = 0
-        img_correct = 0
         encoder.train()
         decoder.train()
         if args.pretrain_img_classifier:
@@ -216,9 +213,11 @@ if __name__ == "__main__":
         else:
             img_classifier.train()
         
+        timer.start()
         for imgs, lbls in tqdm(train_dloader, desc="Training"):
             imgs = imgs.cuda()
             lbls = lbls.cuda()
+            timer.mark("data")
 
             if args.use_handcraft:
                 z = encoder(imgs)
@@ -228,7 +227,7 @@ if __name__ == "__main__":
             imgs_recon = decoder(z)
 
             recon_loss = lpips_loss_fn(imgs, imgs_recon) + l1_loss_fn(imgs, imgs_recon)
-            losses["recon"] += recon_loss.item()
+            metrics.add("recon", recon_loss)
             loss = recon_loss * args.recon_lambda
 
             if args.force_disentanglement:
@@ -238,7 +237,7 @@ if __name__ == "__main__":
 
             normal_loss = normal_loss_fn(mu, torch.zeros_like(mu).cuda())
             normal_loss += normal_loss_fn(std, torch.ones_like(mu).cuda())
-            losses["normal"] += normal_loss.item()
+            metrics.add("normal", normal_loss)
             loss += normal_loss * args.normal_lambda
 
             total += len(imgs)
@@ -246,12 +245,12 @@ if __name__ == "__main__":
             out = img_classifier(imgs_recon)
 
             img_cls_loss = class_loss_fn(out, lbls)
-            losses["img_cls"] += img_cls_loss.item()
+            metrics.add("img_cls", img_cls_loss)
             loss += img_cls_loss * args.img_cls_lambda
 
             _, img_preds = torch.max(out, dim=1)
 
-            img_correct += (img_preds == lbls).sum().item()
+            metrics.add("img_correct", (img_preds == lbls).sum())
 
             # SWAPPING
 
@@ -266,23 +265,28 @@ if __name__ == "__main__":
             out = img_classifier(swap_recon)
 
             img_swap_loss = class_loss_fn(out, lbls) + lpips_loss_fn(swap_recon, imgs)
-            losses["img_swap"] += img_swap_loss.item()
+            metrics.add("img_swap", img_swap_loss)
             loss += img_swap_loss * args.img_swap_lambda
 
+            timer.mark("forward")
             optimizer.zero_grad()
             loss.backward()
+            timer.mark("backward")
             optimizer.step()
+            timer.mark("optimizer")
 
-            losses["all"] += loss.item()
+            metrics.add("all", loss)
 
-        for key in losses:
-            losses[key] = round(losses[key] / len(train_dloader), 4)
+        values = metrics.reduce()
+        img_correct = values.pop("img_correct")
+        losses = {key : round(value / len(train_dloader), 4) for key, value in values.items()}
 
         out_string = f"Epoch: {epoch+1} | Total Loss: {losses['all']} | Normal Loss: {losses['normal']} | Recon Loss: {losses['recon']}"
         out_string += f" | Img Class Loss: {losses['img_cls']} | Image Class Acc: {round(img_correct/total, 4)}"
         out_string += f" | Img Swap Loss: {losses['img_swap']}"
 
         logger.log(out_string)
+        logger.log(f"Epoch: {epoch+1} | {timer.summary()}")
 
         save_imgs(imgs, imgs_recon, swap_recon, logger.get_path())
 
@@ -9,8 +9,8 @@ import numpy as np
 
 from PIL import Image
 
-from lpips.lpips import LPIPS
-from utils import tensor_to_numpy_img
+from lpips.lpips import get_lpips
+from utils import tensor_to_numpy_img, get_device
 
 class AE_Decoder_Trainer():
     def __init__(self, ae, img_classifier, lbls_to_att_fn, img_cls_resize_fn=None, gpu_id=None):
@@ -19,8 +19,8 @@ class AE_Decoder_Trainer():
             self.ae = DDP(ae.to(gpu_id), device_ids=[gpu_id], find_unused_parameters=True)
             self.img_classifier = img_classifier.to(gpu_id)
         else:
-            self.ae = ae.cuda()
-            self.img_classifier = img_classifier.cuda()
+            self.ae = ae.to(get_device())
+            self.img_classifier = img_classifier.to(get_device())
             
         self.lbls_to_att_fn = lbls_to_att_fn
         self.img_cls_resize_fn = img_cls_resize_fn 
@@ -52,12 +52,12 @@ class AE_Decoder_Trainer():
                      cls_lambda=0.1, cls_zero_lambda=0.1, force_dis_lambda=1, sparcity_lambda=0.1, \
                      kl_lambda=0.001, force_hardcode=False):
         l1_loss_fn = nn.L1Loss()
-        lpips_loss_fn = LPIPS(device=self.gpu_id)
+        lpips_loss_fn = get_lpips(device=self.gpu_id if self.gpu_id is not None else get_device())
         class_loss_fn = nn.CrossEntropyLoss()
 
         z_dim = self.ae.module.iin_ae.z_dim
-        z_force = self.lbls_to_att_fn(lbls).float().to(imgs.get_device())
-        z_in = torch.normal(0, 1, size=(len(imgs), z_dim)).to(imgs.get_device())
+        z_force = self.lbls_to_att_fn(lbls).float().to(imgs.device)
+        z_in = torch.normal(0, 1, size=(len(imgs), z_dim)).to(imgs.device)
         z_in[:, :z_force.shape[1]] = z_force
         #if force_hardcode:
         #    z_with_hardcode = torch.cat((z_force, z[:, self.num_att_vars:]), 1)
@@ -97,8 +97,8 @@ class AE_Decoder_Trainer():
 
 
                 z_dim = self.ae.module.iin_ae.z_dim
-                z_force = self.lbls_to_att_fn(lbls).float().to(imgs.get_device())
-                z_in = torch.normal(0, 1, size=(len(imgs), z_dim)).to(imgs.get_device())
+                z_force = self.lbls_to_att_fn(lbls).float().to(imgs.device)
+                z_in = torch.normal(0, 1, size=(len(imgs), z_dim)).to(imgs.device)
                 z_in[:, :z_force.shape[1]] = z_force
                 #if force_hardcode:
                 #    z_with_hardcode = torch.cat((z_force, z[:, self.num_att_vars:]), 1)
@@ -129,7 +129,7 @@ class AE_Decoder_Trainer():
     def set_device(self, x):
         if self.gpu_id is not None:
             return x.to(self.gpu_id)
-        return x.cuda()
+        return x.to(get_device())
 
     def save_imgs(self, reals, zero_fakes, fakes, output_dir):      
         reals = tensor_to_numpy_img(reals).astype(np.uint8)
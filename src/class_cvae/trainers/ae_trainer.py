@@ -1,4 +1,5 @@
-
+import random
+import itertools
 from tqdm import tqdm
 
 import torch
@@ -9,20 +10,25 @@ import numpy as np
 
 from PIL import Image
 
-from lpips.lpips import LPIPS
-from utils import tensor_to_numpy_img
+from lpips.lpips import get_lpips
+from utils import tensor_to_numpy_img, get_device, grouped_batch_norm
+from metrics import Metrics, StepTimer
+from checkpoint import CheckpointManager
 
 class AE_Trainer():
     def __init__(self, ae, img_classifier, lbls_to_att_fn, img_cls_resize_fn=None, \
                  gpu_id=None, logger=None):
         self.logger = logger
         self.gpu_id = gpu_id
+        self.device = torch.device("cuda", gpu_id) if gpu_id is not None else get_device()
         if gpu_id is not None:
+            torch.cuda.set_device(gpu_id)
             self.ae = DDP(ae.to(gpu_id), device_ids=[gpu_id], find_unused_parameters=True)
             self.img_classifier = img_classifier.to(gpu_id)
         else:
-            self.ae = ae.cuda()
-            self.img_classifier = img_classifier.cuda()
+            # DataParallel only provides .module here, the same access path as DDP
+            self.ae = nn.DataParallel(ae.to(get_device()))
+            self.img_classifier = img_classifier.to(get_device())
             
         self.lbls_to_att_fn = lbls_to_att_fn
         self.img_cls_resize_fn = img_cls_resize_fn 
@@ -36,67 +42,111 @@ class AE_Trainer():
         self.logger.log(x)
 
     def init_stats(self):
-        stats = {
-            "losses" : {
-                "recon" : 0,
-                "l1" : 0,
-                "lpips" : 0,
-                "zero_reg_recon" : 0,
-                "latent_cls" : 0,
-                "sparcity" : 0,
-                "normal" : 0,
-                "disentangle" : 0,
-                "img_cls" : 0,
-                "img_cls_zero" : 0,
-                "swap" : 0,
-                "g_loss" : 0,
-                "d_loss" : 0,
-                "all" : 0
-            },
-            "total" : 0,
-            "correct" : 0,
-            "zero_correct" : 0
-        }
-
-        return stats
+        # Loss sums and counts stay on the device, see metrics.Metrics
+        return Metrics(self.device, names=[
+            "recon",
+            "l1",
+            "lpips",
+            "zero_reg_recon",
+            "latent_cls",
+            "sparcity",
+            "normal",
+            "disentangle",
+            "img_cls",
+            "img_cls_zero",
+            "swap",
+            "g_loss",
+            "d_loss",
+            "all",
+            "batches",
+            "total",
+            "correct",
+            "zero_correct"
+        ])
+
+    def summarize_stats(self, stats):
+        # One reduction (over ranks) per epoch, in the layout of the epoch strings
+        values = stats.reduce()
+        num_batches = max(values.pop("batches"), 1)
+        counts = {key : values.pop(key) for key in ["total", "correct", "zero_correct"]}
+        return {"losses" : {key : round(value / num_batches, 4) for key, value in values.items()}, **counts}
+
+    def decode_branches(self, zs, fused=False):
+        # {name : z} -> {name : decoded images}, one decoder pass when fused
+        if not fused:
+            return {name : self.ae.module.decode(self.ae.module.replace(z)) for name, z in zs.items()}
+        sizes = [len(z) for z in zs.values()]
+        with grouped_batch_norm(self.ae.module, sizes):
+            imgs = self.ae.module.decode(self.ae.module.replace(torch.cat(list(zs.values()))))
+        return dict(zip(zs.keys(), imgs.split(sizes)))
+
+    def classify_branches(self, imgs, fused=False):
+        # {name : images} -> {name : img_classifier logits}, one classifier pass when fused
+        if not fused:
+            return {name : self.img_classifier(self.img_cls_resize_fn(x)) for name, x in imgs.items()}
+        sizes = [len(x) for x in imgs.values()]
+        with grouped_batch_norm(self.img_classifier, sizes):
+            out = self.img_classifier(self.img_cls_resize_fn(torch.cat(list(imgs.values()))))
+        return dict(zip(imgs.keys(), out.split(sizes)))
+
+    def lpips_branches(self, lpips_loss_fn, imgs, recons, fused=False):
+        # {name : reconstruction} -> {name : mean LPIPS to imgs}, imgs go through the network once when fused
+        if not fused:
+            return {name : lpips_loss_fn(imgs, x) for name, x in recons.items()}
+        dists = lpips_loss_fn.distances(imgs, list(recons.values()))
+        return {name : dist.sum() / imgs.shape[0] for name, dist in zip(recons.keys(), dists)}
 
     def compute_loss(self, imgs, lbls, stats, configs):
         pixel_loss_fn = nn.L1Loss()
         if configs.pixel_loss == "mse":
             pixel_loss_fn = nn.MSELoss()
-        lpips_loss_fn = LPIPS(device=self.gpu_id)
+        lpips_loss_fn = get_lpips(device=self.gpu_id if self.gpu_id is not None else get_device(), half=configs.lpips_half, channels_last=configs.lpips_channels_last)
         class_loss_fn = nn.CrossEntropyLoss()
+        # Fused: every decoder input variant goes through the decoder as one
+        # batch, and the classifier / LPIPS inputs as one batch each. Batch
+        # norm statistics stay per variant, so the losses match the unfused path.
+        fused = configs.fused_decode
+        use_swap = configs.swap_lambda != 0
+        use_zero = configs.cls_zero_lambda != 0 or configs.recon_zero_lambda != 0
 
         z = self.ae.module.encode(imgs)
-        z_force = self.lbls_to_att_fn(lbls).float().to(z.get_device())
+        z_force = self.lbls_to_att_fn(lbls).float().to(z.device)
         if configs.force_hardcode:
             z_for_recon = torch.cat((z_force, z[:, self.num_att_vars:]), 1)
         else:
             z_for_recon = z
 
-        imgs_recon = self.ae.module.decode(self.ae.module.replace(z_for_recon))
+        zs = {"recon" : z_for_recon}
+        if use_swap:
+            z_att = z_for_recon[:, :self.num_att_vars]
+            z_var = z_for_recon[:, self.num_att_vars:]
+            z_var_shuffle = z_var[torch.randperm(len(z_var))]
+            zs["swap"] = torch.cat((z_att, z_var_shuffle), 1)
+        if use_zero:
+            zs["zero"] = torch.cat((z_force, torch.zeros_like(z[:, self.num_att_vars:])), 1)
+
+        decoded = self.decode_branches(zs, fused=fused)
+        imgs_recon = decoded["recon"]
+        lpips_losses = self.lpips_branches(lpips_loss_fn, imgs, {name : decoded[name] for name in ["recon", "zero"] if name in decoded}, fused=fused)
+        cls_names = [name for name, used in [("swap", use_swap), ("zero", use_zero), ("recon", configs.cls_lambda != 0)] if used]
+        cls_outs = self.classify_branches({name : decoded[name] for name in cls_names}, fused=fused) if len(cls_names) > 0 else {}
 
         l1_loss = pixel_loss_fn(imgs, imgs_recon)
-        lpips_loss = lpips_loss_fn(imgs, imgs_recon)
+        lpips_loss = lpips_losses["recon"]
         recon_loss = (l1_loss + lpips_loss) * configs.recon_lambda
-        stats["losses"]["recon"] += recon_loss.item()
-        stats["losses"]["l1"] += l1_loss.item()
-        stats["losses"]["lpips"] += lpips_loss.item()
+        stats.add("recon", recon_loss)
+        stats.add("l1", l1_loss)
+        stats.add("lpips", lpips_loss)
         loss = recon_loss
 
         if configs.add_gan:
             g_loss = self.compute_gen_loss(imgs_recon, configs)
-            stats['losses']['g_loss'] += g_loss.item()
+            stats.add("g_loss", g_loss)
             loss += g_loss
 
-        if configs.swap_lambda != 0:
-            z_att = z_for_recon[:, :self.num_att_vars]
-            z_var = z_for_recon[:, self.num_att_vars:]
-            z_var_shuffle = z_var[torch.randperm(len(z_var))]
-            z_comb = torch.cat((z_att, z_var_shuffle), 1)
-
-            swap_recon = self.ae.module.decode(self.ae.module.replace(z_comb))
-            out_swap = self.img_classifier(self.img_cls_resize_fn(swap_recon))
+        if use_swap:
+            swap_recon = decoded["swap"]
+            out_swap = cls_outs["swap"]
             swap_cls_loss = class_loss_fn(out_swap, lbls) 
 
             swap_loss = swap_cls_loss
@@ -107,85 +157,155 @@ class AE_Trainer():
 
             swap_loss *= configs.swap_lambda
             loss += swap_loss
-            stats["losses"]["swap"] += swap_loss.item()
+            stats.add("swap", swap_loss)
         
-        if configs.cls_zero_lambda != 0 or configs.recon_zero_lambda != 0:
-            z_zero_with_hardcode = torch.cat((z_force, torch.zeros_like(z[:, self.num_att_vars:])), 1)
-            imgs_recon_zero_reg = self.ae.module.decode(self.ae.module.replace(z_zero_with_hardcode))
-            recon_loss_zero = (pixel_loss_fn(imgs, imgs_recon_zero_reg) + lpips_loss_fn(imgs, imgs_recon_zero_reg)) * configs.recon_zero_lambda
-            stats["losses"]["zero_reg_recon"] += recon_loss_zero.item()
+        if use_zero:
+            imgs_recon_zero_reg = decoded["zero"]
+            recon_loss_zero = (pixel_loss_fn(imgs, imgs_recon_zero_reg) + lpips_losses["zero"]) * configs.recon_zero_lambda
+            stats.add("zero_reg_recon", recon_loss_zero)
             loss += recon_loss_zero
 
-            out_zero = self.img_classifier(self.img_cls_resize_fn(imgs_recon_zero_reg))
+            out_zero = cls_outs["zero"]
             img_cls_zero_loss = class_loss_fn(out_zero, lbls) * configs.cls_zero_lambda
-            stats["losses"]["img_cls_zero"] += img_cls_zero_loss.item()
+            stats.add("img_cls_zero", img_cls_zero_loss)
             loss += img_cls_zero_loss
 
             _, img_preds = torch.max(out_zero, dim=1)
 
-            stats["zero_correct"] += (img_preds == lbls).sum().item()
+            stats.add("zero_correct", (img_preds == lbls).sum())
 
         if configs.force_dis_lambda != 0:
             reg = nn.L1Loss()(z[:, :self.num_att_vars], z_force) * configs.force_dis_lambda
-            stats["losses"]["disentangle"] += reg.item()
+            stats.add("disentangle", reg)
             loss += reg
 
         if configs.kl_lambda != 0:
             normal_loss = self.ae.module.kl_loss() * configs.kl_lambda
-            stats["losses"]["normal"] += normal_loss.item()
+            stats.add("normal", normal_loss)
             loss += normal_loss
 
         if configs.cls_lambda != 0:
-            out = self.img_classifier(self.img_cls_resize_fn(imgs_recon))
+            out = cls_outs["recon"]
 
             img_cls_loss = class_loss_fn(out, lbls) * configs.cls_lambda
-            stats["losses"]["img_cls"] += img_cls_loss.item()
+            stats.add("img_cls", img_cls_loss)
             loss += img_cls_loss
 
             _, img_preds = torch.max(out, dim=1)
 
-            stats["total"] += len(imgs)
-            stats["correct"] += (img_preds == lbls).sum().item()
+            stats.add("total", len(imgs))
+            stats.add("correct", (img_preds == lbls).sum())
 
-        stats["losses"]["all"] += loss.item()
+        stats.add("all", loss)
 
         return loss, imgs_recon
     
     def eval(self, test_dloader, configs):
-        correct = 0
-        zero_correct = 0
-        total = 0
+        # Every rank evaluates its shard of the test set (see
+        # datasets.EvalDistributedSampler), the counts are summed over ranks
+        stats = Metrics(self.device, names=["correct", "zero_correct", "total"])
         self.ae.eval()
         with torch.no_grad():
-            for (imgs, lbls) in tqdm(test_dloader, desc="Evaluation"):
+            for (imgs, lbls) in tqdm(test_dloader, desc="Evaluation", disable=not self.is_base_process()):
                 imgs = self.set_device(imgs)
                 lbls = self.set_device(lbls)
 
 
                 z = self.ae.module.encode(imgs)
-                z_force = self.lbls_to_att_fn(lbls).float().to(z.get_device())
+                z_force = self.lbls_to_att_fn(lbls).float().to(z.device)
                 if configs.force_hardcode:
-                    imgs_recon = self.ae.module.decode(torch.cat((z_force, z[:, self.num_att_vars:]), 1))
+                    z_recon = torch.cat((z_force, z[:, self.num_att_vars:]), 1)
                 else:
-                    imgs_recon = self.ae.module.decode(z)
-                
-                out = self.img_classifier(self.img_cls_resize_fn(imgs_recon))
-                _, preds = torch.max(out, dim=1)
-
-                correct += (preds == lbls).sum().item()
-                total += len(imgs)
+                    z_recon = z
+                z_zero = torch.cat((z_force, torch.zeros_like(z[:, self.num_att_vars:])), 1)
 
-                imgs_zero = self.ae.module.decode(torch.cat((z_force, torch.zeros_like(z[:, self.num_att_vars:])), 1))
-                zero_out = self.img_classifier(self.img_cls_resize_fn(imgs_zero))
+                # Reconstruction and zero variation decoded and classified
+                # together, batch norm uses its running stats here
+                imgs_recon, imgs_zero = self.ae.module.decode(torch.cat((z_recon, z_zero))).split(len(imgs))
+                out, zero_out = self.img_classifier(self.img_cls_resize_fn(torch.cat((imgs_recon, imgs_zero)))).split(len(imgs))
+                _, preds = torch.max(out, dim=1)
                 _, zero_preds = torch.max(zero_out, dim=1)
-                zero_correct += (zero_preds == lbls).sum().item()
+
+                stats.add("correct", (preds == lbls).sum())
+                stats.add("zero_correct", (zero_preds == lbls).sum())
+                stats.add("total", len(imgs))
 
             if self.logger is not None and self.is_base_process():
                 gen_imgs = None
                 if configs.add_gan:
-                    gen_imgs = self.ae.module.generate(len(imgs), imgs.get_device())
+                    gen_imgs = self.ae.module.generate(len(imgs), imgs.device)
                 self.save_imgs(imgs, imgs_zero, imgs_recon, gen_imgs, self.logger.get_path())
-        return correct / total, zero_correct / total
+        stats = stats.reduce()
+        total = max(stats["total"], 1)
+        return stats["correct"] / total, stats["zero_correct"] / total
+
+    def training_state(self, optimizer, optimizerD, epoch, step, stats=None):
+        # Everything needed to continue from (epoch, step), the next batch to
+        # run: weights, optimizer moments and, per rank, the RNG states and the
+        # partial epoch metrics. Collective under DDP (the rank states are
+        # gathered), so every rank has to call it.
+        local = {
+            "rng" : {
+                "torch" : torch.get_rng_state(),
+                "cuda" : torch.cuda.get_rng_state(self.device) if self.device.type == "cuda" else None,
+                "numpy" : np.random.get_state(),
+                "random" : random.getstate()
+            },
+            "stats" : {} if stats is None else {name : value.cpu() for name, value in stats.sums.items()}
+        }
+        ranks = [local]
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            ranks = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(ranks, local)
+
+        return {
+            "ae" : self.ae.module.state_dict(),
+            "img_classifier" : self.img_classifier.state_dict(),
+            "optimizer" : optimizer.state_dict(),
+            "optimizerD" : optimizerD.state_dict() if optimizerD is not None else None,
+            "epoch" : epoch,
+            "step" : step,
+            "ranks" : ranks
+        }
+
+    def load_training_state(self, state, optimizer, optimizerD):
+        self.ae.module.load_state_dict(state["ae"])
+        self.img_classifier.load_state_dict(state["img_classifier"])
+        optimizer.load_state_dict(state["optimizer"])
+        if optimizerD is not None and state["optimizerD"] is not None:
+            optimizerD.load_state_dict(state["optimizerD"])
+
+    def load_rank_state(self, state, stats):
+        # RNG states and partial metrics of this rank, kept as they are when
+        # the checkpoint was written with a different number of ranks
+        rank = 0
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank = torch.distributed.get_rank()
+        if rank >= len(state["ranks"]): return
+        local = state["ranks"][rank]
+        torch.set_rng_state(local["rng"]["torch"])
+        if local["rng"]["cuda"] is not None and self.device.type == "cuda":
+            torch.cuda.set_rng_state(local["rng"]["cuda"], self.device)
+        np.random.set_state(local["rng"]["numpy"])
+        random.setstate(local["rng"]["random"])
+        for name, value in local["stats"].items():
+            if name in stats.sums:
+                stats.sums[name].copy_(value)
+
+    def save_checkpoint(self, checkpoints, optimizer, optimizerD, epoch, step, stats=None, metric=None):
+        # Rank 0 writes in the background, see checkpoint.CheckpointManager.
+        # At the end of an epoch the plain ae.pt / img_classifier.pt weights
+        # the other scripts load are updated too.
+        if checkpoints is None: return
+        state = self.training_state(optimizer, optimizerD, epoch, step, stats)
+        if not self.is_base_process(): return
+        exports = {}
+        if step == 0:
+            exports = {
+                f"{self.logger.get_path()}/ae.pt" : "ae",
+                f"{self.logger.get_path()}/img_classifier.pt" : "img_classifier"
+            }
+        checkpoints.save(state, f"epoch_{epoch:04d}_step_{step:06d}.pt", metric=metric, exports=exports)
 
     def is_base_process(self):
         if self.gpu_id is not None and self.gpu_id != 0:
@@ -195,7 +315,7 @@ class AE_Trainer():
     def set_device(self, x):
         if self.gpu_id is not None:
             return x.to(self.gpu_id)
-        return x.cuda()
+        return x.to(get_device())
 
     def save_imgs(self, reals, zero_fakes, fakes, gen_imgs, output_dir):      
         reals = tensor_to_numpy_img(reals).astype(np.uint8)
@@ -249,7 +369,7 @@ class AE_Trainer():
         d_loss_fake = torch.nn.functional.softplus(fake_out).mean()
 
         b, c, w, h = imgs.shape
-        t = torch.rand((b, 1, 1, 1)).to(imgs.get_device())
+        t = torch.rand((b, 1, 1, 1)).to(imgs.device)
         t = t.repeat(1, c, w, h)
 
         inter = (t * imgs + (1 - t) * imgs_recon).requires_grad_(True)
@@ -260,8 +380,8 @@ class AE_Trainer():
 
         d_loss = (d_loss_real + grad_penalty_loss + d_loss_fake) * configs.d_lambda
         
-        stats['losses']['d_loss'] += d_loss.item()
-        stats["losses"]["all"] += d_loss.item()
+        stats.add("d_loss", d_loss)
+        stats.add("all", d_loss)
 
         return d_loss
 
@@ -274,24 +394,56 @@ class AE_Trainer():
             optimizerD = torch.optim.Adam(self.ae.module.discriminator.parameters(), \
                                           lr=configs.lr, betas=(0.5, 0.999))
 
+        checkpoints = None
+        resume = None
+        start_epoch, start_step = 0, 0
+        if self.logger is not None:
+            checkpoints = CheckpointManager(f"{self.logger.get_path()}/checkpoints", keep=configs.keep_checkpoints)
+            if configs.continue_checkpoint:
+                resume = checkpoints.load_latest()
+        if resume is not None:
+            self.load_training_state(resume, optimizer, optimizerD)
+            start_epoch, start_step = resume["epoch"], resume["step"]
+            self.log(f"Resuming from epoch {start_epoch+1}, step {start_step}")
+
         self.img_classifier.eval()
-        for epoch in range(configs.epochs):
+        for epoch in range(start_epoch, configs.epochs):
             stats = self.init_stats()
+            timer = StepTimer(self.device, sync=configs.sync_timing)
             self.ae.train()
-            if self.gpu_id is not None:
+            if hasattr(train_dloader.sampler, "set_epoch"):
                 train_dloader.sampler.set_epoch(epoch)
-            num_batches = 0
-            for imgs, lbls in tqdm(train_dloader, desc=f"Training Epoch {epoch+1}"):
+            num_batches = len(train_dloader)
+            step = 0
+            if epoch == start_epoch and start_step > 0:
+                # Skip the batches the checkpoint already trained on, without
+                # loading them when the sampler can start part way
+                step = start_step
+                if hasattr(train_dloader.sampler, "set_start"):
+                    train_dloader.sampler.set_start(step * train_dloader.batch_size)
+            batches = iter(train_dloader)
+            if epoch == start_epoch and start_step > 0 and not hasattr(train_dloader.sampler, "set_start"):
+                batches = itertools.islice(batches, start_step, None)
+            if epoch == start_epoch and resume is not None:
+                # After the loader has drawn its seeds, so the rest of the
+                # epoch draws the same random numbers as the original run
+                self.load_rank_state(resume, stats)
+            timer.start()
+            for imgs, lbls in tqdm(batches, desc=f"Training Epoch {epoch+1}", initial=step, total=num_batches):
                 optimizer.zero_grad(set_to_none=True)
                 
-                num_batches += 1
+                stats.add("batches", 1)
                 imgs = self.set_device(imgs)
                 lbls = self.set_device(lbls)
+                timer.mark("data")
 
                 loss, imgs_recon = self.compute_loss(imgs, lbls, stats, configs)
+                timer.mark("forward")
 
                 loss.backward()
+                timer.mark("backward")
                 optimizer.step()
+                timer.mark("optimizer")
                 
                 if configs.add_gan:
                     if configs.d_lambda != 0:
@@ -299,10 +451,13 @@ class AE_Trainer():
                         d_loss = self.compute_dis_loss(imgs, imgs_recon, lbls, stats, configs)
                         d_loss.backward()
                         optimizerD.step()
-                
+                        timer.mark("discriminator")
+
+                step += 1
+                if configs.checkpoint_every > 0 and step % configs.checkpoint_every == 0 and step < num_batches:
+                    self.save_checkpoint(checkpoints, optimizer, optimizerD, epoch, step, stats)
 
-            for key in stats["losses"]:
-                stats["losses"][key] = round(stats["losses"][key] / num_batches, 4)
+            stats = self.summarize_stats(stats)
 
             if stats['total'] == 0:
                 stats['total'] = 1
@@ -324,14 +479,18 @@ class AE_Trainer():
                 #+ f"Image Zero Class Acc: {round(stats['zero_correct']/stats['total'], 4)}" \
 
             self.log(out_string)
+            self.log(f"Epoch: {epoch+1} | {timer.summary()}")
 
-            if self.is_base_process():
+            acc = None
+            if (epoch + 1) % configs.eval_every == 0 or epoch + 1 == configs.epochs:
                 acc, zero_acc = self.eval(test_dloader, configs)
                 self.log(f"Epoch: {epoch+1} | Test Accuracy: {round(acc, 4)} | Zero Test Accuracy: {round(zero_acc, 4)}")
 
-            if self.logger is not None and self.is_base_process():
-                torch.save(self.ae.module.state_dict(), f"{self.logger.get_path()}/ae.pt")
-                torch.save(self.img_classifier.state_dict(), f"{self.logger.get_path()}/img_classifier.pt")
+            self.save_checkpoint(checkpoints, optimizer, optimizerD, epoch + 1, 0, metric=acc)
+
+            if self.gpu_id is not None:
+                torch.distributed.barrier()
 
-            torch.distributed.barrier()
+        if checkpoints is not None:
+            checkpoints.wait()
 
@@ -5,11 +5,13 @@ import numpy as np
 
 from tqdm import tqdm
 
+from utils import get_device
+
 
 class ClassifierTrainer():
     def __init__(self, classifier, logger=None):
-        self.classifier = classifier
-        self.classifier.cuda()
+        self.device = get_device()
+        self.classifier = classifier.to(self.device)
         self.logger = logger
 
     def log(self, x):
@@ -34,8 +36,8 @@ class ClassifierTrainer():
             total = 0
             self.classifier.train()
             for (imgs, lbls) in tqdm(train_dloader):
-                imgs = imgs.cuda()
-                lbls = lbls.cuda()
+                imgs = imgs.to(self.device)
+                lbls = lbls.to(self.device)
 
                 out = self.classifier(imgs)
                 loss = class_loss_fn(out, lbls)
@@ -58,8 +60,8 @@ class ClassifierTrainer():
             self.classifier.eval()
             with torch.no_grad():
                 for (imgs, lbls) in tqdm(test_dloader):
-                    imgs = imgs.cuda()
-                    lbls = lbls.cuda()
+                    imgs = imgs.to(self.device)
+                    lbls = lbls.to(self.device)
 
                     out = self.classifier(imgs)
 
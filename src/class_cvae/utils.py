@@ -1,4 +1,5 @@
 import random
+import contextlib
 
 import torch
 import torch.nn as nn
@@ -8,6 +9,8 @@ import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw, ImageFont
 from torchvision.transforms.functional import pad
 
+from attribute_codes import AttributeCodes
+
 class MaxQueue:
     def __init__(self, size=10):
         self.size = 10
@@ -29,6 +32,43 @@ class MaxQueue:
             acc += z
         return acc / len(self.arr)
 
+def get_device(device=None):
+    # Falls back to the CPU when no GPU is present
+    if device is not None:
+        return torch.device(device)
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def cpu_setup(threads=None):
+    if threads is None: return
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass # Already set once parallel work has started
+
+def autocast(enabled, device):
+    # bfloat16 autocast on either device, a no-op when disabled
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+@contextlib.contextmanager
+def grouped_batch_norm(module, sizes):
+    # Inside the context, every BatchNorm of module that is in training mode
+    # normalizes the chunks (of the given sizes) of its batch separately, in
+    # order. A concatenated batch then gets the same outputs and running stat
+    # updates as running each chunk through module on its own.
+    patched = []
+    for m in module.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training:
+            m.forward = lambda x, forward=m.forward: torch.cat([forward(c) for c in x.split(sizes)])
+            patched.append(m)
+    try:
+        yield module
+    finally:
+        for m in patched:
+            del m.forward
+
 def set_seed(seed=2023):
     torch.manual_seed(seed)
     random.seed(seed)
@@ -186,7 +226,7 @@ def save_tensor_as_graph(ten, output="tensor_graph.png"):
 
 def calc_img_diff_loss(org_img_recon, imgs_recon, loss_fn):
     diffs = (org_img_recon - imgs_recon)
-    loss = nn.L1Loss()(diffs, torch.zeros_like(diffs).cuda())
+    loss = nn.L1Loss()(diffs, torch.zeros_like(diffs))
     return loss
 
 def get_hardcode_mnist_latent_map():
@@ -203,11 +243,11 @@ def get_hardcode_mnist_latent_map():
         9: np.array([[1, 1, 0, 1, 1, 0, 1]]),
     }
 
-def create_z_from_label(lbls):
-    z_map = get_hardcode_mnist_latent_map()
+_mnist_codes = None
 
-    z = z_map[lbls[0].item()]
-    for i in range(1, len(lbls)):
-        z = np.concatenate((z, z_map[lbls[i].item()]), axis=0)
-
-    return torch.tensor(z).cuda()
\ No newline at end of file
+def create_z_from_label(lbls):
+    global _mnist_codes
+    if _mnist_codes is None:
+        z_map = get_hardcode_mnist_latent_map()
+        _mnist_codes = AttributeCodes(np.concatenate([z_map[i] for i in range(len(z_map))]))
+    return _mnist_codes(lbls)
\ No newline at end of file
@@ -15,7 +15,8 @@ from PIL import Image, ImageDraw, ImageFont
 import matplotlib.pyplot as plt
 
 from models import Encoder, Decoder, Classifier, ImageClassifier
-from utils import create_img_from_text, save_imgs, MaxQueue, set_seed, save_tensor_as_graph, get_hardcode_mnist_latent_map
+from utils import create_img_from_text, save_imgs, MaxQueue, set_seed, save_tensor_as_graph, get_hardcode_mnist_latent_map, get_device
+from label_index import LabelIndex
 
 def load_data():
     test_dset = MNIST(root="data", train=False, transform=ToTensor())
@@ -53,7 +54,7 @@ def get_args():
 def get_chg_vec(src_lbl, tgt_lbl):
     z_map = get_hardcode_mnist_latent_map()
 
-    return torch.tensor(z_map[tgt_lbl.item()] - z_map[src_lbl.item()]).cuda() 
+    return torch.tensor(z_map[tgt_lbl.item()] - z_map[src_lbl.item()]).to(tgt_lbl.device) 
 
 
 if __name__ == "__main__":
@@ -61,20 +62,13 @@ if __name__ == "__main__":
     args = get_args()
     test_dset = load_data()
 
-    org_img = None
-    #TODO make a batch
-    i = args.batch_size
-    for img, lbl in test_dset:
-        if lbl == args.src_lbl:
-            i -= 1
-            if org_img is None:
-                org_img = img.cuda().unsqueeze(0)
-            else:
-                org_img = torch.cat((org_img, img.unsqueeze(0).cuda()), axis=0)
-        if i <= 0: break
-
-    tgt_lbl = torch.tensor([args.tgt_lbl]).cuda()
-    src_lbl = torch.tensor([args.src_lbl]).cuda()
+    # The first batch_size test images of src_lbl
+    device = get_device()
+    lbl_index = LabelIndex.load_or_build(test_dset)
+    org_img = torch.stack([test_dset[i][0] for i in lbl_index.take(args.src_lbl, args.batch_size)]).to(device)
+
+    tgt_lbl = torch.tensor([args.tgt_lbl], device=device)
+    src_lbl = torch.tensor([args.src_lbl], device=device)
 
     encoder = Encoder(args.num_features, use_sigmoid=args.force_disentanglement)
     decoder = Decoder(args.num_features)
@@ -82,19 +76,19 @@ if __name__ == "__main__":
     if args.force_disentanglement:
         classifier = Classifier(7, 10)
     img_classifier = ImageClassifier(10)
-    encoder.load_state_dict(torch.load(args.encoder))
-    decoder.load_state_dict(torch.load(args.decoder))
+    encoder.load_state_dict(torch.load(args.encoder, map_location=device))
+    decoder.load_state_dict(torch.load(args.decoder, map_location=device))
     if args.classifier is not None:
-        classifier.load_state_dict(torch.load(args.classifier))
+        classifier.load_state_dict(torch.load(args.classifier, map_location=device))
     if args.img_classifier is not None:
-        img_classifier.load_state_dict(torch.load(args.img_classifier))
+        img_classifier.load_state_dict(torch.load(args.img_classifier, map_location=device))
 
     args.optimize_on_img_cls = args.optimize_on_img_cls or args.classifier is None
     
-    encoder.cuda()
-    decoder.cuda()
-    classifier.cuda()
-    img_classifier.cuda()
+    encoder.to(device)
+    decoder.to(device)
+    classifier.to(device)
+    img_classifier.to(device)
     
     encoder.eval()
     decoder.eval()
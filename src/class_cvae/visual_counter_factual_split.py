@@ -15,7 +15,8 @@ from PIL import Image, ImageDraw, ImageFont
 import matplotlib.pyplot as plt
 
 from models import Encoder, Decoder, Classifier, ImageClassifier
-from utils import create_img_from_text, MaxQueue, set_seed, save_tensor_as_graph, calc_img_diff_loss
+from utils import create_img_from_text, MaxQueue, set_seed, save_tensor_as_graph, calc_img_diff_loss, get_device
+from label_index import LabelIndex, ClassBatchSampler
 
 """
 Goal: Create visual counterfactual
@@ -149,34 +150,27 @@ if __name__ == "__main__":
     args = get_args()
     test_dset = load_data()
 
-    org_img = None
-    #TODO make a batch
-    i = args.batch_size
-    for img, lbl in test_dset:
-        if lbl == args.src_lbl:
-            i -= 1
-            if org_img is None:
-                org_img = img.cuda().unsqueeze(0)
-            else:
-                org_img = torch.cat((org_img, img.unsqueeze(0).cuda()), axis=0)
-        if i <= 0: break
-
-    tgt_lbl = torch.tensor([args.tgt_lbl]).cuda()
-    src_lbl = torch.tensor([args.src_lbl]).cuda()
+    # The first batch_size test images of src_lbl
+    device = get_device()
+    lbl_index = LabelIndex.load_or_build(test_dset)
+    org_img = torch.stack([test_dset[i][0] for i in lbl_index.take(args.src_lbl, args.batch_size)]).to(device)
+
+    tgt_lbl = torch.tensor([args.tgt_lbl], device=device)
+    src_lbl = torch.tensor([args.src_lbl], device=device)
 
     encoder = Encoder(args.num_features, use_sigmoid=True)
     decoder = Decoder(args.num_features)
     class_decoder = Decoder(args.num_class_features)
     img_classifier = ImageClassifier(10)
-    encoder.load_state_dict(torch.load(args.encoder))
-    decoder.load_state_dict(torch.load(args.decoder))
-    class_decoder.load_state_dict(torch.load(args.class_decoder))
-    img_classifier.load_state_dict(torch.load(args.img_classifier))
+    encoder.load_state_dict(torch.load(args.encoder, map_location=device))
+    decoder.load_state_dict(torch.load(args.decoder, map_location=device))
+    class_decoder.load_state_dict(torch.load(args.class_decoder, map_location=device))
+    img_classifier.load_state_dict(torch.load(args.img_classifier, map_location=device))
  
-    encoder.cuda()
-    decoder.cuda()
-    class_decoder.cuda()
-    img_classifier.cuda()
+    encoder.to(device)
+    decoder.to(device)
+    class_decoder.to(device)
+    img_classifier.to(device)
     
     encoder.eval()
     decoder.eval()
@@ -192,19 +186,15 @@ if __name__ == "__main__":
         b_q = MaxQueue(size=size)
         a_c = b_c = 0
         with torch.no_grad():
-            for img, lbl in test_dset:
-                if lbl == args.src_lbl:
-                    z_a = encoder(img.cuda().unsqueeze(0))
-                    cls_img = class_decoder(z_a[:, :args.num_class_features])
-                    out = img_classifier(cls_img)
-                    conf = sm(out)[0, args.src_lbl].item()
-                    a_q.add(z_a, conf)
-                elif lbl == args.tgt_lbl:
-                    z_b = encoder(img.cuda().unsqueeze(0))
-                    cls_img = class_decoder(z_b[:, :args.num_class_features])
-                    out = img_classifier(cls_img)
-                    conf = sm(out)[0, args.tgt_lbl].item()
-                    b_q.add(z_b, conf)
+            # Only the src_lbl and tgt_lbl images, in batches, each queue
+            # still sees its images in dataset order
+            for q, q_lbl in [(a_q, args.src_lbl), (b_q, args.tgt_lbl)]:
+                for imgs, _ in DataLoader(test_dset, batch_sampler=ClassBatchSampler(lbl_index, [q_lbl], 256)):
+                    z_q = encoder(imgs.to(device))
+                    cls_img = class_decoder(z_q[:, :args.num_class_features])
+                    confs = sm(img_classifier(cls_img))[:, q_lbl].tolist()
+                    for j, conf in enumerate(confs):
+                        q.add(z_q[j:j+1], conf)
         a = a_q.avg_val()
         b = b_q.avg_val()
         chg_path = (b - a)
@@ -215,9 +205,9 @@ if __name__ == "__main__":
     class_loss_fn = nn.CrossEntropyLoss()
 
     if chg_path is not None:
-        z_chg = (torch.ones_like(chg_path).cuda() * -1)
+        z_chg = (torch.ones_like(chg_path) * -1)
     else:
-        z_chg = torch.zeros(args.num_class_features).cuda()
+        z_chg = torch.zeros(args.num_class_features, device=device)
     
     z_chg = z_chg[:args.num_class_features]
 
@@ -246,11 +236,11 @@ if __name__ == "__main__":
             delta = (chg_path * sig_z_chg)#.repeat(args.batch_size, 1)
             z_edit = z.clone()
             z_edit[:, :args.num_class_features] += delta
-            loss = min_loss_fn(sig_z_chg, torch.zeros_like(z_chg).cuda())
+            loss = min_loss_fn(sig_z_chg, torch.zeros_like(z_chg))
         else:
             z_edit = z.clone()
             z_edit[:, :args.num_class_features] += z_chg.unsqueeze(0).repeat(args.batch_size, 1)
-            loss = min_loss_fn(z_chg, torch.zeros_like(z_chg).cuda())
+            loss = min_loss_fn(z_chg, torch.zeros_like(z_chg))
 
         loss *= args.z_lambda
 
@@ -285,7 +275,7 @@ if __name__ == "__main__":
             tgt_logit = torch.gather(logit_diff, 1, tgt_lbl.repeat(args.batch_size).reshape(-1, 1))
             src_logit = torch.gather(logit_diff, 1, src_lbl.repeat(args.batch_size).reshape(-1, 1))
 
-            cls_loss = -tgt_logit.mean() + nn.L1Loss()(logit_diff, torch.zeros_like(logit_diff).cuda())
+            cls_loss = -tgt_logit.mean() + nn.L1Loss()(logit_diff, torch.zeros_like(logit_diff))
 
         loss += args.cls_lambda * cls_loss
 
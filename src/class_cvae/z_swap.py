@@ -15,7 +15,8 @@ from PIL import Image, ImageDraw, ImageFont
 import matplotlib.pyplot as plt
 
 from models import Encoder, Decoder, Classifier, ImageClassifier
-from utils import create_img_from_text, save_imgs, set_seed
+from utils import create_img_from_text, save_imgs, set_seed, get_device
+from label_index import LabelIndex
 
 
 """
@@ -48,32 +49,27 @@ if __name__ == "__main__":
     args = get_args()
     test_dset = load_data()
 
-    src_img = None
-    tgt_img = None
-    for img, lbl in test_dset:
-        if lbl == args.src_lbl:
-            src_img = img.cuda().unsqueeze(0)
-        elif lbl == args.tgt_lbl:
-            tgt_img = img.cuda().unsqueeze(0)
-        
-        if src_img is not None and tgt_img is not None: break
+    device = get_device()
+    lbl_index = LabelIndex.load_or_build(test_dset)
+    src_img = test_dset[lbl_index[args.src_lbl][0]][0].to(device).unsqueeze(0)
+    tgt_img = test_dset[lbl_index[args.tgt_lbl][0]][0].to(device).unsqueeze(0)
 
     encoder = Encoder(args.num_features, use_sigmoid=True)
     decoder = Decoder(args.num_features)
     classifier = Classifier(7, 10)
     img_classifier = ImageClassifier(10)
-    encoder.load_state_dict(torch.load(args.encoder))
-    decoder.load_state_dict(torch.load(args.decoder))
+    encoder.load_state_dict(torch.load(args.encoder, map_location=device))
+    decoder.load_state_dict(torch.load(args.decoder, map_location=device))
     
     if args.classifier is not None:
-        classifier.load_state_dict(torch.load(args.classifier))
+        classifier.load_state_dict(torch.load(args.classifier, map_location=device))
     if args.img_classifier is not None:
-        img_classifier.load_state_dict(torch.load(args.img_classifier))
+        img_classifier.load_state_dict(torch.load(args.img_classifier, map_location=device))
  
-    encoder.cuda()
-    decoder.cuda()
-    classifier.cuda()
-    img_classifier.cuda()
+    encoder.to(device)
+    decoder.to(device)
+    classifier.to(device)
+    img_classifier.to(device)
     
     encoder.eval()
     decoder.eval()